@@ -6,8 +6,15 @@
 
 import math
 import numpy as np
-from datetime import timedelta
-from geopy.distance import great_circle
+from contextlib import contextmanager
+from time import perf_counter
+from geopy.distance import great_circle, EARTH_RADIUS
+from scipy.spatial import cKDTree
+
+from utils.geofunctions_utils import latlon_to_unit_vectors, chord_threshold
+NOISE = -1
+UNMARKED = 777777
+
 """
 SOURCE:
     Birant, D. and Kut, A. (2007). St-dbscan: An algorithm for clustering 
@@ -19,57 +26,297 @@ INPUTS:
     spatial_threshold = Maximum geographical coordinate (spatial) distance value
     temporal_threshold = Maximum non-spatial distance value
     min_neighbors = Minimun number of points within Eps1 and Eps2 distance
+    temporal_resolution = 'month' (default, month column, threshold in months),
+                          'day' (Date column, threshold in days) or
+                          'dayofyear' (Date column, threshold in days wrapping around the year)
+    n_jobs = Number of processes, cluster lat/lon tiles in parallel if not 1 (optional)
+    tile_size = Tile size in degrees for the parallel mode (optional)
+    cache = ClusteringCache (ST_DBSCAN.cache) to load/store the labels on disk (optional)
+    stats = ClusteringStats to collect counters and phase timings of the run (optional)
 OUTPUT:
     C = {c1,c2,...,ck} Set of clusters
 """
-def ST_DBSCAN(df, spatial_threshold, temporal_threshold, min_neighbors):
-    cluster_label = 0
-    NOISE = -1
-    UNMARKED = 777777
-    stack = []
-
-    # initialize each point with unmarked
-    df['cluster'] = UNMARKED
-    
-    # for each point in database
-    for index, point in df.iterrows():
-        if df.loc[index]['cluster'] == UNMARKED:
-            neighborhood = retrieve_neighbors(index, df, spatial_threshold, temporal_threshold)
-            
-            if len(neighborhood) < min_neighbors:
-                df.set_value(index, 'cluster', NOISE)
-
-            else: # found a core point
-                cluster_label = cluster_label + 1
-                df.set_value(index, 'cluster', cluster_label)# assign a label to core point
-
-                for neig_index in neighborhood: # assign core's label to its neighborhood
-                    df.set_value(neig_index, 'cluster', cluster_label)
-                    stack.append(neig_index) # append neighborhood to stack
-                
-                """
-                    The stack is necessary to find density-reachable objects from
-                    directly density-reachable objects
-                """
-                while len(stack) > 0: # find new neighbors from core point neighborhood
-                    current_point_index = stack.pop()
-                    
-                    """
-                    mabye add filtering of months here?
-                    months = get_re
-                    """
-                    
-                    new_neighborhood = retrieve_neighbors(current_point_index, df, spatial_threshold, temporal_threshold)
-                    
-                    if len(new_neighborhood) >= min_neighbors: # current_point is a new core
-                        for neig_index in new_neighborhood:
-                            neig_cluster = df.loc[neig_index]['cluster']
-                            if (neig_cluster != NOISE) & (neig_cluster == UNMARKED): 
-                                # TODO: verify cluster average before add new point
-                                df.set_value(neig_index, 'cluster', cluster_label)
-                                stack.append(neig_index)
+def ST_DBSCAN(df, spatial_threshold, temporal_threshold, min_neighbors, temporal_resolution='month',
+              n_jobs=1, tile_size=1.0, cache=None, stats=None):
+    # thin wrapper around the array based engine
+    time = df['month'].values if temporal_resolution == 'month' else df['Date'].values
+    if cache is not None:
+        start_time = perf_counter()
+        df['cluster'] = cache.labels(df['Latitude'].values, df['Longitude'].values, time,
+                                     spatial_threshold, temporal_threshold, min_neighbors,
+                                     temporal_resolution=temporal_resolution, n_jobs=n_jobs, tile_size=tile_size)
+        if stats is not None:  # only the time is recorded through the cache
+            stats.add_time('cache', perf_counter() - start_time)
+            stats.report()
+        return df
+
+    engine = STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors, temporal_resolution=temporal_resolution,
+                      n_jobs=n_jobs, tile_size=tile_size)
+    df['cluster'] = engine.fit_predict(df['Latitude'].values, df['Longitude'].values, time, stats=stats)
     return df
 
+
+class STDBSCAN():
+    """
+    Array based ST-DBSCAN engine with an estimator style API, e.g.
+
+        labels = STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors).fit_predict(lat, lon, month)
+        labels = STDBSCAN(spatial_threshold, 7, min_neighbors, temporal_resolution='day').fit_predict(lat, lon, date)
+
+    Labels are kept in an int32 array (NOISE = -1, clusters numbered from 1) and the
+    expansion stack in a preallocated buffer, nothing is written to a dataframe.
+    The labels are identical to the original dataframe implementation of ST_DBSCAN.
+
+    Parameters
+    ----------
+        spatial_threshold -- float, maximum great circle distance (km)
+        temporal_threshold -- int, maximum distance in months (wrapping around the year), or
+            float, maximum distance in days for the day resolutions
+        min_neighbors -- int, minimum number of neighbors (the point itself not included) of a core point
+        temporal_resolution -- string, default 'month', one of
+            'month': time is the month (1-12)
+            'day': time is a timestamp (datetime64), the window is found by binary search on the sorted times
+            'dayofyear': time is a timestamp or day of year, with the days wrapping around the year
+        n_jobs -- int, default 1, number of processes; if not 1 the points are clustered in
+            lat/lon tiles in parallel (-1 uses all cores), see ST_DBSCAN.parallel
+        tile_size -- float, default 1.0, size of the tiles in degrees (only used if n_jobs != 1)
+    """
+    def __init__(self, spatial_threshold, temporal_threshold, min_neighbors, temporal_resolution='month',
+                 n_jobs=1, tile_size=1.0):
+        self.spatial_threshold = spatial_threshold
+        self.temporal_threshold = temporal_threshold
+        self.min_neighbors = min_neighbors
+        self.temporal_resolution = temporal_resolution
+        self.n_jobs = n_jobs
+        self.tile_size = tile_size
+        self.labels_ = None
+
+    def fit(self, latitude, longitude, time, stats=None):
+        """
+        Cluster the points given by the arrays latitude, longitude (decimal degrees) and
+        time (month 1-12 or timestamps, see temporal_resolution).
+        If stats (ClusteringStats) is given, the counters and phase timings of the run are added to it.
+        """
+        if self.n_jobs != 1:
+            from ST_DBSCAN.parallel import parallel_ST_DBSCAN
+            self.labels_ = parallel_ST_DBSCAN(latitude, longitude, time, self.spatial_threshold,
+                                              self.temporal_threshold, self.min_neighbors,
+                                              temporal_resolution=self.temporal_resolution,
+                                              n_jobs=self.n_jobs, tile_size=self.tile_size, stats=stats)
+            if stats is not None:
+                stats.report()
+            return self
+
+        n = len(latitude)
+        start_time = perf_counter()
+        neighbor_index = NeighborIndex(latitude, longitude, time, self.spatial_threshold, self.temporal_threshold,
+                                       self.temporal_resolution)
+        query = neighbor_index.query
+        if stats is not None:
+            stats.add_time('index', perf_counter() - start_time)
+            query = stats.profiled_query(neighbor_index)
+            start_time = perf_counter()
+            query_time = stats.phase_seconds.get('neighbor_queries', 0.0)
+
+        labels = np.full(n, UNMARKED, dtype=np.int32)
+        # a point is pushed at most once while expanding a cluster, so n entries is enough
+        stack = np.empty(n, dtype=np.intp)
+        cluster_label = 0
+
+        # for each point in database
+        for index in range(n):
+            if labels[index] != UNMARKED:
+                continue
+
+            neighborhood = query(index)
+            if len(neighborhood) < self.min_neighbors:
+                labels[index] = NOISE
+                continue
+
+            # found a core point, assign a label to it and to its neighborhood
+            cluster_label = cluster_label + 1
+            labels[index] = cluster_label
+            labels[neighborhood] = cluster_label
+            stack[:len(neighborhood)] = neighborhood
+            stack_size = len(neighborhood)
+
+            # find density-reachable objects from directly density-reachable objects
+            while stack_size > 0:
+                if stats is not None and stack_size > stats.max_stack_depth:
+                    stats.max_stack_depth = stack_size
+                stack_size -= 1
+                new_neighborhood = query(stack[stack_size])
+
+                if len(new_neighborhood) >= self.min_neighbors: # current point is a new core
+                    unmarked = new_neighborhood[labels[new_neighborhood] == UNMARKED]
+                    labels[unmarked] = cluster_label
+                    stack[stack_size:stack_size + len(unmarked)] = unmarked
+                    stack_size += len(unmarked)
+
+        self.labels_ = labels
+        if stats is not None:
+            # time spent in the loop itself, without the neighbor queries
+            query_time = stats.phase_seconds.get('neighbor_queries', 0.0) - query_time
+            stats.add_time('expansion', perf_counter() - start_time - query_time)
+            stats.report()
+        return self
+
+    def fit_predict(self, latitude, longitude, time, stats=None):
+        """
+        Cluster the points and return the int32 label array
+        """
+        return self.fit(latitude, longitude, time, stats=stats).labels_
+
+
+class ClusteringStats():
+    """
+    Counters and phase timings of a clustering run, e.g.
+
+        stats = ClusteringStats()
+        df_clustered = ST_DBSCAN(df, spatial_threshold, temporal_threshold, min_neighbors, stats=stats)
+        print(stats.neighbor_queries, stats.phase_seconds)
+
+    Nothing is collected unless a ClusteringStats is passed, so a normal run is not slowed down.
+
+    Parameters
+    ----------
+        callback -- function, default None, called with the ClusteringStats at the end of each run
+
+    Attributes
+    ----------
+        neighbor_queries -- int, number of neighborhoods queried
+        candidates_scanned -- int, candidate points returned by the spatial index (or the month window)
+        distance_evaluations -- int, great circle distances computed (geopy re-checks included)
+        max_stack_depth -- int, largest size of the expansion stack
+        phase_seconds -- dict, seconds per phase, e.g. 'index', 'neighbor_queries', 'expansion'
+            (in parallel mode the worker phases are summed over the workers)
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.neighbor_queries = 0
+        self.candidates_scanned = 0
+        self.distance_evaluations = 0
+        self.max_stack_depth = 0
+        self.phase_seconds = {}
+
+    def add_time(self, phase, seconds):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """
+        Context manager adding the time spent in the block to 'phase'
+        """
+        start_time = perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(phase, perf_counter() - start_time)
+
+    def profiled_query(self, neighbor_index):
+        """
+        Return neighbor_index.query counting into these stats, timed as the phase 'neighbor_queries'
+        """
+        def query(position):
+            start_time = perf_counter()
+            neighborhood = neighbor_index.query(position, stats=self)
+            self.add_time('neighbor_queries', perf_counter() - start_time)
+            return neighborhood
+        return query
+
+    def merge(self, other):
+        """
+        Add the counters and timings of another ClusteringStats (e.g. of a worker)
+        """
+        self.neighbor_queries += other.neighbor_queries
+        self.candidates_scanned += other.candidates_scanned
+        self.distance_evaluations += other.distance_evaluations
+        self.max_stack_depth = max(self.max_stack_depth, other.max_stack_depth)
+        for phase, seconds in other.phase_seconds.items():
+            self.add_time(phase, seconds)
+        return self
+
+    def report(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        return {'neighbor_queries': self.neighbor_queries,
+                'candidates_scanned': self.candidates_scanned,
+                'distance_evaluations': self.distance_evaluations,
+                'max_stack_depth': self.max_stack_depth,
+                'phase_seconds': dict(self.phase_seconds)}
+
+    def __repr__(self):
+        return 'ClusteringStats({})'.format(self.as_dict())
+
+
+def labels_from_core_graph(core, component, border_points, border_cores):
+    """
+    Compute the labels ST_DBSCAN would give, from the core points and their
+    density-connected components alone. Used to merge partial results (e.g. tiles)
+    without running the sequential expansion.
+
+    The sequential algorithm labels as follows:
+        - every component of core points is one cluster, its seed is the first core
+          point in the data and clusters are numbered in the order of their seeds
+        - a non-core point next to one or more seeds gets the label of the last of
+          these seeds (all neighbors of a seed are relabelled when the cluster starts)
+        - otherwise it gets the first cluster that has a core point next to it, but
+          only if that cluster was started before the point itself was visited,
+          else it is (and stays) noise
+
+    Parameters
+    ----------
+        core -- bool array (n,), True for core points
+        component -- int array (n,), component id of each core point (ids are arbitrary,
+            entries of non-core points are ignored)
+        border_points, border_cores -- int arrays, pairs (non-core point, core neighbor)
+
+    Returns
+    -------
+        labels -- int32 array (n,)
+    """
+    n = len(core)
+    labels = np.full(n, NOISE, dtype=np.int32)
+
+    core_points = np.flatnonzero(core)
+    if len(core_points) == 0:
+        return labels
+
+    # seed (first core point) of each component and cluster numbers in seed order
+    components, component_codes = np.unique(np.asarray(component)[core_points], return_inverse=True)
+    seeds = np.full(len(components), n, dtype=np.intp)
+    np.minimum.at(seeds, component_codes, core_points)
+    seed_order = np.argsort(seeds)
+    cluster_seeds = seeds[seed_order]
+    cluster_numbers = np.empty(len(components), dtype=np.int32)
+    cluster_numbers[seed_order] = np.arange(1, len(components) + 1, dtype=np.int32)
+    labels[core_points] = cluster_numbers[component_codes]
+
+    border_points = np.asarray(border_points, dtype=np.intp)
+    border_cores = np.asarray(border_cores, dtype=np.intp)
+    if len(border_points) == 0:
+        return labels
+
+    neighbor_clusters = labels[border_cores]
+
+    # last seed next to the point
+    is_seed = cluster_seeds[neighbor_clusters - 1] == border_cores
+    last_seed_cluster = np.zeros(n, dtype=np.int32)
+    np.maximum.at(last_seed_cluster, border_points[is_seed], neighbor_clusters[is_seed])
+
+    # first cluster next to the point, if started before the point was visited
+    first_cluster = np.full(n, len(components) + 1, dtype=np.int32)
+    np.minimum.at(first_cluster, border_points, neighbor_clusters)
+    reached = first_cluster <= len(components)
+    reached[reached] = cluster_seeds[first_cluster[reached] - 1] < np.flatnonzero(reached)
+
+    labels[reached] = first_cluster[reached]
+    labels[last_seed_cluster > 0] = last_seed_cluster[last_seed_cluster > 0]
+
+    return labels
+
 def get_relevant_months(date,timedelta):
 
     """
@@ -107,23 +354,309 @@ def get_relevant_months(date,timedelta):
     # might add sorting here
     return months
 
-def retrieve_neighbors(index_center, df, spatial_threshold, temporal_threshold):
-    neigborhood = []
 
-    center_point = df.loc[index_center]
+class TemporalIndex():
+    """
+    Precomputed temporal index, replaces filtering the whole month column for every query.
 
-    # filter by time 
-    #min_time = center_point['month'] - timedelta(days = temporal_threshold)
-    #max_time = center_point['month'] + timedelta(days = temporal_threshold)
-    
-    months = get_relevant_months(center_point['month'],temporal_threshold)
-    df = df[np.isin(df['month'],months)]
+    resolution 'month' (time is the month 1-12, temporal_threshold in months):
+        the row positions are bucketed per month, the window of a month (wrapping around
+        the year as in get_relevant_months) is a concatenation of the prebuilt buckets,
+        cached per month.
+    resolution 'day' (time is datetime64, temporal_threshold in days):
+        the row positions are sorted on time and the window [t - threshold, t + threshold]
+        is found by binary search, for all points at once when the index is built.
+    resolution 'dayofyear' (time is datetime64 or the day of year 1-366, temporal_threshold
+    in days, wrapping around the year):
+        the same on the day of year (see day_of_year, a day of year number 366 is taken as
+        day 1), searched in the sorted days repeated for the years before and after.
+    Points without a time (NaT) have an empty window, so they are noise as points without a month.
+    """
+    DAYS_IN_YEAR = 365
+
+    def __init__(self, time, temporal_threshold, resolution='month'):
+        if resolution not in ['month', 'day', 'dayofyear']:
+            raise ValueError("Unknown temporal resolution '{}'".format(resolution))
+        self.temporal_threshold = temporal_threshold
+        self.resolution = resolution
+        time = np.asarray(time)
+
+        if resolution == 'month':
+            # relevant[a, b] is True if month value b is within the window of month value a
+            self.values, self.codes = np.unique(time, return_inverse=True)
+            self.codes = self.codes.ravel()
+            self.relevant_table = np.zeros((len(self.values), len(self.values)), dtype=bool)
+            for code, month_value in enumerate(self.values):
+                self.relevant_table[code] = np.isin(self.values, get_relevant_months(month_value, temporal_threshold))
+
+            order = np.argsort(self.codes, kind='stable')
+            bucket_sizes = np.bincount(self.codes, minlength=len(self.values))
+            self.buckets = np.split(order, np.cumsum(bucket_sizes)[:-1])
+            self.window_sizes = self.relevant_table.astype(np.int64) @ bucket_sizes
+            self._windows = {}
+        else:
+            is_datetime = np.issubdtype(time.dtype, np.datetime64)
+            # points without a time (NaT, NaN) have NaN values, are left out of the order and have no window
+            self.missing = np.isnat(time) if is_datetime else np.isnan(time.astype('float64'))
+            if resolution == 'day':
+                # days (with fractions) since epoch
+                self.values = time.astype('datetime64[s]').astype(np.int64) / 86400.0
+            else:
+                days = day_of_year(time) if is_datetime else time.astype('float64')
+                # day of year number 366 coincides with day 1
+                self.values = ((days - 1) % self.DAYS_IN_YEAR + 1).astype('float64')
+            self.values[self.missing] = np.nan
+            present = np.flatnonzero(~self.missing)
+            self.order = present[np.argsort(self.values[present], kind='stable')]
+            self.sorted_values = self.values[self.order]
+            self.buckets = None
+
+            # the window of each point as a slice of window_order, found by binary search for all points at once
+            self.window_order = self.order
+            if resolution == 'dayofyear' and 2 * temporal_threshold + 1 >= self.DAYS_IN_YEAR:
+                # all points are within the threshold
+                self.window_start = np.where(self.missing, len(self.order), 0)
+                self.window_stop = np.full(len(time), len(self.order))
+            else:
+                window_values = self.sorted_values
+                if resolution == 'dayofyear':
+                    # the sorted days repeated for the years before and after, to wrap around
+                    self.window_order = np.concatenate([self.order] * 3)
+                    window_values = np.concatenate([self.sorted_values - self.DAYS_IN_YEAR, self.sorted_values,
+                                                    self.sorted_values + self.DAYS_IN_YEAR])
+                # NaN values (missing times) give empty windows
+                self.window_start = np.searchsorted(window_values, self.values - temporal_threshold, side='left')
+                self.window_stop = np.searchsorted(window_values, self.values + temporal_threshold, side='right')
+
+    def window(self, position):
+        """
+        Return the row positions (including 'position' itself) within the temporal threshold of 'position'
+        """
+        if self.resolution == 'month':
+            code = self.codes[position]
+            if code not in self._windows:
+                self._windows[code] = np.sort(np.concatenate(
+                    [np.zeros(0, dtype=np.intp)] + [self.buckets[bucket] for bucket in self.window_buckets(position)]))
+            return self._windows[code]
+
+        return self.window_order[self.window_start[position]:self.window_stop[position]]
+
+    def window_buckets(self, position):
+        """
+        Return the month buckets (codes) within the window of 'position' (month resolution only)
+        """
+        return np.flatnonzero(self.relevant_table[self.codes[position]])
+
+    def window_size(self, position):
+        if self.resolution == 'month':
+            return self.window_sizes[self.codes[position]]
+        return self.window_stop[position] - self.window_start[position]
+
+    def relevant(self, position, candidates):
+        """
+        Return a boolean mask, True for the candidates within the temporal threshold of 'position'
+        """
+        if self.resolution == 'month':
+            return self.relevant_table[self.codes[position], self.codes[candidates]]
+        if self.resolution == 'day':
+            return np.abs(self.values[candidates] - self.values[position]) <= self.temporal_threshold
+        difference = np.abs(self.values[candidates] - self.values[position]) % self.DAYS_IN_YEAR
+        return np.minimum(difference, self.DAYS_IN_YEAR - difference) <= self.temporal_threshold
+
+
+def day_of_year(dates):
+    """
+    Day of year (1-365) of an array of datetime64 on a calendar of 365 days, so that a date has the
+    same day in every year: in leap years the days from March 1 are moved back by one and February 29
+    is day 59.5, half way between February 28 and March 1 (float array, NaN for NaT)
+    """
+    days = np.asarray(dates).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]')
+    day = (days - years).astype(np.int64) + 1.0
+    year = years.astype(np.int64) + 1970
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    day = np.where(leap & (day == 60), 59.5, np.where(leap & (day > 60), day - 1, day))
+    return np.where(np.isnat(days), np.nan, day)
+
+def great_circle_km(lat1, lon1, lat2, lon2):
+    """
+    Vectorized version of geopy's great_circle (same formula and earth radius),
+    lat1/lon1 is the center point and lat2/lon2 may be arrays.
+    """
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+
+    delta_lng = lon2 - lon1
+    cos_delta_lng, sin_delta_lng = np.cos(delta_lng), np.sin(delta_lng)
+
+    d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lng) ** 2 +
+                           (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lng) ** 2),
+                   sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lng)
+
+    return EARTH_RADIUS * d
+
+
+class NeighborIndex():
+    """
+    K-d tree over the points as 3D unit vectors, built once per clustering run.
+
+    The spatial threshold is converted to a chord length once, so the tree returns the
+    candidates within a slightly inflated chord radius with Euclidean distances only; these
+    are filtered on time with a TemporalIndex and then on distance (see within_chord_threshold),
+    so the neighborhoods equal the ones from the brute force scan. Candidates lying on the
+    threshold (up to rounding) are re-checked with geopy itself so that ties are decided
+    exactly as before.
+
+    With month resolution there is also one tree per month; when the month window
+    of a point covers less than a quarter of the data only the trees of these months
+    are queried. With the day resolutions the time window of a point (found by binary
+    search, see TemporalIndex) is used as the candidates instead of the tree when it holds
+    fewer points than the spatial ball is estimated to (on a sample of the points).
+    """
+    # relative inflation of the tree radius, candidates are refined afterwards
+    RADIUS_TOLERANCE = 1e-6
+    # points sampled for the spatial candidates estimate, and how much larger than the estimate a
+    # time window may be to be scanned instead of querying the tree (day resolutions)
+    SAMPLE_SIZE = 1000
+    WINDOW_SCAN_FACTOR = 2
+
+    def __init__(self, latitude, longitude, time, spatial_threshold, temporal_threshold, resolution='month'):
+        self.latitude = np.asarray(latitude, dtype='float64')
+        self.longitude = np.asarray(longitude, dtype='float64')
+        self.spatial_threshold = spatial_threshold
+        self.temporal_threshold = temporal_threshold
+        self.temporal_index = TemporalIndex(time, temporal_threshold, resolution)
+
+        self.vectors = latlon_to_unit_vectors(self.latitude, self.longitude)
+        self.tree = cKDTree(self.vectors)
+        self.radius = chord_threshold(spatial_threshold * (1 + self.RADIUS_TOLERANCE), EARTH_RADIUS)
+        # squared chords, below the inner bound a candidate is a neighbor without further checks
+        self.inner_chord2 = chord_threshold(spatial_threshold * (1 - self.RADIUS_TOLERANCE), EARTH_RADIUS) ** 2
+        self.outer_chord2 = self.radius ** 2
+
+        self.bucket_trees = None
+        self.spatial_candidates = 0.0
+        if self.temporal_index.buckets is None:
+            # average number of points in the spatial ball, estimated on a sample
+            sample = self.vectors[::max(1, len(self.vectors) // self.SAMPLE_SIZE)]
+            if len(sample):
+                self.spatial_candidates = self.tree.query_ball_point(sample, self.radius, return_length=True).mean()
+        else:
+            self.bucket_trees = [(positions, cKDTree(self.vectors[positions]))
+                                 for positions in self.temporal_index.buckets]
+
+    def query(self, position, stats=None):
+        """
+        Return the (sorted) row positions of all neighbors of the point at row 'position'
+        (counting into stats, a ClusteringStats, if given)
+        """
+        center = self.vectors[position]
+        if self.bucket_trees is None and (self.temporal_index.window_size(position) <
+                                          self.WINDOW_SCAN_FACTOR * self.spatial_candidates):
+            # the time window of the day resolutions (binary search on the sorted times) holds fewer points
+            # than the spatial ball (estimated), it is tested on the chord directly (see within_chord_threshold)
+            candidates = self.temporal_index.window(position)
+            if stats is not None:
+                stats.candidates_scanned += len(candidates)
+        elif self.bucket_trees is not None and 4 * self.temporal_index.window_size(position) < len(self.latitude):
+            # query only the months in the window (none for a missing month, the point is then noise)
+            candidates = np.concatenate([np.zeros(0, dtype=np.intp)] +
+                                        [self.bucket_trees[bucket][0][
+                                             self.bucket_trees[bucket][1].query_ball_point(center, self.radius)]
+                                         for bucket in self.temporal_index.window_buckets(position)])
+            if stats is not None:
+                stats.candidates_scanned += len(candidates)
+        else:
+            candidates = np.asarray(self.tree.query_ball_point(center, self.radius), dtype=np.intp)
+            if stats is not None:
+                stats.candidates_scanned += len(candidates)
+            # filter by time
+            candidates = candidates[self.temporal_index.relevant(position, candidates)]
+        candidates = candidates[candidates != position]
+
+        if stats is not None:
+            stats.neighbor_queries += 1
+        return within_chord_threshold(self.vectors, self.latitude, self.longitude, position, candidates,
+                                      self.spatial_threshold, self.inner_chord2, self.outer_chord2, stats)
+
+
+def within_chord_threshold(vectors, latitude, longitude, position, candidates, spatial_threshold, inner_chord2,
+                           outer_chord2, stats=None):
+    """
+    Return the (sorted) candidates (row positions) within spatial_threshold (km) of the point at 'position'.
+
+    The candidates clearly within the threshold (squared chord between the unit vectors up to inner_chord2)
+    are decided on the chord length, only the ones up to outer_chord2 get the great circle distance
+    (see within_spatial_threshold), see NeighborIndex for the bounds.
+    """
+    difference = vectors[candidates] - vectors[position]
+    chords2 = np.einsum('ij,ij->i', difference, difference)
+    inside = chords2 <= inner_chord2
+    near = candidates[~inside & (chords2 <= outer_chord2)]
+    if len(near):
+        near = within_spatial_threshold(latitude, longitude, position, near, spatial_threshold, stats)
+        return np.sort(np.concatenate([candidates[inside], near]))
+    return np.sort(candidates[inside])
+
+
+def within_spatial_threshold(latitude, longitude, position, candidates, spatial_threshold, stats=None):
+    """
+    Return the candidates (row positions) within spatial_threshold (km) of the point at 'position'.
+
+    Uses the vectorized great circle distance; candidates lying on the threshold
+    (up to rounding) are re-checked with geopy itself so that ties are decided as before.
+    The distances computed are counted into stats (ClusteringStats) if given.
+    """
+    distances = great_circle_km(latitude[position], longitude[position], latitude[candidates], longitude[candidates])
+    on_threshold = np.abs(distances - spatial_threshold) <= NeighborIndex.RADIUS_TOLERANCE * spatial_threshold
+    if stats is not None:
+        stats.distance_evaluations += len(candidates) + int(on_threshold.sum())
+    for i in np.flatnonzero(on_threshold):
+        distances[i] = great_circle((latitude[position], longitude[position]),
+                                    (latitude[candidates[i]], longitude[candidates[i]])).km
+
+    return candidates[distances <= spatial_threshold]
+
+
+def retrieve_neighbors(index_center, df, spatial_threshold, temporal_threshold, neighbor_index=None,
+                       temporal_index=None, stats=None):
+    """
+    Return the index labels of all points within spatial_threshold (km) and
+    temporal_threshold (months) of the point index_center.
+
+    If neighbor_index (NeighborIndex built on df) is given, it is used instead of
+    scanning the dataframe. Otherwise the points in the month window are scanned,
+    taken from temporal_index (TemporalIndex built on df['month']) if given.
+    If stats (ClusteringStats) is given, the query is counted and timed into it.
+    """
+    if stats is not None:
+        with stats.phase('neighbor_queries'):
+            return _retrieve_neighbors(index_center, df, spatial_threshold, temporal_threshold, neighbor_index,
+                                       temporal_index, stats)
+    return _retrieve_neighbors(index_center, df, spatial_threshold, temporal_threshold, neighbor_index,
+                               temporal_index, stats)
+
+
+def _retrieve_neighbors(index_center, df, spatial_threshold, temporal_threshold, neighbor_index, temporal_index,
+                        stats):
+    position = df.index.get_loc(index_center)
+    if neighbor_index is not None:
+        return list(df.index[neighbor_index.query(position, stats)])
+
+    # filter by time
+    if temporal_index is None:
+        temporal_index = TemporalIndex(df['month'].values, temporal_threshold)
+    candidates = temporal_index.window(position)
+    candidates = candidates[candidates != position]
+    if stats is not None:
+        stats.neighbor_queries += 1
+        stats.candidates_scanned += len(candidates)
 
     # filter by distance
-    for index, point in df.iterrows():
-        if index != index_center:
-            distance = great_circle((center_point['Latitude'], center_point['Longitude']), (point['Latitude'], point['Longitude'])).km
-            if distance <= spatial_threshold:
-                neigborhood.append(index)
+    neigborhood = within_spatial_threshold(df['Latitude'].values, df['Longitude'].values, position,
+                                           np.sort(candidates), spatial_threshold, stats)
 
-    return neigborhood
\ No newline at end of file
+    return list(df.index[neigborhood])
@@ -0,0 +1,145 @@
+"""
+ST-OPTICS: reachability ordering of spatio-temporal points, from which ST-DBSCAN
+clusters can be extracted for any spatial threshold up to the maximum without
+reclustering.
+
+SOURCE:
+    Ankerst, M., Breunig, M. M., Kriegel, H.-P. and Sander, J. (1999). OPTICS: ordering
+    points to identify the clustering structure. ACM SIGMOD Record, 28(2):49 - 60.
+
+The temporal constraint and the great circle metric are the same as in ST_DBSCAN
+(see NeighborIndex), min_neighbors counts the neighbors without the point itself.
+"""
+import heapq
+import numpy as np
+
+from ST_DBSCAN.STDBSCAN import NeighborIndex, great_circle_km, labels_from_core_graph
+
+
+class STOPTICS():
+    """
+    ST-OPTICS with an estimator style API, e.g.
+
+        optics = STOPTICS(max_spatial_threshold, temporal_threshold, min_neighbors).fit(lat, lon, month)
+        labels = optics.extract_dbscan(spatial_threshold)   # fast, for any spatial_threshold <= max
+
+    The extracted labels are the ones of ST_DBSCAN with the same parameters. The clusters
+    of the core points follow from the ordering; for the border points the min_neighbors
+    nearest neighbors of each point are kept (a point that is not core has all its
+    neighbors among these), so that labels_from_core_graph gives the exact labels.
+
+    Parameters
+    ----------
+        max_spatial_threshold -- float, largest spatial threshold (km) to extract clusters for
+        temporal_threshold -- int, maximum distance in months (or days, see temporal_resolution)
+        min_neighbors -- int, minimum number of neighbors (the point itself not included) of a core point
+        temporal_resolution -- string, default 'month', see STDBSCAN
+
+    Attributes (after fit)
+    ----------
+        ordering_ -- int array, the points in cluster order
+        reachability_ -- float array, reachability distance (km) of each point (inf if not reachable)
+        core_distances_ -- float array, core distance (km) of each point (inf if not core at max_spatial_threshold)
+        nearest_neighbors_ -- int array (n, min_neighbors), nearest neighbors of each point within
+            max_spatial_threshold (-1 if there are fewer), with distances in nearest_distances_
+    """
+    def __init__(self, max_spatial_threshold, temporal_threshold, min_neighbors, temporal_resolution='month'):
+        self.max_spatial_threshold = max_spatial_threshold
+        self.temporal_threshold = temporal_threshold
+        self.min_neighbors = min_neighbors
+        self.temporal_resolution = temporal_resolution
+        self.ordering_ = None
+        self.reachability_ = None
+        self.core_distances_ = None
+        self.nearest_neighbors_ = None
+        self.nearest_distances_ = None
+
+    def fit(self, latitude, longitude, time):
+        """
+        Compute the reachability ordering of the points given by the arrays latitude,
+        longitude (decimal degrees) and time (month 1-12 or timestamps)
+        """
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        n = len(latitude)
+        neighbor_index = NeighborIndex(latitude, longitude, time, self.max_spatial_threshold,
+                                       self.temporal_threshold, self.temporal_resolution)
+
+        reachability = np.full(n, np.inf)
+        core_distances = np.full(n, np.inf)
+        processed = np.zeros(n, dtype=bool)
+        ordering = np.empty(n, dtype=np.intp)
+        n_ordered = 0
+        nearest_neighbors = np.full((n, self.min_neighbors), -1, dtype=np.intp)
+        nearest_distances = np.full((n, self.min_neighbors), np.inf)
+
+        for start in range(n):
+            if processed[start]:
+                continue
+            seeds = [(np.inf, start)]
+            while seeds:
+                _, point = heapq.heappop(seeds)
+                if processed[point]:
+                    continue
+                processed[point] = True
+                ordering[n_ordered] = point
+                n_ordered += 1
+
+                neighbors = neighbor_index.query(point)
+                distances = great_circle_km(latitude[point], longitude[point], latitude[neighbors], longitude[neighbors])
+                nearest = np.argsort(distances, kind='stable')[:self.min_neighbors]
+                nearest_neighbors[point, :len(nearest)] = neighbors[nearest]
+                nearest_distances[point, :len(nearest)] = distances[nearest]
+                if len(neighbors) < self.min_neighbors:
+                    continue
+                core_distances[point] = nearest_distances[point, -1] if self.min_neighbors > 0 else 0.0
+
+                # update the reachability of the unprocessed neighbors
+                new_reachability = np.maximum(distances, core_distances[point])
+                improved = ~processed[neighbors] & (new_reachability < reachability[neighbors])
+                for neighbor, distance in zip(neighbors[improved], new_reachability[improved]):
+                    reachability[neighbor] = distance
+                    heapq.heappush(seeds, (distance, neighbor))
+
+        self.ordering_ = ordering
+        self.reachability_ = reachability
+        self.core_distances_ = core_distances
+        self.nearest_neighbors_ = nearest_neighbors
+        self.nearest_distances_ = nearest_distances
+        return self
+
+    def extract_dbscan(self, spatial_threshold):
+        """
+        Return the ST_DBSCAN labels (int32 array, NOISE = -1) for spatial_threshold <= max_spatial_threshold
+        """
+        if self.ordering_ is None:
+            raise ValueError("STOPTICS is not fitted, call fit() first")
+        if spatial_threshold > self.max_spatial_threshold:
+            raise ValueError("spatial_threshold {} exceeds max_spatial_threshold {}".format(
+                spatial_threshold, self.max_spatial_threshold))
+
+        reachability = self.reachability_[self.ordering_]
+        core = self.core_distances_ <= spatial_threshold
+
+        # a core point not reachable within the threshold starts a new cluster, the following
+        # core points in the ordering belong to it until the next start
+        starts = (reachability > spatial_threshold) & core[self.ordering_]
+        component = np.empty(len(reachability), dtype=np.intp)
+        component[self.ordering_] = np.cumsum(starts)
+
+        # the complete neighborhoods of the non-core points are among their nearest neighbors
+        within = (self.nearest_distances_ <= spatial_threshold) & ~core[:, np.newaxis]
+        border_points = np.nonzero(within)[0]
+        border_cores = self.nearest_neighbors_[within]
+        to_core = core[border_cores]
+
+        return labels_from_core_graph(core, component, border_points[to_core], border_cores[to_core])
+
+    def fit_predict(self, latitude, longitude, time, spatial_threshold=None):
+        """
+        Compute the ordering and return the labels for spatial_threshold (default max_spatial_threshold)
+        """
+        self.fit(latitude, longitude, time)
+        if spatial_threshold is None:
+            spatial_threshold = self.max_spatial_threshold
+        return self.extract_dbscan(spatial_threshold)
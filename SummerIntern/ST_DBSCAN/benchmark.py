@@ -0,0 +1,241 @@
+"""
+Benchmark suite for the ST-DBSCAN engines.
+
+Synthetic catch sets are generated with Gaussian krill swarms in the fishing grounds of
+the CCAMLR subareas 48.1 (Antarctic Peninsula), 48.2 (South Orkney Islands) and 48.3
+(South Georgia), each fished in its own season. Every engine is timed on the same set,
+its peak memory is recorded (in a separate run, tracing slows the engines down) and its
+labels are compared with the first engine. The incremental engine gets the catches in
+monthly batches, as when appending new catches. The
+results are written as JSON so that runs can be compared across commits, e.g.
+
+    python -m ST_DBSCAN.benchmark --sizes 1000 10000 100000 --output ../data/benchmark.json
+
+(run from the SummerIntern folder).
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from ST_DBSCAN.STDBSCAN import ST_DBSCAN, STDBSCAN
+from ST_DBSCAN.STOPTICS import STOPTICS
+from ST_DBSCAN.incremental import IncrementalSTDBSCAN
+from ST_DBSCAN.neighbor_graph import NeighborGraph
+
+# fishing grounds (lat min, lat max, lon min, lon max) and season (months) of the subareas
+FISHING_GROUNDS = {
+    '48.1': {'grounds': [(-63.5, -62.0, -61.5, -57.5),   # Bransfield Strait
+                         (-61.5, -60.5, -56.5, -54.0),   # Elephant Island
+                         (-65.0, -64.0, -63.0, -61.5)],  # Gerlache Strait
+             'season': [1, 2, 3, 4, 5, 6]},
+    '48.2': {'grounds': [(-61.0, -60.0, -47.5, -44.5)],  # South Orkney Islands
+             'season': [2, 3, 4, 5, 6, 7]},
+    '48.3': {'grounds': [(-54.2, -53.4, -38.5, -35.5)],  # South Georgia
+             'season': [5, 6, 7, 8, 9]},
+}
+
+ENGINES = ['ST_DBSCAN', 'parallel', 'graph', 'optics', 'incremental']
+
+
+def synthetic_catch_data(n_points, points_per_swarm=500, noise_fraction=0.05, years=(2010, 2019), seed=0):
+    """
+    Generate a synthetic catch set with Gaussian swarms in the 48.1/48.2/48.3 fishing grounds.
+
+    Parameters
+    ----------
+        n_points -- int, number of catches
+        points_per_swarm -- int, default 500, average number of catches per swarm
+        noise_fraction -- float, default 0.05, fraction of catches spread uniformly over the grounds
+        years -- tuple of ints, default (2010, 2019), first and last fishing season
+        seed -- int, default 0, random seed
+
+    Returns
+    -------
+        df -- pandas DataFrame with columns ['Latitude', 'Longitude', 'Date', 'month',
+            'ASD', 'Total catch Krill - Mt'], one row per catch
+    """
+    rng = np.random.default_rng(seed)
+    grounds = [(area, box) for area, info in FISHING_GROUNDS.items() for box in info['grounds']]
+    n_noise = int(round(noise_fraction * n_points))
+    n_swarms = max(1, (n_points - n_noise) // points_per_swarm)
+
+    # swarms: a position in one of the grounds, a month in the season of its subarea and a size
+    swarm_ground = rng.integers(0, len(grounds), n_swarms)
+    swarm_box = np.array([grounds[ground][1] for ground in swarm_ground]).reshape(-1, 4)
+    swarm_lat = rng.uniform(swarm_box[:, 0], swarm_box[:, 1])
+    swarm_lon = rng.uniform(swarm_box[:, 2], swarm_box[:, 3])
+    swarm_month = np.array([rng.choice(FISHING_GROUNDS[grounds[ground][0]]['season']) for ground in swarm_ground])
+    swarm_spread = rng.uniform(0.03, 0.2, n_swarms)  # degrees latitude
+
+    swarm = rng.integers(0, n_swarms, n_points - n_noise)
+    latitude = swarm_lat[swarm] + rng.normal(0, 1, len(swarm)) * swarm_spread[swarm]
+    longitude = swarm_lon[swarm] + rng.normal(0, 1, len(swarm)) * swarm_spread[swarm] \
+        / np.cos(np.radians(swarm_lat[swarm]))
+    month = (swarm_month[swarm] - 1 + rng.integers(-1, 2, len(swarm))) % 12 + 1
+    area = np.array([grounds[ground][0] for ground in swarm_ground])[swarm]
+
+    # background catches
+    noise_ground = rng.integers(0, len(grounds), n_noise)
+    noise_box = np.array([grounds[ground][1] for ground in noise_ground]).reshape(-1, 4)
+    latitude = np.concatenate([latitude, rng.uniform(noise_box[:, 0], noise_box[:, 1])])
+    longitude = np.concatenate([longitude, rng.uniform(noise_box[:, 2], noise_box[:, 3])])
+    noise_area = np.array([grounds[ground][0] for ground in noise_ground], dtype=area.dtype)
+    month = np.concatenate([month, [rng.choice(FISHING_GROUNDS[a]['season']) for a in noise_area]])
+    area = np.concatenate([area, noise_area])
+
+    year = rng.integers(years[0], years[1] + 1, n_points)
+    day = rng.integers(0, 28, n_points)
+    date = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1})) + pd.to_timedelta(day, 'D')
+
+    df = pd.DataFrame({'Latitude': latitude,
+                       'Longitude': longitude,
+                       'Date': date.values,
+                       'month': month.astype(np.int64),
+                       'ASD': area,
+                       'Total catch Krill - Mt': rng.lognormal(5.0, 0.5, n_points)})
+    # catches arrive in time order
+    return df.sort_values('Date', kind='stable').reset_index(drop=True)
+
+
+def run_engine(engine, df, spatial_threshold, temporal_threshold, min_neighbors, n_jobs=-1):
+    """
+    Cluster df with one of the ENGINES and return the labels (int array)
+    """
+    latitude, longitude, month = df['Latitude'].values, df['Longitude'].values, df['month'].values
+    if engine == 'ST_DBSCAN':
+        return ST_DBSCAN(df[['Latitude', 'Longitude', 'month']].copy(), spatial_threshold, temporal_threshold,
+                         min_neighbors)['cluster'].values
+    if engine == 'parallel':
+        return STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors, n_jobs=n_jobs).fit_predict(
+            latitude, longitude, month)
+    if engine == 'graph':
+        graph = NeighborGraph.build(latitude, longitude, month, spatial_threshold, temporal_threshold)
+        return graph.labels(spatial_threshold, temporal_threshold, min_neighbors)
+    if engine == 'optics':
+        return STOPTICS(spatial_threshold, temporal_threshold, min_neighbors).fit_predict(latitude, longitude, month)
+    if engine == 'incremental':
+        clusterer = IncrementalSTDBSCAN(spatial_threshold, temporal_threshold, min_neighbors)
+        batch = df['Date'].values.astype('datetime64[M]')
+        for start, stop in zip(*_batch_bounds(batch)):
+            clusterer.partial_fit(latitude[start:stop], longitude[start:stop], month[start:stop])
+        return clusterer.labels_
+    raise ValueError("Unknown engine '{}', expected one of {}".format(engine, ENGINES))
+
+
+def _batch_bounds(batch):
+    """
+    Start and stop of the runs of equal values in batch (sorted)
+    """
+    starts = np.concatenate([[0], np.flatnonzero(batch[1:] != batch[:-1]) + 1]) if len(batch) else np.zeros(0, int)
+    return starts, np.append(starts[1:], len(batch))
+
+
+def benchmark(sizes, engines=ENGINES, spatial_threshold=5, temporal_threshold=1, min_neighbors=5,
+              n_jobs=-1, repeat=1, seed=0):
+    """
+    Time the engines on synthetic catch sets of the given sizes.
+
+    The peak memory is measured with tracemalloc, i.e. the memory allocated by Python and
+    numpy in the main process (the workers of the parallel engine are not included), in an
+    extra run after the timed runs, since tracing slows the Python loops down several times.
+
+    Parameters
+    ----------
+        sizes -- list of ints, number of catches of the synthetic sets
+        engines -- list of strings, default ENGINES, the first engine is the reference for the labels
+        spatial_threshold, temporal_threshold, min_neighbors -- ST-DBSCAN parameters (km, months, count)
+        n_jobs -- int, default -1, number of processes of the parallel engine
+        repeat -- int, default 1, number of runs per engine, the fastest is reported
+        seed -- int, default 0, random seed of the synthetic sets
+
+    Returns
+    -------
+        results -- dict with the parameters, the environment and one record per size and engine
+    """
+    records = []
+    for n_points in sizes:
+        df = synthetic_catch_data(n_points, seed=seed)
+        reference = None
+        for engine in engines:
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                labels = np.asarray(run_engine(engine, df, spatial_threshold, temporal_threshold, min_neighbors,
+                                               n_jobs=n_jobs))
+                seconds.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            run_engine(engine, df, spatial_threshold, temporal_threshold, min_neighbors, n_jobs=n_jobs)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            if reference is None:
+                reference = labels
+            records.append({'n_points': n_points,
+                            'engine': engine,
+                            'seconds': min(seconds),
+                            'peak_memory_mb': peak / 1024 ** 2,
+                            'n_clusters': int(len(np.unique(labels[labels >= 0]))),
+                            'noise_fraction': float(np.mean(labels < 0)) if len(labels) else 0.0,
+                            'labels_agree': bool(np.array_equal(labels, reference)),
+                            'n_disagreeing': int(np.sum(labels != reference))})
+
+    return {'parameters': {'spatial_threshold': spatial_threshold,
+                           'temporal_threshold': temporal_threshold,
+                           'min_neighbors': min_neighbors,
+                           'n_jobs': n_jobs,
+                           'repeat': repeat,
+                           'seed': seed},
+            'environment': environment(),
+            'results': records}
+
+
+def environment():
+    """
+    Commit, date and versions, to tell runs apart
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ST-DBSCAN engines on synthetic catch data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='number of catches, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--engines', nargs='+', default=ENGINES, choices=ENGINES)
+    parser.add_argument('--spatial-threshold', type=float, default=5)
+    parser.add_argument('--temporal-threshold', type=int, default=1)
+    parser.add_argument('--min-neighbors', type=int, default=5)
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes, args.engines, args.spatial_threshold, args.temporal_threshold,
+                        args.min_neighbors, n_jobs=args.n_jobs, repeat=args.repeat, seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for record in results['results']:
+        print('{n_points:>9} {engine:<12} {seconds:10.3f} s {peak_memory_mb:10.1f} MB  agree: {labels_agree}'.format(
+            **record))
+
+
+if __name__ == '__main__':
+    main()
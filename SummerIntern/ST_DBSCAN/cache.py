@@ -0,0 +1,153 @@
+"""
+Persistent on-disk cache of ST-DBSCAN neighbor graphs and labels.
+
+Each entry is a directory with one .npy file per array, loaded memory-mapped so that a
+cache hit costs milliseconds. The cache key is a content hash of the Latitude, Longitude
+and month (or Date) arrays together with the thresholds. The total size of the cache is
+limited, the least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from ST_DBSCAN.STDBSCAN import STDBSCAN
+from ST_DBSCAN.neighbor_graph import NeighborGraph
+
+
+class ClusteringCache():
+    """
+    On-disk cache for ST-DBSCAN results, e.g.
+
+        cache = ClusteringCache('../data/cache/st_dbscan', max_size_mb=2048)
+        df_clustered = STDBSCAN.ST_DBSCAN(df, spatial_threshold, temporal_threshold, min_neighbors, cache=cache)
+
+    Parameters
+    ----------
+        cache_dir -- string, default '../data/cache/st_dbscan', directory of the cache (created if missing)
+        max_size_mb -- float, default 2048, size limit of the cache in MB
+    """
+    GRAPH_ARRAYS = ['indptr', 'indices', 'distances', 'month_distances']
+
+    def __init__(self, cache_dir='../data/cache/st_dbscan', max_size_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def neighbor_graph(self, latitude, longitude, month, spatial_threshold, temporal_threshold):
+        """
+        Return the NeighborGraph of the points, from the cache or computed (and stored)
+        """
+        key = self.key('graph', latitude, longitude, month, spatial_threshold, temporal_threshold)
+        arrays = self._load(key, self.GRAPH_ARRAYS)
+        if arrays is None:
+            graph = NeighborGraph.build(latitude, longitude, month, spatial_threshold, temporal_threshold)
+            self._store(key, {name: getattr(graph, name) for name in self.GRAPH_ARRAYS})
+            return graph
+        return NeighborGraph(*arrays, spatial_threshold=spatial_threshold, temporal_threshold=temporal_threshold)
+
+    def labels(self, latitude, longitude, time, spatial_threshold, temporal_threshold, min_neighbors,
+               temporal_resolution='month', **kwargs):
+        """
+        Return the ST_DBSCAN labels of the points, from the cache or computed (and stored).
+        Keyword arguments are passed on to STDBSCAN (e.g. n_jobs) on a cache miss.
+        """
+        key = self.key('labels_' + temporal_resolution, latitude, longitude, time,
+                       spatial_threshold, temporal_threshold, min_neighbors)
+        arrays = self._load(key, ['labels'])
+        if arrays is None:
+            graph_arrays = None
+            if temporal_resolution == 'month':  # neighbor graphs are only computed on months
+                graph_key = self.key('graph', latitude, longitude, time, spatial_threshold, temporal_threshold)
+                graph_arrays = self._load(graph_key, self.GRAPH_ARRAYS)
+            if graph_arrays is not None:
+                graph = NeighborGraph(*graph_arrays, spatial_threshold=spatial_threshold,
+                                      temporal_threshold=temporal_threshold)
+                labels = graph.labels(spatial_threshold, temporal_threshold, min_neighbors)
+            else:
+                engine = STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors,
+                                  temporal_resolution=temporal_resolution, **kwargs)
+                labels = engine.fit_predict(latitude, longitude, time)
+            self._store(key, {'labels': labels})
+            return labels
+        return arrays[0]
+
+    @staticmethod
+    def key(kind, latitude, longitude, time, *parameters):
+        """
+        Cache key from a content hash of the arrays and the parameters
+        """
+        sha = hashlib.sha1()
+        time = np.asarray(time)
+        if np.issubdtype(time.dtype, np.datetime64):
+            time = time.astype('datetime64[ns]').view('int64')
+        for array, dtype in [(latitude, 'float64'), (longitude, 'float64'), (time, 'int64')]:
+            array = np.ascontiguousarray(array, dtype=dtype)
+            sha.update(str(array.shape).encode())
+            sha.update(array.tobytes())
+        sha.update(repr([kind] + [float(parameter) for parameter in parameters]).encode())
+        return kind + '_' + sha.hexdigest()
+
+    def size_mb(self):
+        return sum(size for _, _, size in self._entries()) / 1024 ** 2
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _load(self, key, names):
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names]
+        except (OSError, ValueError):  # incomplete or evicted by another process
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def _store(self, key, arrays):
+        path = os.path.join(self.cache_dir, key)
+        temp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, name + '.npy'), np.asarray(array))
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as f:
+            json.dump({'key': key, 'created': time.time()}, f)
+        try:
+            os.rename(temp_path, path)
+        except OSError:  # stored by another process in the meantime
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._evict(keep=path)
+
+    def _entries(self):
+        """
+        List of (path, last used, size in bytes) of all entries
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.tmp_') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((path, os.stat(path).st_mtime, size))
+            except OSError:
+                continue
+        return entries
+
+    def _evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache is within max_size_mb
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total_size <= self.max_size_mb * 1024 ** 2:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,181 @@
+"""
+Incremental ST-DBSCAN, for appending new (daily) catches without reclustering the history.
+
+The clusterer keeps its state between batches:
+    - the spatial index, k-d trees over the unit vectors of batches of points (see NeighborIndex),
+      merged so that there are O(log n) trees
+    - the number of neighbors of each point and the core flags
+    - the components of the core points in a union-find structure
+    - the neighbors of the non-core points (less than min_neighbors each)
+    - the labels
+
+A new batch only queries the index for the new points. Old points next to them get
+their neighbor counts updated; points that become core are joined with their core
+neighbors, which merges clusters and promotes noise to border points where needed.
+The labels are the ones ST_DBSCAN gives on all points in arrival order, so cluster
+numbers follow the order in which the clusters were started (when two clusters merge,
+the numbers of later clusters shift down by one).
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from geopy.distance import EARTH_RADIUS
+
+from ST_DBSCAN.STDBSCAN import (NeighborIndex, get_relevant_months, labels_from_core_graph,
+                                within_chord_threshold)
+from ST_DBSCAN.parallel import UnionFind
+from utils.geofunctions_utils import latlon_to_unit_vectors, chord_threshold
+
+
+class IncrementalSTDBSCAN():
+    """
+    ST-DBSCAN which can be updated with new batches of points, e.g.
+
+        clusterer = IncrementalSTDBSCAN(spatial_threshold, temporal_threshold, min_neighbors)
+        clusterer.partial_fit(lat_history, lon_history, month_history)
+        labels = clusterer.partial_fit(lat_today, lon_today, month_today).labels_
+
+    Parameters
+    ----------
+        spatial_threshold -- float, maximum great circle distance (km)
+        temporal_threshold -- int, maximum distance in months (wrapping around the year)
+        min_neighbors -- int, minimum number of neighbors (the point itself not included) of a core point
+    """
+    def __init__(self, spatial_threshold, temporal_threshold, min_neighbors):
+        self.spatial_threshold = spatial_threshold
+        self.temporal_threshold = temporal_threshold
+        self.min_neighbors = min_neighbors
+        # chord radius of the trees and squared chord bounds of the refinement, as in NeighborIndex
+        self._radius = chord_threshold(spatial_threshold * (1 + NeighborIndex.RADIUS_TOLERANCE), EARTH_RADIUS)
+        self._inner_chord2 = chord_threshold(spatial_threshold * (1 - NeighborIndex.RADIUS_TOLERANCE),
+                                             EARTH_RADIUS) ** 2
+        self._outer_chord2 = self._radius ** 2
+        self._months_allowed = {}
+        self._reset()
+
+    def _reset(self):
+        self.latitude = np.zeros(0, dtype='float64')
+        self.longitude = np.zeros(0, dtype='float64')
+        self.vectors = np.zeros((0, 3), dtype='float64')
+        self.month = np.zeros(0, dtype='float64')
+        self._month_index = np.zeros(0, dtype=np.intp)  # 0 for a missing month
+        self.neighbor_count = np.zeros(0, dtype=np.int32)
+        self.core = np.zeros(0, dtype=bool)
+        self.union_find = UnionFind(0)
+        self.labels_ = np.zeros(0, dtype=np.int32)
+
+        # pairs (non-core point, neighbor), the complete neighborhoods of the non-core points
+        self._border_points = np.zeros(0, dtype=np.intp)
+        self._border_neighbors = np.zeros(0, dtype=np.intp)
+
+        # spatial index, list of (start, end, tree) over contiguous ranges of points
+        self._segments = []
+
+    @property
+    def n_points(self):
+        return len(self.latitude)
+
+    def partial_fit(self, latitude, longitude, month):
+        """
+        Add a batch of points (arrays latitude, longitude in decimal degrees and month 1-12)
+        and update the clusters they touch. Points without a month (NaN) are noise, as in ST_DBSCAN.
+        """
+        start = self.n_points
+        new_points = np.arange(start, start + len(latitude))
+        self.latitude = np.concatenate([self.latitude, np.asarray(latitude, dtype='float64')])
+        self.longitude = np.concatenate([self.longitude, np.asarray(longitude, dtype='float64')])
+        month = np.asarray(month, dtype='float64')
+        self.month = np.concatenate([self.month, month])
+        self._month_index = np.concatenate([self._month_index, np.nan_to_num(month, nan=0).astype(np.intp)])
+        self.vectors = np.concatenate([self.vectors, latlon_to_unit_vectors(self.latitude[start:],
+                                                                            self.longitude[start:])])
+        self._add_segment(start, self.n_points)
+
+        neighborhoods = self._query(new_points)
+        sizes = np.array([len(neighborhood) for neighborhood in neighborhoods], dtype=np.intp)
+        sources = np.repeat(new_points, sizes)
+        targets = np.concatenate(neighborhoods + [np.zeros(0, dtype=np.intp)])
+
+        # neighbor counts, the new points are neighbors of old points as well
+        was_core = np.concatenate([self.core, np.zeros(len(new_points), dtype=bool)])
+        old_targets = targets[targets < start]
+        self.neighbor_count = np.concatenate([self.neighbor_count, sizes.astype(np.int32)])
+        self.neighbor_count += np.bincount(old_targets, minlength=self.n_points).astype(np.int32)
+        self.core = self.neighbor_count >= self.min_neighbors
+        self.union_find.add(len(new_points))
+
+        # store the neighborhoods of non-core points, old and new
+        self._border_points = np.concatenate([self._border_points, old_targets, sources])
+        self._border_neighbors = np.concatenate([self._border_neighbors, sources[targets < start], targets])
+
+        # join points that became core with their core neighbors (their neighborhoods are stored)
+        new_core = self.core & ~was_core
+        joining = new_core[self._border_points] & self.core[self._border_neighbors]
+        self.union_find.union_pairs(self._border_points[joining], self._border_neighbors[joining])
+
+        keep = ~self.core[self._border_points]
+        self._border_points = self._border_points[keep]
+        self._border_neighbors = self._border_neighbors[keep]
+
+        self._update_labels()
+        return self
+
+    def fit(self, latitude, longitude, month):
+        """
+        Reset the state and cluster the points
+        """
+        self._reset()
+        return self.partial_fit(latitude, longitude, month)
+
+    def fit_predict(self, latitude, longitude, month):
+        return self.fit(latitude, longitude, month).labels_
+
+    def _update_labels(self):
+        component = self.union_find.find_all(np.arange(self.n_points))
+        border_to_core = self.core[self._border_neighbors]
+        self.labels_ = labels_from_core_graph(self.core, component, self._border_points[border_to_core],
+                                              self._border_neighbors[border_to_core])
+
+    def _add_segment(self, start, end):
+        """
+        Add a tree for the points start:end, merging the last trees while they are
+        not larger than the new one (so there are O(log n) trees)
+        """
+        while self._segments and (self._segments[-1][1] - self._segments[-1][0]) <= end - start:
+            start = self._segments.pop()[0]
+        self._segments.append((start, end, cKDTree(self.vectors[start:end])))
+
+    def _query(self, positions):
+        """
+        Return the (sorted) neighborhoods of the points at 'positions', as a list of arrays
+        """
+        candidates = [[] for _ in positions]
+        for start, _, tree in self._segments:
+            for i, segment_candidates in enumerate(tree.query_ball_point(self.vectors[positions], self._radius)):
+                candidates[i].append(np.asarray(segment_candidates, dtype=np.intp) + start)
+
+        neighborhoods = []
+        for position, point_candidates in zip(positions, candidates):
+            if np.isnan(self.month[position]):
+                neighborhoods.append(np.zeros(0, dtype=np.intp))
+                continue
+            point_candidates = np.concatenate(point_candidates)
+            point_candidates = point_candidates[point_candidates != position]
+            # filter by time
+            relevant_months = self._relevant_months(self._month_index[position])
+            point_candidates = point_candidates[relevant_months[self._month_index[point_candidates]]]
+            # filter by distance
+            neighborhoods.append(within_chord_threshold(self.vectors, self.latitude, self.longitude, position,
+                                                        point_candidates, self.spatial_threshold,
+                                                        self._inner_chord2, self._outer_chord2))
+        return neighborhoods
+
+    def _relevant_months(self, month):
+        """
+        Lookup table over the months 0-12, True for the months within the temporal threshold
+        (0, a missing month, is within the threshold of no month)
+        """
+        if month not in self._months_allowed:
+            months = get_relevant_months(month, self.temporal_threshold)
+            self._months_allowed[month] = np.isin(np.arange(13), months)
+            self._months_allowed[month][0] = False
+        return self._months_allowed[month]
@@ -0,0 +1,93 @@
+"""
+Spatio-temporal neighbor graph for ST-DBSCAN, stored as CSR with distances.
+
+The graph is computed once at the largest thresholds of interest. The clusters for any
+smaller spatial/temporal threshold and any min_neighbors can then be derived from it
+without computing a single distance, see NeighborGraph.labels.
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ST_DBSCAN.STDBSCAN import NeighborIndex, get_relevant_months, great_circle_km, labels_from_core_graph
+
+
+class NeighborGraph():
+    """
+    CSR neighbor graph: the neighbors of point i are indices[indptr[i]:indptr[i + 1]], with the
+    great circle distances (km) in 'distances' and the distances in months in 'month_distances'.
+
+    Create with NeighborGraph.build(latitude, longitude, month, spatial_threshold, temporal_threshold).
+    """
+    def __init__(self, indptr, indices, distances, month_distances, spatial_threshold, temporal_threshold):
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+        self.month_distances = month_distances
+        self.spatial_threshold = spatial_threshold
+        self.temporal_threshold = temporal_threshold
+
+    @property
+    def n_points(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def build(cls, latitude, longitude, month, spatial_threshold, temporal_threshold):
+        """
+        Compute the neighbor graph of the points at the (largest) thresholds
+        """
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        neighbor_index = NeighborIndex(latitude, longitude, month, spatial_threshold, temporal_threshold)
+
+        neighborhoods = [neighbor_index.query(position) for position in range(len(latitude))]
+        sizes = np.array([len(neighborhood) for neighborhood in neighborhoods], dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(sizes)])
+        indices = np.concatenate(neighborhoods + [np.zeros(0, dtype=np.intp)]).astype(np.int32)
+
+        sources = np.repeat(np.arange(len(latitude)), sizes)
+        distances = great_circle_km(latitude[sources], longitude[sources], latitude[indices], longitude[indices])
+
+        month_table = month_distance_table(neighbor_index.temporal_index.values, temporal_threshold)
+        codes = neighbor_index.temporal_index.codes
+        month_distances = month_table[codes[sources], codes[indices]]
+
+        return cls(indptr, indices, distances, month_distances, spatial_threshold, temporal_threshold)
+
+    def labels(self, spatial_threshold, temporal_threshold, min_neighbors):
+        """
+        Return the ST_DBSCAN labels (int32 array) for thresholds up to the ones the graph was built with
+        """
+        if spatial_threshold > self.spatial_threshold or temporal_threshold > self.temporal_threshold:
+            raise ValueError("Thresholds ({}, {}) exceed the ones of the neighbor graph ({}, {})".format(
+                spatial_threshold, temporal_threshold, self.spatial_threshold, self.temporal_threshold))
+
+        n = self.n_points
+        sources = np.repeat(np.arange(n), np.diff(self.indptr))
+        within = (self.distances <= spatial_threshold) & (self.month_distances <= temporal_threshold)
+        sources, targets = sources[within], self.indices[within]
+
+        core = np.bincount(sources, minlength=n) >= min_neighbors
+
+        # components of the core points
+        core_edges = core[sources] & core[targets]
+        graph = coo_matrix((np.ones(core_edges.sum(), dtype=np.int8), (sources[core_edges], targets[core_edges])),
+                           shape=(n, n))
+        _, component = connected_components(graph, directed=False)
+
+        border = ~core[sources] & core[targets]
+        return labels_from_core_graph(core, component, sources[border], targets[border])
+
+
+def month_distance_table(month_values, temporal_threshold):
+    """
+    Distance in months between all pairs of month values, i.e. the smallest temporal
+    threshold for which get_relevant_months includes the other month.
+    Pairs further apart than temporal_threshold get temporal_threshold + 1.
+    """
+    table = np.full((len(month_values), len(month_values)), temporal_threshold + 1, dtype=np.int16)
+    for threshold in range(temporal_threshold, -1, -1):
+        for code, month_value in enumerate(month_values):
+            relevant = np.isin(month_values, get_relevant_months(month_value, threshold))
+            table[code, relevant] = threshold
+    return table
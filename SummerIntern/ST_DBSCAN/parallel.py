@@ -0,0 +1,232 @@
+"""
+Parallel ST-DBSCAN over lat/lon tiles.
+
+The points are partitioned into tiles of tile_size degrees. Each tile is clustered
+in a process pool together with a halo of spatial_threshold around it, so that all
+neighbors of the points owned by the tile are available locally. Each tile returns
+the core flags and core components of its own points together with the links into
+its halo; the components are merged across tile borders with a union-find pass and
+the final labels are derived with labels_from_core_graph, which gives the same
+labels as the serial algorithm.
+"""
+import os
+import numpy as np
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from geopy.distance import EARTH_RADIUS
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ST_DBSCAN.STDBSCAN import ClusteringStats, NeighborIndex, labels_from_core_graph
+
+
+def parallel_ST_DBSCAN(latitude, longitude, time, spatial_threshold, temporal_threshold, min_neighbors,
+                       temporal_resolution='month', n_jobs=-1, tile_size=1.0, stats=None):
+    """
+    Cluster points with ST-DBSCAN in parallel over lat/lon tiles.
+
+    Parameters
+    ----------
+        latitude, longitude -- arrays, position in decimal degrees
+        time -- array, month (1-12) or timestamp of each point, see temporal_resolution
+        spatial_threshold -- float, maximum great circle distance (km)
+        temporal_threshold -- int, maximum distance in months (or days)
+        min_neighbors -- int, minimum number of neighbors of a core point
+        temporal_resolution -- string, default 'month', see STDBSCAN
+        n_jobs -- int, default -1, number of processes (-1 uses all cores)
+        tile_size -- float, default 1.0, size of the tiles in degrees
+        stats -- ClusteringStats, default None, collects the counters of the workers and the phase timings
+
+    Returns
+    -------
+        labels -- int32 array, same labels as STDBSCAN(...).fit_predict(latitude, longitude, time)
+    """
+    latitude = np.asarray(latitude, dtype='float64')
+    longitude = np.asarray(longitude, dtype='float64')
+    time = np.asarray(time)
+    n = len(latitude)
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+
+    if stats is not None:
+        start_time = perf_counter()
+    tasks = [(ids, owned, latitude[ids], longitude[ids], time[ids],
+              spatial_threshold, temporal_threshold, temporal_resolution, min_neighbors, stats is not None)
+             for ids, owned in make_tiles(latitude, longitude, spatial_threshold, tile_size)]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        if stats is not None:
+            stats.add_time('tiles', perf_counter() - start_time)
+            start_time = perf_counter()
+        results = list(executor.map(_cluster_tile, tasks))
+
+    if stats is not None:
+        stats.add_time('cluster_tiles', perf_counter() - start_time)
+        start_time = perf_counter()
+        for result in results:
+            stats.merge(result[5])
+
+    core = np.zeros(n, dtype=bool)
+    component = np.full(n, -1, dtype=np.intp)
+    for owned_ids, owned_core, owned_component, _, _, _ in results:
+        core[owned_ids] = owned_core
+        component[owned_ids] = owned_component
+
+    # merge components across tile borders
+    union_find = UnionFind(n)
+    for _, _, _, halo_links, _, _ in results:
+        halo_links = halo_links[:, core[halo_links[1]]]
+        union_find.union_pairs(component[halo_links[0]], component[halo_links[1]])
+    component[core] = union_find.find_all(component[core])
+
+    border_links = np.concatenate([result[4] for result in results] + [np.zeros((2, 0), dtype=np.intp)], axis=1)
+    border_links = border_links[:, core[border_links[1]]]
+
+    labels = labels_from_core_graph(core, component, border_links[0], border_links[1])
+    if stats is not None:
+        stats.add_time('merge', perf_counter() - start_time)
+    return labels
+
+
+def make_tiles(latitude, longitude, spatial_threshold, tile_size):
+    """
+    Partition the points in lat/lon tiles with a halo of spatial_threshold (km).
+
+    Returns a list of (ids, owned) per non-empty tile, where ids are the (sorted) positions
+    of the points in the tile and its halo and owned is True for points in the tile itself.
+    """
+    # halo as angle, slightly inflated since the exact test is done afterwards
+    halo_angle = spatial_threshold / EARTH_RADIUS * (1 + NeighborIndex.RADIUS_TOLERANCE)
+    halo = np.degrees(halo_angle)
+
+    tile_row = np.floor(latitude / tile_size).astype(np.int64)
+    tile_col = np.floor((longitude % 360) / tile_size).astype(np.int64)
+    tile_keys, tile_codes = np.unique(np.column_stack([tile_row, tile_col]), axis=0, return_inverse=True)
+    tile_codes = tile_codes.ravel()
+
+    lat_order = np.argsort(latitude)
+    lat_sorted = latitude[lat_order]
+
+    tiles = []
+    for code, (row, col) in enumerate(tile_keys):
+        lat_min, lat_max = row * tile_size - halo, (row + 1) * tile_size + halo
+        band = lat_order[np.searchsorted(lat_sorted, lat_min):np.searchsorted(lat_sorted, lat_max, side='right')]
+
+        # halo in longitude grows towards the poles, take the whole band close to the poles
+        max_abs_lat = max(abs(lat_min), abs(lat_max))
+        if max_abs_lat >= 90 - halo:
+            in_tile = band
+        else:
+            lon_halo = np.degrees(np.arcsin(min(1.0, np.sin(halo_angle) / np.cos(np.radians(max_abs_lat)))))
+            offset = (longitude[band] - col * tile_size) % 360  # offset from west edge of tile
+            in_tile = band[(offset <= tile_size + lon_halo) | (offset >= 360 - lon_halo)]
+
+        ids = np.sort(in_tile)
+        tiles.append((ids, tile_codes[ids] == code))
+    return tiles
+
+
+def _cluster_tile(task):
+    """
+    Cluster a single tile (run in a worker process).
+
+    Returns for the owned points: global ids, core flags and a component id per core point
+    (the global id of one of its members), together with the links needed for the merge:
+    halo_links (2, k) from owned core points to halo points, and border_links (2, m) from
+    owned non-core points to all their neighbors, and the ClusteringStats of the tile (None
+    if not profiled).
+    """
+    ids, owned, latitude, longitude, time, spatial_threshold, temporal_threshold, temporal_resolution, \
+        min_neighbors, profile = task
+    stats = ClusteringStats() if profile else None
+    start_time = perf_counter()
+    neighbor_index = NeighborIndex(latitude, longitude, time, spatial_threshold, temporal_threshold,
+                                   temporal_resolution)
+    query = neighbor_index.query
+    if stats is not None:
+        stats.add_time('index', perf_counter() - start_time)
+        query = stats.profiled_query(neighbor_index)
+
+    owned_positions = np.flatnonzero(owned)
+    neighborhoods = [query(position) for position in owned_positions]
+    sizes = np.array([len(neighborhood) for neighborhood in neighborhoods], dtype=np.intp)
+    sources = np.repeat(owned_positions, sizes)
+    targets = np.concatenate(neighborhoods) if neighborhoods else np.zeros(0, dtype=np.intp)
+
+    local_core = np.zeros(len(ids), dtype=bool)
+    local_core[owned_positions] = sizes >= min_neighbors
+    from_core = local_core[sources]
+
+    # components of owned core points connected within the tile
+    inner = from_core & local_core[targets]
+    graph = coo_matrix((np.ones(inner.sum(), dtype=np.int8), (sources[inner], targets[inner])),
+                       shape=(len(ids), len(ids)))
+    _, local_component = connected_components(graph, directed=False)
+    representative = np.full(len(ids), len(ids), dtype=np.intp)
+    np.minimum.at(representative, local_component, np.arange(len(ids)))
+    owned_component = np.where(local_core[owned_positions],
+                               ids[representative[local_component[owned_positions]]], -1)
+
+    halo = from_core & ~owned[targets]
+    halo_links = np.vstack([ids[sources[halo]], ids[targets[halo]]])
+    border_links = np.vstack([ids[sources[~from_core]], ids[targets[~from_core]]])
+
+    return ids[owned_positions], local_core[owned_positions], owned_component, halo_links, border_links, stats
+
+
+class UnionFind():
+    """
+    Union-find (disjoint set) over the integers 0..n-1. The root of each set is its
+    smallest element.
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.intp)
+
+    def add(self, count):
+        """
+        Add 'count' new singleton sets
+        """
+        n = len(self.parent)
+        self.parent = np.concatenate([self.parent, np.arange(n, n + count, dtype=np.intp)])
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def union_pairs(self, a, b):
+        """
+        Union all pairs (a[i], b[i]), vectorized over the pairs
+        """
+        if len(a) == 0:
+            return
+        roots, codes = np.unique(np.concatenate([self.find_all(a), self.find_all(b)]), return_inverse=True)
+        codes = codes.reshape(2, -1)
+        graph = coo_matrix((np.ones(codes.shape[1], dtype=np.int8), (codes[0], codes[1])),
+                           shape=(len(roots), len(roots)))
+        _, root_component = connected_components(graph, directed=False)
+
+        # roots are sorted, so the first root in each component is the smallest
+        new_root = np.full(len(roots), len(self.parent), dtype=np.intp)
+        np.minimum.at(new_root, root_component, roots)
+        self.parent[roots] = new_root[root_component]
+
+    def find_all(self, x):
+        """
+        Vectorized find for an array of elements
+        """
+        parent = self.parent
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+        self.parent = parent
+        return parent[x]
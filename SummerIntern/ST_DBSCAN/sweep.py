@@ -0,0 +1,88 @@
+"""
+Parameter sweeps for ST-DBSCAN.
+
+The spatio-temporal neighbor graph is computed once at the largest thresholds; the
+labels for every combination of smaller thresholds and min_neighbors are derived from
+it (in parallel across the settings) and summarized in a tidy table.
+"""
+import itertools
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from ST_DBSCAN.STDBSCAN import NOISE
+from ST_DBSCAN.neighbor_graph import NeighborGraph
+
+
+def ST_DBSCAN_sweep(df, spatial_thresholds, temporal_thresholds, min_neighbors,
+                    catch_column='Total catch Krill - Mt', n_jobs=1, graph=None, cache=None):
+    """
+    Run ST_DBSCAN for all combinations of the given parameters.
+
+    Parameters
+    ----------
+        df -- pandas DataFrame with columns ['Latitude', 'Longitude', 'month'] (and catch_column)
+        spatial_thresholds -- list of floats, spatial thresholds (km)
+        temporal_thresholds -- list of ints, temporal thresholds (months)
+        min_neighbors -- list of ints, min_neighbors values
+        catch_column -- string, default 'Total catch Krill - Mt', column summed per cluster
+            (None to skip the catch)
+        n_jobs -- int, default 1, number of processes for the settings (-1 uses all cores)
+        graph -- NeighborGraph, default None, precomputed graph with thresholds at least
+            the largest ones in the sweep
+        cache -- ClusteringCache, default None, cache to load/store the neighbor graph (if graph is None)
+
+    Returns
+    -------
+        df_sweep -- pandas DataFrame, one row per setting and cluster (noise is cluster -1) with columns
+            ['spatial_threshold', 'temporal_threshold', 'min_neighbors', 'n_clusters',
+             'noise_fraction', 'cluster', 'n_points', 'catch']
+    """
+    if graph is None and cache is not None:
+        graph = cache.neighbor_graph(df['Latitude'].values, df['Longitude'].values, df['month'].values,
+                                     max(spatial_thresholds), max(temporal_thresholds))
+    elif graph is None:
+        graph = NeighborGraph.build(df['Latitude'].values, df['Longitude'].values, df['month'].values,
+                                    max(spatial_thresholds), max(temporal_thresholds))
+
+    settings = list(itertools.product(spatial_thresholds, temporal_thresholds, min_neighbors))
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        all_labels = [graph.labels(*setting) for setting in settings]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(graph,)) as executor:
+            all_labels = list(executor.map(_labels_for_setting, settings))
+
+    catch = df[catch_column].values if catch_column is not None else np.zeros(len(df))
+
+    tables = []
+    for (spatial_threshold, temporal_threshold, neighbors), labels in zip(settings, all_labels):
+        clusters, codes, counts = np.unique(labels, return_inverse=True, return_counts=True)
+        table = pd.DataFrame({'cluster': clusters,
+                              'n_points': counts,
+                              'catch': np.bincount(codes.ravel(), weights=catch, minlength=len(clusters))})
+        table.insert(0, 'spatial_threshold', spatial_threshold)
+        table.insert(1, 'temporal_threshold', temporal_threshold)
+        table.insert(2, 'min_neighbors', neighbors)
+        table.insert(3, 'n_clusters', int((clusters != NOISE).sum()))
+        table.insert(4, 'noise_fraction', np.mean(labels == NOISE) if len(labels) else 0.0)
+        tables.append(table)
+
+    df_sweep = pd.concat(tables, ignore_index=True)
+    if catch_column is None:
+        df_sweep.drop(['catch'], axis=1, inplace=True)
+    return df_sweep
+
+
+_worker_graph = None
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _labels_for_setting(setting):
+    return _worker_graph.labels(*setting)
@@ -0,0 +1,296 @@
+import os
+
+import numpy as np
+import pytest
+from geopy.distance import great_circle
+
+from ST_DBSCAN.STDBSCAN import ST_DBSCAN, STDBSCAN, ClusteringStats, NeighborIndex, TemporalIndex, day_of_year, \
+    get_relevant_months
+from ST_DBSCAN.benchmark import synthetic_catch_data
+
+MISSING = [5, 17, 400]
+
+
+@pytest.fixture(scope='module')
+def df_catch():
+    return synthetic_catch_data(1500, points_per_swarm=100, seed=2)
+
+
+@pytest.mark.parametrize('temporal_threshold', [0, 1, 6])
+def test_missing_month_is_noise(df_catch, temporal_threshold):
+    df = df_catch[['Latitude', 'Longitude', 'month']].astype({'month': 'float64'})
+    df.loc[df.index[MISSING], 'month'] = np.nan
+
+    labels = ST_DBSCAN(df.copy(), 10, temporal_threshold, 5)['cluster'].values
+    assert (labels[MISSING] == -1).all()
+
+    # the points without a month are neighbors of no other point either
+    others = np.setdiff1d(np.arange(len(df)), MISSING)
+    expected = STDBSCAN(10, temporal_threshold, 5).fit_predict(df['Latitude'].values[others],
+                                                              df['Longitude'].values[others],
+                                                              df['month'].values[others])
+    np.testing.assert_array_equal(labels[others], expected)
+    assert len(np.unique(expected)) > 2
+
+
+def test_missing_date_is_noise(df_catch):
+    dates = df_catch['Date'].values.copy()
+    dates[MISSING] = np.datetime64('NaT')
+    latitude, longitude = df_catch['Latitude'].values, df_catch['Longitude'].values
+
+    labels = STDBSCAN(10, 20, 5, temporal_resolution='day').fit_predict(latitude, longitude, dates)
+    assert (labels[MISSING] == -1).all()
+    others = np.setdiff1d(np.arange(len(dates)), MISSING)
+    np.testing.assert_array_equal(labels[others], STDBSCAN(10, 20, 5, temporal_resolution='day').fit_predict(
+        latitude[others], longitude[others], dates[others]))
+
+
+@pytest.mark.parametrize('temporal_resolution', ['day', 'dayofyear'])
+def test_colocated_missing_dates_are_noise(df_catch, temporal_resolution):
+    latitude = np.concatenate([df_catch['Latitude'].values, np.full(20, -60.5)])
+    longitude = np.concatenate([df_catch['Longitude'].values, np.full(20, -46.0)])
+    dates = np.concatenate([df_catch['Date'].values, np.full(20, np.datetime64('NaT'), dtype=df_catch['Date'].dtype)])
+
+    labels = STDBSCAN(10, 20, 5, temporal_resolution=temporal_resolution).fit_predict(latitude, longitude, dates)
+    assert (labels[-20:] == -1).all()
+    np.testing.assert_array_equal(labels[:-20], STDBSCAN(10, 20, 5, temporal_resolution=temporal_resolution)
+                                  .fit_predict(latitude[:-20], longitude[:-20], dates[:-20]))
+
+
+@pytest.mark.parametrize('temporal_resolution', ['day', 'dayofyear'])
+def test_time_window_candidates(df_catch, temporal_resolution, monkeypatch):
+    latitude, longitude, dates = df_catch['Latitude'].values, df_catch['Longitude'].values, df_catch['Date'].values
+    window_stats = ClusteringStats()
+    labels = STDBSCAN(30, 1, 3, temporal_resolution=temporal_resolution).fit_predict(latitude, longitude, dates,
+                                                                                   stats=window_stats)
+
+    # only the spatial tree
+    monkeypatch.setattr(NeighborIndex, 'WINDOW_SCAN_FACTOR', 0)
+    tree_stats = ClusteringStats()
+    np.testing.assert_array_equal(labels, STDBSCAN(30, 1, 3, temporal_resolution=temporal_resolution).fit_predict(
+        latitude, longitude, dates, stats=tree_stats))
+    assert window_stats.candidates_scanned < tree_stats.candidates_scanned
+
+
+def test_day_of_year_in_leap_years():
+    dates = np.array(['2015-03-10', '2016-03-10', '2016-02-28', '2016-02-29', '2016-03-01', '2016-12-31',
+                      '2017-01-01', 'NaT'], dtype='datetime64[ns]')
+    days = day_of_year(dates)
+    np.testing.assert_array_equal(days[:7], [69, 69, 59, 59.5, 60, 365, 1])
+    assert np.isnan(days[7])
+
+    temporal_index = TemporalIndex(dates, 0, 'dayofyear')
+    np.testing.assert_array_equal(temporal_index.window(0), [0, 1])
+    temporal_index = TemporalIndex(dates, 1, 'dayofyear')
+    np.testing.assert_array_equal(np.sort(temporal_index.window(5)), [5, 6])
+    np.testing.assert_array_equal(np.sort(temporal_index.window(3)), [2, 3, 4])
+    assert len(temporal_index.window(7)) == 0
+
+
+def baseline_neighbors(latitude, longitude, month, position, spatial_threshold, temporal_threshold):
+    """
+    Neighborhood of the original retrieve_neighbors: the points in the relevant months within
+    spatial_threshold (km) by geopy's great_circle, in index order
+    """
+    months = get_relevant_months(month[position], temporal_threshold)
+    center = (latitude[position], longitude[position])
+    return [i for i in np.flatnonzero(np.isin(month, months)) if i != position and
+            great_circle(center, (latitude[i], longitude[i])).km <= spatial_threshold]
+
+
+@pytest.mark.parametrize('temporal_threshold', [0, 1])
+def test_neighbor_index_equals_retrieve_neighbors(temporal_threshold):
+    df = synthetic_catch_data(400, points_per_swarm=40, seed=3)
+    latitude, longitude, month = df['Latitude'].values.copy(), df['Longitude'].values.copy(), df['month'].values
+    # points exactly on the spatial threshold of their predecessor, decided by the exact re-check
+    for row, bearing in zip(range(0, 400, 8), np.linspace(0, 360, 50)):
+        position = great_circle(kilometers=10).destination((latitude[row], longitude[row]), bearing)
+        latitude[row + 1], longitude[row + 1] = position.latitude, position.longitude
+
+    neighbor_index = NeighborIndex(latitude, longitude, month, 10, temporal_threshold)
+    sizes = []
+    for position in range(len(latitude)):
+        expected = baseline_neighbors(latitude, longitude, month, position, 10, temporal_threshold)
+        np.testing.assert_array_equal(neighbor_index.query(position), expected)
+        sizes.append(len(expected))
+    assert max(sizes) > 5
+
+
+def baseline_labels(neighborhoods, min_neighbors):
+    """
+    Labels of the original dataframe ST_DBSCAN loop, on precomputed neighborhoods
+    """
+    labels = [777777] * len(neighborhoods)
+    cluster_label = 0
+    stack = []
+    for index in range(len(neighborhoods)):
+        if labels[index] == 777777:
+            if len(neighborhoods[index]) < min_neighbors:
+                labels[index] = -1
+            else:
+                cluster_label = cluster_label + 1
+                labels[index] = cluster_label
+                for neig_index in neighborhoods[index]:
+                    labels[neig_index] = cluster_label
+                    stack.append(neig_index)
+                while len(stack) > 0:
+                    new_neighborhood = neighborhoods[stack.pop()]
+                    if len(new_neighborhood) >= min_neighbors:
+                        for neig_index in new_neighborhood:
+                            if labels[neig_index] == 777777:
+                                labels[neig_index] = cluster_label
+                                stack.append(neig_index)
+    return labels
+
+
+@pytest.mark.parametrize('spatial_threshold, temporal_threshold, min_neighbors', [(10, 1, 5), (20, 0, 8), (5, 6, 3)])
+def test_engine_equals_original_ST_DBSCAN(spatial_threshold, temporal_threshold, min_neighbors):
+    df = synthetic_catch_data(500, points_per_swarm=50, seed=5)
+    latitude, longitude, month = df['Latitude'].values, df['Longitude'].values, df['month'].values
+    neighborhoods = [baseline_neighbors(latitude, longitude, month, position, spatial_threshold, temporal_threshold)
+                     for position in range(len(df))]
+    expected = baseline_labels(neighborhoods, min_neighbors)
+    assert len(set(expected)) > 2 and -1 in expected
+
+    labels = STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors).fit_predict(latitude, longitude, month)
+    assert labels.dtype == np.int32
+    np.testing.assert_array_equal(labels, expected)
+    df_clustered = ST_DBSCAN(df[['Latitude', 'Longitude', 'month']].copy(), spatial_threshold, temporal_threshold,
+                             min_neighbors)
+    np.testing.assert_array_equal(df_clustered['cluster'].values, expected)
+
+
+@pytest.mark.parametrize('temporal_resolution, temporal_threshold', [('month', 1), ('day', 20)])
+def test_parallel_tiles_equal_serial(df_catch, temporal_resolution, temporal_threshold):
+    from ST_DBSCAN.parallel import make_tiles, parallel_ST_DBSCAN
+
+    latitude, longitude = df_catch['Latitude'].values, df_catch['Longitude'].values
+    time = df_catch['month'].values if temporal_resolution == 'month' else df_catch['Date'].values
+    # tiles smaller than the swarms, so that clusters are merged across tile borders
+    tiles = make_tiles(latitude, longitude, 10, 0.25)
+    assert len(tiles) > 10
+    np.testing.assert_array_equal(np.sort(np.concatenate([ids[owned] for ids, owned in tiles])),
+                                  np.arange(len(latitude)))
+
+    expected = STDBSCAN(10, temporal_threshold, 5, temporal_resolution=temporal_resolution).fit_predict(
+        latitude, longitude, time)
+    labels = parallel_ST_DBSCAN(latitude, longitude, time, 10, temporal_threshold, 5,
+                                temporal_resolution=temporal_resolution, n_jobs=2, tile_size=0.25)
+    assert len(np.unique(expected)) > 2
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_neighbor_graph_sweep_equals_ST_DBSCAN(df_catch):
+    from ST_DBSCAN.neighbor_graph import NeighborGraph
+    from ST_DBSCAN.sweep import ST_DBSCAN_sweep
+
+    latitude, longitude, month = df_catch['Latitude'].values, df_catch['Longitude'].values, df_catch['month'].values
+    graph = NeighborGraph.build(latitude, longitude, month, 20, 2)
+    df_sweep = ST_DBSCAN_sweep(df_catch, [5, 20], [0, 2], [3, 8], graph=graph)
+    for (spatial_threshold, temporal_threshold, min_neighbors), df_setting in df_sweep.groupby(
+            ['spatial_threshold', 'temporal_threshold', 'min_neighbors']):
+        expected = STDBSCAN(spatial_threshold, temporal_threshold, min_neighbors).fit_predict(latitude, longitude,
+                                                                                               month)
+        np.testing.assert_array_equal(graph.labels(spatial_threshold, temporal_threshold, min_neighbors), expected)
+
+        clusters, counts = np.unique(expected, return_counts=True)
+        np.testing.assert_array_equal(df_setting['cluster'], clusters)
+        np.testing.assert_array_equal(df_setting['n_points'], counts)
+        np.testing.assert_allclose(df_setting['catch'], [df_catch['Total catch Krill - Mt'].values[
+            expected == cluster].sum() for cluster in clusters])
+        assert (df_setting['n_clusters'] == (clusters != -1).sum()).all()
+    assert len(df_sweep.groupby(['spatial_threshold', 'temporal_threshold', 'min_neighbors'])) == 8
+
+    with pytest.raises(ValueError):
+        graph.labels(25, 1, 5)
+
+
+def test_clustering_cache_key_hit_and_eviction(df_catch, tmp_path, monkeypatch):
+    from ST_DBSCAN.cache import ClusteringCache
+
+    latitude, longitude, month = df_catch['Latitude'].values, df_catch['Longitude'].values, df_catch['month'].values
+    key = ClusteringCache.key('labels_month', latitude, longitude, month, 10, 1, 5)
+    assert key == ClusteringCache.key('labels_month', latitude.copy(), longitude.copy(), month.astype(float), 10, 1, 5)
+    moved = latitude.copy()
+    moved[0] += 1e-9
+    assert len({key, ClusteringCache.key('labels_month', moved, longitude, month, 10, 1, 5),
+                ClusteringCache.key('labels_month', latitude, longitude, month, 10, 1, 6),
+                ClusteringCache.key('labels_day', latitude, longitude, month, 10, 1, 5)}) == 4
+
+    cache = ClusteringCache(str(tmp_path / 'cache'))
+    expected = STDBSCAN(10, 1, 5).fit_predict(latitude, longitude, month)
+    np.testing.assert_array_equal(ST_DBSCAN(df_catch.copy(), 10, 1, 5, cache=cache)['cluster'].values, expected)
+
+    # a hit is loaded from disk, nothing is clustered
+    def fail(*args, **kwargs):
+        raise AssertionError('clustered on a cache hit')
+    monkeypatch.setattr(STDBSCAN, 'fit_predict', fail)
+    np.testing.assert_array_equal(cache.labels(latitude, longitude, month, 10, 1, 5), expected)
+    monkeypatch.undo()
+
+    # labels are derived from a cached neighbor graph at the same thresholds
+    graph = cache.neighbor_graph(latitude, longitude, month, 20, 2)
+    monkeypatch.setattr(STDBSCAN, 'fit_predict', fail)
+    np.testing.assert_array_equal(cache.labels(latitude, longitude, month, 20, 2, 8), graph.labels(20, 2, 8))
+    monkeypatch.undo()
+
+    # the least recently used entries are evicted first
+    entries = sorted(cache._entries())
+    for age, (path, _, _) in enumerate(entries):
+        os.utime(path, (1000 + age, 1000 + age))
+    cache.max_size_mb = (cache.size_mb() - entries[0][2] / 1024 ** 2) * (1 + 1e-9)
+    cache._evict()
+    assert sorted(path for path, _, _ in cache._entries()) == [path for path, _, _ in entries[1:]]
+    cache.clear()
+    assert cache.size_mb() == 0
+
+
+@pytest.mark.parametrize('temporal_resolution, temporal_threshold', [('month', 1), ('day', 20)])
+def test_optics_extract_dbscan_equals_ST_DBSCAN(df_catch, temporal_resolution, temporal_threshold):
+    from ST_DBSCAN.STOPTICS import STOPTICS
+
+    latitude, longitude = df_catch['Latitude'].values, df_catch['Longitude'].values
+    time = df_catch['month'].values if temporal_resolution == 'month' else df_catch['Date'].values
+    optics = STOPTICS(20, temporal_threshold, 5, temporal_resolution=temporal_resolution)
+    with pytest.raises(ValueError):
+        optics.extract_dbscan(10)
+    optics.fit(latitude, longitude, time)
+    np.testing.assert_array_equal(np.sort(optics.ordering_), np.arange(len(latitude)))
+
+    for spatial_threshold in [2.5, 5, 10, 20]:
+        expected = STDBSCAN(spatial_threshold, temporal_threshold, 5,
+                            temporal_resolution=temporal_resolution).fit_predict(latitude, longitude, time)
+        np.testing.assert_array_equal(optics.extract_dbscan(spatial_threshold), expected)
+    assert len(np.unique(expected)) > 2
+    with pytest.raises(ValueError):
+        optics.extract_dbscan(25)
+
+
+def test_clustering_stats_counters(df_catch, monkeypatch):
+    latitude, longitude, month = df_catch['Latitude'].values, df_catch['Longitude'].values, df_catch['month'].values
+    expected = STDBSCAN(10, 1, 5).fit_predict(latitude, longitude, month)
+
+    queries = []
+    query = NeighborIndex.query
+    monkeypatch.setattr(NeighborIndex, 'query', lambda self, position, stats=None: queries.append(position) or
+                        query(self, position, stats))
+    reports = []
+    stats = ClusteringStats(callback=reports.append)
+    np.testing.assert_array_equal(STDBSCAN(10, 1, 5).fit_predict(latitude, longitude, month, stats=stats), expected)
+    monkeypatch.undo()
+
+    assert reports == [stats]
+    assert stats.neighbor_queries == len(queries) > len(latitude)
+    assert stats.distance_evaluations <= stats.candidates_scanned
+    assert 5 <= stats.max_stack_depth < len(latitude)
+    assert set(stats.phase_seconds) == {'index', 'neighbor_queries', 'expansion'}
+
+    # the wrapper reports the same counters, merging adds them up
+    wrapper_stats = ClusteringStats()
+    ST_DBSCAN(df_catch[['Latitude', 'Longitude', 'month']].copy(), 10, 1, 5, stats=wrapper_stats)
+    counters = ['neighbor_queries', 'candidates_scanned', 'distance_evaluations', 'max_stack_depth']
+    assert [getattr(wrapper_stats, name) for name in counters] == [getattr(stats, name) for name in counters]
+    merged = ClusteringStats().merge(stats).merge(wrapper_stats).as_dict()
+    assert merged['neighbor_queries'] == 2 * stats.neighbor_queries
+    assert merged['max_stack_depth'] == stats.max_stack_depth
+    assert merged['phase_seconds']['index'] == stats.phase_seconds['index'] + wrapper_stats.phase_seconds['index']
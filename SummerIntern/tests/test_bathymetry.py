@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.bathymetry import NODATA, Bathymetry, depth_at, ingest_bathymetry
+
+RESOLUTION = 1 / 120
+
+
+@pytest.fixture(scope='module')
+def grid(tmp_path_factory):
+    """
+    ERDDAP-like CSV (a row of units below the header, axes rounded to 4 decimals) ingested to a grid
+    """
+    rng = np.random.default_rng(0)
+    latitude = np.linspace(-61, -60, 121)[::-1]
+    longitude = np.linspace(-46, -45, 121)
+    lat, lon = np.meshgrid(latitude, longitude, indexing='ij')
+    topo = np.round(-3000 + 2000 * np.sin(lat) * np.cos(lon) + rng.normal(0, 50, lat.shape))
+    topo[40:45, 60:65] = np.nan  # no data
+
+    directory = tmp_path_factory.mktemp('bathymetry')
+    path = directory / 'srtm30.csv'
+    with open(path, 'w') as f:
+        f.write('latitude,longitude,topo\ndegrees_north,degrees_east,m\n')
+        pd.DataFrame({'latitude': np.round(lat.ravel(), 4), 'longitude': np.round(lon.ravel(), 4),
+                      'topo': topo.ravel()}).dropna().to_csv(f, header=False, index=False)
+    bathymetry = ingest_bathymetry(str(path), str(directory / 'grid'))
+    # elevation on ascending axes, as in the grid
+    return bathymetry, str(directory / 'grid'), latitude[::-1], longitude, topo[::-1]
+
+
+def test_ingest_rounded_csv(grid):
+    bathymetry, directory, latitude, longitude, topo = grid
+    assert bathymetry.elevation.dtype == np.int16 and bathymetry.elevation.shape == (121, 121)
+    assert (bathymetry.elevation[np.isnan(topo)] == NODATA).all()
+    np.testing.assert_array_equal(bathymetry.elevation[~np.isnan(topo)], topo[~np.isnan(topo)])
+
+
+def test_irregular_axis_raises(tmp_path):
+    path = tmp_path / 'irregular.csv'
+    pd.DataFrame({'latitude': [-60.0, -60.0, -59.0, -59.0, -56.0, -56.0],
+                  'longitude': [-45.0, -44.0, -45.0, -44.0, -45.0, -44.0], 'topo': -100}).to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        ingest_bathymetry(str(path), str(tmp_path / 'grid'))
+
+
+def test_depth_at_nearest(grid):
+    bathymetry, directory, latitude, longitude, topo = grid
+    rng = np.random.default_rng(1)
+    lat, lon = rng.uniform(-61, -60, 5000), rng.uniform(-46, -45, 5000)
+    rows = np.argmin(np.abs(latitude[:, np.newaxis] - lat), axis=0)
+    columns = np.argmin(np.abs(longitude[:, np.newaxis] - lon), axis=0)
+    np.testing.assert_array_equal(depth_at(lat, lon, directory), -topo[rows, columns])
+    assert np.isnan(topo[rows, columns]).any()
+
+
+def test_depth_at_bilinear(grid):
+    bathymetry, directory, latitude, longitude, topo = grid
+    from scipy.interpolate import RegularGridInterpolator
+
+    rng = np.random.default_rng(2)
+    lat, lon = rng.uniform(-61, -60, 5000), rng.uniform(-46, -45, 5000)
+    expected = -RegularGridInterpolator((latitude, longitude), topo)(np.column_stack([lat, lon]))
+    np.testing.assert_allclose(bathymetry.depth_at(lat, lon, 'bilinear'), expected, atol=1e-6)
+
+
+def test_depth_at_missing_cells(grid):
+    bathymetry, directory, latitude, longitude, topo = grid
+    # missing cells in the rows 76-80 and columns 60-64 of the ascending grid
+    assert np.isnan(topo[76:81, 60:65]).all() and not np.isnan(topo[76:81, 59]).any()
+    # on the grid line of the valid column 59, the missing column 60 has no weight
+    depth = bathymetry.depth_at([latitude[77] + 0.5 * RESOLUTION], [longitude[59]], 'bilinear')[0]
+    np.testing.assert_allclose(depth, -(topo[77, 59] + topo[78, 59]) / 2)
+    # with a weight, a missing cell gives NaN
+    assert np.isnan(bathymetry.depth_at([latitude[78]], [longitude[59] + 0.5 * RESOLUTION], 'bilinear')[0])
+    assert np.isnan(bathymetry.depth_at([latitude[78]], [longitude[61]])[0])
+
+
+def test_depth_at_outside_grid(grid):
+    bathymetry, directory, latitude, longitude, topo = grid
+    depth = bathymetry.depth_at([-62.0, -60.5, np.nan, -61 - 0.4 * RESOLUTION, -61 - 0.6 * RESOLUTION],
+                                [-45.5, -44.0, -45.5, -45.5, -45.5])
+    assert np.isnan(depth[[0, 1, 2, 4]]).all()
+    assert depth[3] == -topo[0, 60]
+    assert Bathymetry.load_cached(directory) is Bathymetry.load_cached(directory)
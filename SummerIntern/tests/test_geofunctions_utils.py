@@ -0,0 +1,184 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from utils.geofunctions_utils import R_EARTH, GriddedField, LandMask, LunationTable, distance_between_latlon_arrays, \
+    distance_between_latlon_coords, distance_from_latlon_coord, get_location_temperature, get_moon_phase, \
+    get_phase_on_day, matrix_mask_from_seaicedata, pairwise_distance_latlon, pairwise_distance_latlon_blocks
+
+
+def make_npz(path, with_dates=True):
+    """
+    Satellite-like .npz file: temperature (longitude, latitude, date), 2-D latitude and longitude grids
+    """
+    rng = np.random.default_rng(0)
+    latitude_vector, longitude_vector = np.linspace(-50, -70, 21), np.linspace(-70, -30, 41)
+    latitude, longitude = np.meshgrid(latitude_vector, longitude_vector)
+    temperature = rng.normal(0, 2, (41, 21, 5))
+    fields = {'temperature': temperature, 'latitude': latitude, 'longitude': longitude}
+    if with_dates:
+        fields['date'] = np.arange('2015-01-01', '2015-01-06', dtype='datetime64[D]')
+    np.savez(path, **fields)
+    return temperature, latitude_vector, longitude_vector
+
+
+def baseline_location_temperature(temperature, latitude_vector, longitude_vector, lat, lon):
+    index_row = np.argmin(np.abs(longitude_vector - lon))
+    index_col = np.argmin(np.abs(latitude_vector - lat))
+    return temperature[index_row, index_col, :]
+
+
+def test_values_at_with_dates(tmp_path):
+    temperature, latitude_vector, longitude_vector = make_npz(tmp_path / 'temperature.npz')
+    field = GriddedField.from_npz(str(tmp_path / 'temperature.npz'))
+
+    lat, lon = np.array([-55.3, -61.0, np.nan]), np.array([-44.6, -69.9, -40.0])
+    values = field.values_at(lat, lon, np.array(['2015-01-03', '2015-01-05', '2015-01-01'], dtype='datetime64[D]'))
+    for i, date_index in enumerate([2, 4]):
+        expected = baseline_location_temperature(temperature, latitude_vector, longitude_vector, lat[i], lon[i])
+        assert values[i] == expected[date_index]
+    assert np.isnan(values[2])
+
+    opened = field.save(str(tmp_path / 'temperature')).open(str(tmp_path / 'temperature'))
+    np.testing.assert_array_equal(opened.values_at(lat, lon), field.values_at(lat, lon))
+
+
+def test_field_without_date_array(tmp_path):
+    temperature, latitude_vector, longitude_vector = make_npz(tmp_path / 'temperature.npz', with_dates=False)
+    field = GriddedField.from_npz(str(tmp_path / 'temperature.npz'))
+    assert field.dates is None and field.values.shape == (41, 21, 5)
+
+    # the values on all dates can still be read, as the baseline get_location_temperature did
+    np.testing.assert_array_equal(
+        get_location_temperature(-55.3, -44.6, data=field),
+        baseline_location_temperature(temperature, latitude_vector, longitude_vector, -55.3, -44.6))
+    assert field.values_at([-55.3, -61.0], [-44.6, -69.9], method='bilinear').shape == (2, 5)
+
+    # get_location_temperature ignores the date, as the baseline did
+    np.testing.assert_array_equal(get_location_temperature(-55.3, -44.6, '2015-01-03', data=field),
+                                  get_location_temperature(-55.3, -44.6, data=field))
+    np.testing.assert_array_equal(
+        get_location_temperature(-55.3, -44.6, np.datetime64('2015-01-03'), np.load(tmp_path / 'temperature.npz')),
+        get_location_temperature(-55.3, -44.6, data=field))
+
+    # only the lookups by date fail
+    with pytest.raises(ValueError):
+        field.values_at([-55.3], [-44.6], np.array(['2015-01-03'], dtype='datetime64[D]'))
+    with pytest.raises(ValueError):
+        field.select_dates('2015-01-01', '2015-01-03')
+
+    # a field on a single date ignores dates
+    single = GriddedField(temperature[:, :, 0], latitude_vector, longitude_vector)
+    assert single.values_at([-55.3], [-44.6], np.array(['2015-01-03'], dtype='datetime64[D]'))[0] == \
+        baseline_location_temperature(temperature, latitude_vector, longitude_vector, -55.3, -44.6)[0]
+
+
+def test_shape_mismatch_raises():
+    with pytest.raises(ValueError):
+        GriddedField(np.zeros((3, 4, 2)), np.arange(4), np.arange(3), np.arange(3).astype('datetime64[D]'))
+    with pytest.raises(ValueError):
+        GriddedField(np.zeros((4, 3)), np.arange(4), np.arange(3))
+
+
+@pytest.mark.parametrize('data_source', ['NASA', 'ESA'])
+def test_land_mask_equals_unpacked_mask(data_source):
+    rng = np.random.default_rng(1)
+    latitude_vector, longitude_vector = np.linspace(-50, -80, 61), np.linspace(-90, 0, 91)
+    latitude, longitude = np.meshgrid(latitude_vector, longitude_vector)
+    land = rng.random((91, 61)) < 0.2
+    if data_source == 'NASA':
+        seaice = rng.integers(0, 25, (91, 61, 3))
+        seaice[land] = 25
+    else:
+        seaice = rng.uniform(0, 100, (91, 61, 3))
+        seaice[land] = np.nan
+    seaice_data = {'seaice': seaice, 'latitude': latitude, 'longitude': longitude,
+                   'date': np.arange('2019-01-01', '2019-01-04', dtype='datetime64[D]')}
+
+    # the baseline contract: an NpzFile with an integer mask
+    mask_npz = matrix_mask_from_seaicedata(seaice_data, data_source)
+    assert isinstance(mask_npz, np.lib.npyio.NpzFile)
+    assert np.issubdtype(mask_npz['mask'].dtype, np.integer)
+    np.testing.assert_array_equal(mask_npz['mask'], land * 1)
+
+    land_mask = LandMask.from_seaicedata(seaice_data, data_source)
+    np.testing.assert_array_equal(land_mask.land, mask_npz['mask'].astype(bool))
+
+    # positions looked up in the nearest cell, as with argmin on the axes
+    lat, lon = rng.uniform(-82, -48, 3000), rng.uniform(-92, 2, 3000)
+    rows = np.argmin(np.abs(longitude_vector[:, np.newaxis] - lon), axis=0)
+    columns = np.argmin(np.abs(latitude_vector[:, np.newaxis] - lat), axis=0)
+    np.testing.assert_array_equal(land_mask.is_land(lat, lon), mask_npz['mask'][rows, columns] == 1)
+    dates = np.datetime64('2019-01-01') + rng.integers(0, 3, 3000).astype('timedelta64[D]')
+    values = seaice[rows, columns, (dates - np.datetime64('2019-01-01')).astype(int)]
+    with np.errstate(invalid='ignore'):
+        ice = (values >= land_mask.ice_threshold) & ~land[rows, columns]
+    np.testing.assert_array_equal(land_mask.is_ice(lat, lon, dates), ice)
+
+    # an irregular grid is looked up with a k-d tree, the same cells away from cell boundaries
+    irregular = LandMask(seaice, latitude + rng.normal(0, 1e-6, latitude.shape), longitude, data_source=data_source)
+    assert irregular.tree is not None
+    assert (irregular.is_land(lat, lon) == land_mask.is_land(lat, lon)).mean() > 0.99
+    assert not land_mask.is_land([np.nan], [-45.0])[0]
+
+
+def test_haversine_arrays_equal_distance_between_latlon_coords():
+    rng = np.random.default_rng(2)
+    lat1, lat2 = rng.uniform(-90, 90, (2, 500))
+    lon1, lon2 = rng.uniform(-180, 360, (2, 500))
+    expected = np.array([distance_between_latlon_coords(*coords) for coords in zip(lat1, lon1, lat2, lon2)])
+    np.testing.assert_allclose(distance_between_latlon_arrays(lat1, lon1, lat2, lon2), expected, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(distance_between_latlon_arrays(lat1, lon1, lat2, lon2, dtype='float32'), expected,
+                               rtol=1e-5, atol=1e-2)
+    np.testing.assert_array_equal(distance_between_latlon_arrays(lat1, lon1, lat1, lon1), 0)
+    np.testing.assert_allclose(distance_between_latlon_arrays(-60, -45, 60, 135), np.pi * R_EARTH)
+
+    # one to many, broadcast
+    expected = [distance_between_latlon_coords(lat1[0], lon1[0], lat, lon) for lat, lon in zip(lat2, lon2)]
+    np.testing.assert_allclose(distance_from_latlon_coord(lat1[0], lon1[0], lat2, lon2), expected, atol=1e-9)
+    np.testing.assert_allclose(distance_between_latlon_arrays(lat1[0], lon1[0], lat2, lon2), expected, atol=1e-9)
+
+
+@pytest.mark.parametrize('with_columns', [False, True])
+def test_pairwise_distance_blocks(with_columns):
+    rng = np.random.default_rng(3)
+    lat1, lon1 = rng.uniform(-70, -50, 230), rng.uniform(-70, -30, 230)
+    lat2, lon2 = (rng.uniform(-70, -50, 170), rng.uniform(-70, -30, 170)) if with_columns else (lat1, lon1)
+    expected = distance_between_latlon_arrays(lat1[:, np.newaxis], lon1[:, np.newaxis], lat2, lon2)
+    columns = (lat2, lon2) if with_columns else (None, None)
+
+    covered = np.zeros(expected.shape, dtype=int)
+    for row_start, col_start, block in pairwise_distance_latlon_blocks(lat1, lon1, *columns, block_size=64):
+        assert block.shape[0] <= 64 and block.shape[1] <= 64
+        rows, cols = slice(row_start, row_start + block.shape[0]), slice(col_start, col_start + block.shape[1])
+        np.testing.assert_allclose(block, expected[rows, cols], rtol=0, atol=1e-9)
+        covered[rows, cols] += 1
+    assert (covered == 1).all()
+
+    np.testing.assert_allclose(pairwise_distance_latlon(lat1, lon1, *columns, block_size=64), expected, atol=1e-9)
+    distance = pairwise_distance_latlon(lat1, lon1, *columns, block_size=100, dtype='float32')
+    assert distance.dtype == np.float32
+    np.testing.assert_allclose(distance, expected, rtol=1e-5, atol=1e-2)
+
+
+def test_lunation_table_equals_ephem(monkeypatch):
+    monkeypatch.setattr(LunationTable, '_cached', None)
+    rng = np.random.default_rng(4)
+    dates = np.datetime64('2014-01-01') + rng.integers(0, 6 * 365, 200).astype('timedelta64[D]')
+    table = LunationTable.covering(np.append(dates, np.datetime64('NaT')))
+
+    days = [date.astype(datetime.date) for date in dates]
+    np.testing.assert_allclose(table.lunation(dates), [get_phase_on_day(day.year, day.month, day.day) for day in days],
+                               rtol=0, atol=1e-9)
+    np.testing.assert_allclose(table.illuminated_fraction(dates), [get_moon_phase(day) for day in days],
+                               rtol=0, atol=1e-4)
+    assert np.isnan(table.lunation(np.array(['NaT'], dtype='datetime64[D]'))).all()
+    assert np.isnan(table.illuminated_fraction(np.array(['NaT'], dtype='datetime64[D]'))).all()
+
+    # the table is reused for dates it covers, and extended for the others
+    assert LunationTable.covering(dates[:10]) is table
+    with pytest.raises(ValueError):
+        table.lunation(np.array(['2021-01-01'], dtype='datetime64[D]'))
+    extended = LunationTable.covering(np.array(['2021-01-01'], dtype='datetime64[D]'))
+    assert extended is not table and extended.start_date == table.start_date
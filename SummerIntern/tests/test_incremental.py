@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from geopy.distance import great_circle
+
+from ST_DBSCAN.STDBSCAN import ST_DBSCAN, STDBSCAN
+from ST_DBSCAN.benchmark import synthetic_catch_data
+from ST_DBSCAN.incremental import IncrementalSTDBSCAN
+
+
+@pytest.fixture(scope='module')
+def df_catch():
+    df = synthetic_catch_data(2000, points_per_swarm=150, seed=4).sort_values(by=['Date'], kind='stable')
+    # pairs of catches exactly on the spatial threshold, decided by the geopy re-check
+    rng = np.random.default_rng(4)
+    rows = rng.choice(len(df), 100, replace=False)
+    for row, bearing in zip(rows, rng.uniform(0, 360, len(rows))):
+        position = great_circle(kilometers=10).destination((df['Latitude'].iloc[row], df['Longitude'].iloc[row]),
+                                                           bearing)
+        df.iloc[(row + 1) % len(df), [df.columns.get_loc('Latitude'), df.columns.get_loc('Longitude')]] = \
+            [position.latitude, position.longitude]
+    return df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('batch_size', [1, 37, 500, None])
+@pytest.mark.parametrize('temporal_threshold', [0, 1])
+def test_incremental_labels_equal_ST_DBSCAN(df_catch, batch_size, temporal_threshold):
+    latitude, longitude, month = df_catch['Latitude'].values, df_catch['Longitude'].values, df_catch['month'].values
+    expected = ST_DBSCAN(df_catch[['Latitude', 'Longitude', 'month']].copy(), 10, temporal_threshold,
+                         5)['cluster'].values
+    assert len(np.unique(expected)) > 2
+
+    clusterer = IncrementalSTDBSCAN(10, temporal_threshold, 5)
+    batch_size = batch_size or len(latitude)
+    for start in range(0, len(latitude), batch_size):
+        stop = start + batch_size
+        clusterer.partial_fit(latitude[start:stop], longitude[start:stop], month[start:stop])
+        if start < len(latitude) // 2 <= stop:
+            # the labels so far are the ones of the points so far
+            np.testing.assert_array_equal(clusterer.labels_, STDBSCAN(10, temporal_threshold, 5).fit_predict(
+                latitude[:stop], longitude[:stop], month[:stop]))
+    np.testing.assert_array_equal(clusterer.labels_, expected)
+
+
+@pytest.mark.parametrize('temporal_threshold', [1, 7])
+def test_incremental_missing_months(df_catch, temporal_threshold):
+    latitude, longitude = df_catch['Latitude'].values, df_catch['Longitude'].values
+    month = df_catch['month'].values.astype('float64')
+    month[::50] = np.nan
+    expected = STDBSCAN(10, temporal_threshold, 5).fit_predict(latitude, longitude, month)
+    assert (expected[::50] == -1).all()
+
+    clusterer = IncrementalSTDBSCAN(10, temporal_threshold, 5)
+    for start in range(0, len(latitude), 300):
+        clusterer.partial_fit(latitude[start:start + 300], longitude[start:start + 300], month[start:start + 300])
+    np.testing.assert_array_equal(clusterer.labels_, expected)
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from utils.moon_phase_client import MoonPhaseClient, format_coords, format_date
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stub of the moon phase API: fracillum is 3 % per day of the month, the first request of a
+    date in January fails with 503 and '2/2/2019' is an API error
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stats = self.server.stats
+        date = parse_qs(urlsplit(self.path).query)['date'][0]
+        with stats['lock']:
+            stats['requests'] += 1
+            stats['connections'].add(self.client_address)
+            stats['active'] += 1
+            stats['max_active'] = max(stats['max_active'], stats['active'])
+            n_seen = stats['seen'].get(date, 0)
+            stats['seen'][date] = n_seen + 1
+        time.sleep(0.005)
+        with stats['lock']:
+            stats['active'] -= 1
+
+        if date.startswith('1/') and n_seen == 0:
+            status, body = 503, b'unavailable'
+        elif date == '2/2/2019':
+            status, body = 200, json.dumps({'error': True, 'type': 'bad date'}).encode()
+        else:
+            day = int(date.split('/')[1])
+            status, body = 200, json.dumps({'error': False, 'fracillum': '{}%'.format(3 * day),
+                                            'curphase': 'Waxing Gibbous'}, indent=1).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.stats = {'lock': threading.Lock(), 'requests': 0, 'connections': set(), 'active': 0, 'max_active': 0,
+                    'seen': {}}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, 'http://127.0.0.1:{}/rstt/oneday'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+DATES = ['{}/{}/2019'.format(month, day) for month in (1, 2, 3) for day in range(1, 21)]
+
+
+def test_pooled_requests_with_retries_and_errors(stub_server):
+    server, url = stub_server
+    client = MoonPhaseClient(url, max_concurrency=4, backoff=0.01)
+    results = client.get_moon_phases(DATES + DATES[:5] + ['not a date'], (-60.123, -45.456))
+
+    assert len(results) == len(DATES) + 6
+    assert results[0].value == pytest.approx(0.03) and results[0].error is None  # retried after the 503
+    assert results[21].value is None and results[21].error == 'bad date'
+    assert results[-1].value is None and 'not a date' in results[-1].error
+    assert results[len(DATES)] == results[0]
+    # one request per distinct date, plus the retries of January
+    assert server.stats['requests'] == client.n_requests == len(DATES) + 20
+    assert server.stats['max_active'] <= 4
+    assert len(server.stats['connections']) <= 4
+    client.close()
+
+
+def test_disk_cache_makes_no_requests(stub_server, tmp_path):
+    server, url = stub_server
+    cache_path = str(tmp_path / 'moon_phase_cache.sqlite')
+    dates = DATES[40:]
+    client = MoonPhaseClient(url, cache_path=cache_path)
+    first = client.get_moon_phases(dates, '60.12S,45.46W')
+    client.close()
+    n_requests = server.stats['requests']
+
+    client = MoonPhaseClient(url, cache_path=cache_path)
+    second = client.get_moon_phases(dates, (-60.12, -45.46), info='fracillum')
+    client.close()
+    assert server.stats['requests'] == n_requests
+    assert [result.value for result in second] == [result.value for result in first]
+    assert all(result.from_cache and result.error is None for result in second)
+
+
+def test_connection_errors_are_returned_per_request():
+    client = MoonPhaseClient('http://127.0.0.1:9/rstt/oneday', retries=1, backoff=0.01, timeout=1)
+    results = client.get_moon_phases(['3/5/2019'], '60S,45W')
+    assert results[0].value is None and 'Error while connecting to API' in results[0].error
+    assert client.n_requests == 2
+
+
+def test_get_moon_phases_in_running_event_loop(stub_server):
+    _, url = stub_server
+    client = MoonPhaseClient(url)
+
+    async def notebook_cell():
+        return client.get_moon_phases(['3/5/2019'], '60S,45W', 'moonphase')
+
+    results = asyncio.run(notebook_cell())
+    assert results[0].value == 'Waxing Gibbous'
+    assert asyncio.run(client.fetch_many(['3/6/2019'], '60S,45W'))[0].value == pytest.approx(0.18)
+
+
+def test_formats():
+    assert format_coords('59.5449N,10.4651E') == '59.54N,10.47E'
+    assert format_coords((-0.004, 179.999)) == '0.00N,180.00E'
+    assert format_date('04/23/2019') == '4/23/2019'
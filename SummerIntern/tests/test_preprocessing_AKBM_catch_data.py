@@ -0,0 +1,225 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.geofunctions_utils import distance_between_latlon_coords, get_latitude_longitude_as_dd
+from utils.preprocessing_AKBM_catch_data import ParseCache, _parse_wind_values, coalesce_first_valid, coerce_numeric, \
+    correct_position, feature_engineering_catch_data, parse_positions, split_wind_string, split_wind_strings, \
+    trajectory_features
+
+
+def expected_wind(wind_string):
+    """
+    (direction, speed) of the per-row split_wind_string (sequential replacements), None if it raises
+    """
+    try:
+        result = split_wind_string(wind_string)
+    except ValueError:
+        return None
+    return result if result is not None else (None, None)
+
+
+def assert_same_as_split_wind_string(wind_strings):
+    wind_strings = pd.Series(wind_strings, dtype=object)
+    df_wind = split_wind_strings(wind_strings)
+    for i, wind_string in enumerate(wind_strings):
+        expected = expected_wind(wind_string)
+        if expected is None:
+            continue
+        direction, speed = df_wind['Wind direction'].iloc[i], df_wind['Wind speed (kn)'].iloc[i]
+        assert (expected[0] is None and pd.isna(direction)) or expected[0] == direction, wind_string
+        assert (expected[1] is None and np.isnan(speed)) or expected[1] == speed \
+            or (np.isnan(expected[1]) and np.isnan(speed)), wind_string
+
+
+@pytest.mark.parametrize('wind_string, expected', [
+    ('S-SSE 10 kts', ('SE', 10.0)),
+    ('E-SSE 12', ('SE', 12.0)),
+    ('N-NNE 5 knots', ('NE', 5.0)),
+    ('W-WSW 20kts', ('SW', 20.0)),
+    ('ENE-NE 15', ('NNE', 15.0)),
+    ('WSW 15 kts', ('SW', 15.0)),
+    ('East-20knots', ('E', 20.0)),
+    ('Nice and calm', ('Calm', np.nan)),
+    ('12,5', (None, 12.5)),
+])
+def test_split_wind_strings_chained_replacements(wind_string, expected):
+    assert expected_wind(wind_string)[0] == expected[0]
+    df_wind = split_wind_strings(pd.Series([wind_string]))
+    assert (pd.isna(df_wind['Wind direction'][0]) and expected[0] is None) or df_wind['Wind direction'][0] == expected[0]
+    np.testing.assert_equal(df_wind['Wind speed (kn)'][0], expected[1])
+
+
+def test_split_wind_strings_equals_split_wind_string_fuzzed():
+    rng = np.random.default_rng(0)
+    parts = ['N', 'S', 'E', 'W', 'NE', 'SSE', 'E-SE', 'S-', '-', 'North', 'East', 'South', 'West', 'calm',
+             'Nice and calm', 'wind', 'kts', 'knots', 'Knots', 'kots', 'kn', ' ', '10', '5,5', '12.0', 'x']
+    wind_strings = [''.join(rng.choice(parts, size=rng.integers(1, 6))) for _ in range(5000)]
+    wind_strings += [''.join(combination) for combination in itertools.product(['N', 'S', 'E', 'W', '-'], repeat=4)]
+    wind_strings += ['', None, np.nan, 5.0]
+    assert_same_as_split_wind_string(wind_strings)
+
+
+def test_parse_positions_equals_correct_position_fuzzed():
+    rng = np.random.default_rng(0)
+    parts = ['60', '°', 'º', '48', 'S', ' ', 'W', '045', '3012', "'", "''", '.', ',', '-', 'xx', '7', '75', 'N',
+             '\u2003', '00']
+    positions = [''.join(rng.choice(parts, size=rng.integers(0, 12))) for _ in range(5000)]
+    positions += ['60°48S 45°30W', '60°48S4530°W', "63°12'50''S 58°11'50''W", 'xx°xxS xx°xxW', '60º75S 45º61W',
+                  '00º00S 00º00W', '', None, np.nan]
+    expected = []
+    for position in positions:
+        try:
+            corrected = correct_position(position)
+        except ValueError:
+            continue
+        latlon = get_latitude_longitude_as_dd(corrected) if corrected is not None else (np.nan, np.nan)
+        expected.append((position, corrected) + tuple(latlon))
+
+    position, latitude, longitude = parse_positions(pd.Series([row[0] for row in expected]))
+    assert list(position) == [row[1] for row in expected]
+    np.testing.assert_array_equal(latitude, [row[2] for row in expected])
+    np.testing.assert_array_equal(longitude, [row[3] for row in expected])
+    assert position.notna().sum() > 100
+
+
+@pytest.mark.parametrize('values', [pd.Series([], dtype=object), np.array([], dtype=object), []])
+def test_parse_cache_empty_values(values):
+    cache = ParseCache(_parse_wind_values, 2)
+    df_parsed = cache.parse(values)
+    assert df_parsed.empty and list(df_parsed.columns) == [0, 1]
+    assert cache.hits == 0 and cache.misses == 0
+
+
+def test_parse_cache_parses_distinct_values_once():
+    calls = []
+    cache = ParseCache(lambda values: calls.append(list(values)) or [(value, len(str(value))) for value in values], 2)
+    df_parsed = cache.parse(pd.Series(['N 10', 'S 5', 'N 10', None, np.nan], dtype=object))
+    assert calls == [['N 10', 'S 5', None, np.nan]]
+    assert list(df_parsed[1]) == [4, 3, 4, 4, 3]
+    cache.parse(['S 5', 'E 2'])
+    assert calls[-1] == ['E 2'] and (cache.hits, cache.misses) == (2, 5)
+
+
+def baseline_cols_to_float(values):
+    """
+    The cols_to_float loop before coerce_numeric: sequential replacements in str(value) and pd.to_numeric
+    """
+    values = pd.Series(values)
+    for org, replacement in {'-': '', ' ': '', ',': '.', 'nan': '', '%': '', 'ND': ''}.items():
+        values = values.apply(lambda x: str(x).replace(org, replacement))
+    return pd.to_numeric(values)
+
+
+@pytest.mark.parametrize('values', [
+    pd.Series(['12', '-3', '1 200', '4,5', '87 %', 'ND', 'N D', 'n-an', np.nan, '7'], dtype=object),
+    pd.Series(['12', '3', '1 200', '7'], dtype=object),
+    pd.Series([12, -3, 0, 7]),
+    pd.Series([12.5, -3.0, np.nan, 1e-5]),
+    pd.Series([12, '-3', 4.5, '2e-5', 1e-7], dtype=object),
+])
+def test_coerce_numeric_equals_cols_to_float(values):
+    expected = baseline_cols_to_float(values).astype(float)
+    numbers = coerce_numeric(values, {})
+    assert numbers.dtype == np.float64
+    pd.testing.assert_series_equal(numbers, expected, check_names=False)
+    # values the baseline raised on are missing
+    assert np.isnan(coerce_numeric(pd.Series([None, 'abc'], dtype=object))).all()
+
+
+def test_coalesce_first_valid_equals_row_loop():
+    rng = np.random.default_rng(2)
+    # krill size, the first positive value of the two columns, as in the row loop of clean_catch_data
+    first, second = rng.choice([np.nan, -1.0, 0.0, 30.5, 42.0], (2, 500))
+    expected = []
+    for value_1, value_2 in zip(first, second):
+        expected.append(value_1 if value_1 > 0 else value_2 if value_2 > 0 else np.nan)
+    values = coalesce_first_valid([first, second], is_valid=lambda values: values > 0)
+    assert values.dtype == np.float64
+    np.testing.assert_array_equal(values, expected)
+
+    # wind direction, the first value that is not null
+    first = np.array(rng.choice(['N', 'SE', None, np.nan], 500), dtype=object)
+    second = np.array(rng.choice(['W', None, np.nan], 500), dtype=object)
+    expected = []
+    for value_1, value_2 in zip(first, second):
+        expected.append(value_1 if not pd.isnull(value_1) else value_2 if not pd.isnull(value_2) else None)
+    values = coalesce_first_valid([first, second])
+    assert [value if not pd.isnull(value) else None for value in values] == expected
+    assert values.isna().any() and values.notna().sum() > 250
+
+
+def make_catch_data(n=600, vessels=('Antarctic Sea', 'Saga Sea', 'Antarctic Endurance', 'New Vessel'), seed=1):
+    rng = np.random.default_rng(seed)
+    vessel = rng.choice(list(vessels), n)
+    day = np.zeros(n, dtype=np.int64)
+    for name in vessels:
+        on_vessel = vessel == name
+        day[on_vessel] = rng.choice(2 * n, on_vessel.sum(), replace=False)
+    return pd.DataFrame({'Vessel': vessel,
+                         'Date': pd.Timestamp('2015-01-01') + pd.to_timedelta(day, 'D'),
+                         'Latitude': rng.uniform(-65, -53, n),
+                         'Longitude': rng.uniform(-60, -35, n)})
+
+
+def test_feature_engineering_catch_data_returns_baseline_tuple():
+    df = make_catch_data()
+    df_catch_Antarctic, df_catch_Saga, df_catch_Endurance = feature_engineering_catch_data(df)
+
+    for df_vessel, vessel in [(df_catch_Antarctic, 'Antarctic Sea'), (df_catch_Saga, 'Saga Sea'),
+                              (df_catch_Endurance, 'Antarctic Endurance')]:
+        assert isinstance(df_vessel, pd.DataFrame)
+        expected = df[df['Vessel'] == vessel].sort_values(by=['Date'])
+        assert list(df_vessel.index) == list(expected.index)
+
+        # the per-row computation of the baseline
+        days = (expected['Date'] - expected['Date'].shift()).map(lambda x: x.days)
+        np.testing.assert_array_equal(df_vessel['Days since last report'].values, days.values.astype(float))
+        latlons = expected[['Latitude', 'Longitude']].values
+        distances = np.zeros(len(expected))
+        for i in range(1, len(expected)):
+            if days.iloc[i] == 1:
+                distances[i] = distance_between_latlon_coords(latlons[i, 0], latlons[i, 1], latlons[i - 1, 0],
+                                                              latlons[i - 1, 1])
+        np.testing.assert_allclose(df_vessel['Distance since yesterday'].values, distances, rtol=1e-12, atol=1e-9)
+
+
+def test_feature_engineering_catch_data_other_outputs():
+    df = make_catch_data()
+    df_vessels = feature_engineering_catch_data(df, vessels=None)
+    assert sorted(df_vessels) == ['Antarctic Endurance', 'Antarctic Sea', 'New Vessel', 'Saga Sea']
+    assert len(feature_engineering_catch_data(df, per_vessel=False)) == len(df)
+
+    df_catch_Antarctic, df_catch_Saga, df_catch_Endurance = feature_engineering_catch_data(
+        df[df['Vessel'] != 'Antarctic Endurance'])
+    assert df_catch_Endurance.empty and not df_catch_Antarctic.empty
+
+
+def test_trajectory_features_dwell_segments():
+    # one vessel: days 1-3 within 1 km of the day before, a 50 km move on day 4, day 5 close, a gap to day 7
+    days = [1, 2, 3, 4, 5, 7, 1, 2]
+    latitude = [-60.0, -60.009, -60.018, -60.468, -60.477, -60.486, -55.0, -55.5]
+    df = pd.DataFrame({'Vessel': ['Saga Sea'] * 6 + ['Antarctic Sea'] * 2,
+                       'Date': pd.Timestamp('2019-02-28') + pd.to_timedelta(days, 'D'),
+                       'Latitude': latitude, 'Longitude': -45.0})
+    df_trajectory = trajectory_features(df.iloc[::-1], min_dwell_days=2)
+
+    assert list(df_trajectory.index) == [6, 7, 0, 1, 2, 3, 4, 5]
+    np.testing.assert_array_equal(df_trajectory['Dwell segment'], [0, 1, 2, 2, 2, 3, 3, 4])
+    np.testing.assert_array_equal(df_trajectory['Dwell days'], [1, 1, 3, 3, 3, 2, 2, 1])
+    np.testing.assert_array_equal(df_trajectory['Stationary fishing'], [False, False, True, True, True, True, True,
+                                                                        False])
+
+    # the per-report quantities of each vessel, from its previous report
+    for vessel, df_vessel in trajectory_features(df, per_vessel=True).items():
+        latlons = df_vessel[['Latitude', 'Longitude']].values
+        distances = [0.0] + [distance_between_latlon_coords(*latlons[i - 1], *latlons[i])
+                             for i in range(1, len(latlons))]
+        np.testing.assert_allclose(df_vessel['Distance since last report'], distances, atol=1e-9)
+        np.testing.assert_allclose(df_vessel['Cumulative distance'], np.cumsum(distances), atol=1e-9)
+        hours = df_vessel['Date'].diff().dt.total_seconds().values / 3600
+        np.testing.assert_allclose(df_vessel['Speed (kn)'].values[1:], np.array(distances[1:]) / 1.852 / hours[1:])
+        assert np.isnan(df_vessel['Bearing since last report'].values[0])
+        np.testing.assert_allclose(df_vessel['Bearing since last report'].values[1:], 180)
@@ -0,0 +1,201 @@
+"""
+Local bathymetry raster and batch depth lookup for catch positions.
+
+A bathymetry extract (e.g. SRTM30 from http://coastwatch.pfeg.noaa.gov/erddap/griddap/usgsCeSrtm30v6.html,
+as CSV with columns latitude, longitude, topo or as NetCDF) is converted once to a compact int16 grid
+(depth.npy) with its metadata (metadata.json), which is then opened memory-mapped:
+
+    ingest_bathymetry('../data/bathymetry/srtm30_48.csv', '../data/bathymetry/srtm30_48')
+    df_catch['Depth'] = depth_at(df_catch['Latitude'], df_catch['Longitude'], '../data/bathymetry/srtm30_48')
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# int16 value of grid cells without data
+NODATA = np.iinfo(np.int16).min
+# largest deviation of a grid step from the mean step (relative), e.g. for axes written rounded to a CSV
+AXIS_TOLERANCE = 0.1
+
+
+def ingest_bathymetry(path, directory, variable='topo'):
+    """
+    Convert a bathymetry extract (.csv or .nc) to a grid in directory, see ingest_bathymetry_csv
+    and ingest_bathymetry_netcdf
+    """
+    if path.endswith('.nc') or path.endswith('.nc4'):
+        return ingest_bathymetry_netcdf(path, directory, variable)
+    return ingest_bathymetry_csv(path, directory, variable)
+
+
+def ingest_bathymetry_csv(path, directory, variable='topo'):
+    """
+    Convert a bathymetry CSV (one row per grid point with columns 'latitude', 'longitude' and
+    variable, as downloaded from ERDDAP, i.e. with a row of units below the header) to a grid.
+
+    Parameters
+    ----------
+        path -- string, path to the CSV file
+        directory -- string, directory for depth.npy and metadata.json
+        variable -- string, default 'topo', column with the elevation (m, negative below sea level)
+
+    Returns
+    -------
+        bathymetry -- Bathymetry, the grid opened from directory
+    """
+    df = pd.read_csv(path, usecols=['latitude', 'longitude', variable], dtype=str)
+    # the row of units (and any other text) gives NaN
+    df = df.apply(pd.to_numeric, errors='coerce').dropna()
+    latitude, longitude = np.unique(df['latitude'].values), np.unique(df['longitude'].values)
+
+    elevation = np.full((len(latitude), len(longitude)), NODATA, dtype=np.int16)
+    rows = np.searchsorted(latitude, df['latitude'].values)
+    columns = np.searchsorted(longitude, df['longitude'].values)
+    elevation[rows, columns] = np.round(df[variable].values).astype(np.int16)
+
+    return _save_grid(directory, elevation, latitude, longitude, source=os.path.basename(path))
+
+
+def ingest_bathymetry_netcdf(path, directory, variable='topo'):
+    """
+    Convert a bathymetry NetCDF file (variable on a latitude/longitude grid) to a grid, see
+    ingest_bathymetry_csv. Requires netCDF4.
+    """
+    from netCDF4 import Dataset
+
+    with Dataset(path) as dataset:
+        names = dataset.variables.keys()
+        latitude = np.asarray(dataset.variables['latitude' if 'latitude' in names else 'lat'][:], dtype='float64')
+        longitude = np.asarray(dataset.variables['longitude' if 'longitude' in names else 'lon'][:], dtype='float64')
+        values = np.ma.filled(np.ma.asarray(dataset.variables[variable][:], dtype='float64'), np.nan)
+
+    # sort the axes ascending, the grid is (latitude, longitude)
+    values = values[np.argsort(latitude)][:, np.argsort(longitude)]
+    elevation = np.where(np.isnan(values), NODATA, np.round(np.nan_to_num(values))).astype(np.int16)
+
+    return _save_grid(directory, elevation, np.sort(latitude), np.sort(longitude), source=os.path.basename(path))
+
+
+def _save_grid(directory, elevation, latitude, longitude, source):
+    """
+    Save the int16 grid and its metadata, the axes must be regular up to AXIS_TOLERANCE of the step
+    """
+    for name, axis in [('latitude', latitude), ('longitude', longitude)]:
+        if len(axis) > 2:
+            step = (axis[-1] - axis[0]) / (len(axis) - 1)
+            if np.abs(np.diff(axis) - step).max() > AXIS_TOLERANCE * abs(step):
+                raise ValueError("The {} axis of the bathymetry grid is not regular".format(name))
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'depth.npy'), elevation)
+    metadata = {'latitude': {'first': float(latitude[0]), 'last': float(latitude[-1]), 'n': len(latitude)},
+                'longitude': {'first': float(longitude[0]), 'last': float(longitude[-1]), 'n': len(longitude)},
+                'units': 'm', 'positive': 'up', 'nodata': int(NODATA), 'source': source}
+    with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return Bathymetry.open(directory)
+
+
+class Bathymetry():
+    """
+    Elevation grid (int16, m, negative below sea level) on regular latitude/longitude axes,
+    memory-mapped, with a vectorized depth lookup.
+
+    Parameters
+    ----------
+        elevation -- int16 array (n_latitude, n_longitude), NODATA for missing cells
+        metadata -- dict, the axes {'latitude': {'first', 'last', 'n'}, 'longitude': {...}}
+    """
+    _opened = {}
+
+    def __init__(self, elevation, metadata):
+        self.elevation = elevation
+        self.metadata = metadata
+        self.nodata = metadata.get('nodata', int(NODATA))
+        self.axes = [(metadata[name]['first'], metadata[name]['last'], metadata[name]['n'])
+                     for name in ['latitude', 'longitude']]
+
+    @classmethod
+    def open(cls, directory, mmap_mode='r'):
+        """
+        Open a grid saved by ingest_bathymetry
+        """
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        return cls(np.load(os.path.join(directory, 'depth.npy'), mmap_mode=mmap_mode), metadata)
+
+    @classmethod
+    def load_cached(cls, directory):
+        """
+        Grid of directory, opened only the first time
+        """
+        if directory not in cls._opened:
+            cls._opened[directory] = cls.open(directory)
+        return cls._opened[directory]
+
+    def _grid_position(self, values, axis):
+        """
+        Fractional grid index of the values on an axis (first, last, n), NaN outside the grid
+        """
+        first, last, n = axis
+        if n == 1:
+            return np.where(np.isclose(values, first), 0.0, np.nan)
+        position = (values - first) / ((last - first) / (n - 1))
+        # positions on a grid line (up to rounding) are exactly on it
+        position = np.where(np.abs(position - np.round(position)) < 1e-6, np.round(position), position)
+        # half a cell beyond the outer cells is still in the grid
+        return np.where((position >= -0.5) & (position <= n - 0.5), np.clip(position, 0, n - 1), np.nan)
+
+    def depth_at(self, lat, lon, method='nearest'):
+        """
+        Depth at the positions
+
+        Parameters
+        ----------
+            lat, lon -- arrays, positions in decimal degrees
+            method -- string, default 'nearest', depth of the nearest grid cell or 'bilinear'
+                interpolation between the four enclosing cells
+
+        Returns
+        -------
+            depth -- float array, depth (m) below sea level, negative on land; NaN outside the grid
+                and for missing cells (with 'bilinear', a missing cell with a weight)
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        row = self._grid_position(lat, self.axes[0])
+        column = self._grid_position(lon, self.axes[1])
+        outside = np.isnan(row) | np.isnan(column)
+        row, column = np.where(outside, 0, row), np.where(outside, 0, column)
+
+        if method == 'nearest':
+            cells = [(np.round(row).astype(np.intp), np.round(column).astype(np.intp), 1.0)]
+        elif method == 'bilinear':
+            row0 = np.minimum(np.floor(row).astype(np.intp), max(self.axes[0][2] - 2, 0))
+            column0 = np.minimum(np.floor(column).astype(np.intp), max(self.axes[1][2] - 2, 0))
+            row1 = np.minimum(row0 + 1, self.axes[0][2] - 1)
+            column1 = np.minimum(column0 + 1, self.axes[1][2] - 1)
+            row_weight, column_weight = row - row0, column - column0
+            cells = [(row0, column0, (1 - row_weight) * (1 - column_weight)),
+                     (row0, column1, (1 - row_weight) * column_weight),
+                     (row1, column0, row_weight * (1 - column_weight)),
+                     (row1, column1, row_weight * column_weight)]
+        else:
+            raise ValueError("method should be 'nearest' or 'bilinear', got '{}'".format(method))
+
+        elevation = np.zeros(len(lat))
+        for rows, columns, weight in cells:
+            values = self.elevation[rows, columns]
+            # missing cells only count where they have a weight
+            elevation += np.where(weight == 0, 0.0, weight * np.where(values == self.nodata, np.nan, values))
+        elevation[outside] = np.nan
+        return -elevation
+
+
+def depth_at(lat, lon, directory, method='nearest'):
+    """
+    Depth (m, below sea level) at the positions from the grid in directory (opened once),
+    see Bathymetry.depth_at
+    """
+    return Bathymetry.load_cached(directory).depth_at(lat, lon, method)
@@ -4,6 +4,7 @@ These are utils/helper functions for working with geospatial data, e.g. for coor
 from math import sin, cos, sqrt, atan2, radians
 import numpy as np
 import datetime
+import os
 import ephem
 from tempfile import TemporaryFile
 import re
@@ -14,6 +15,11 @@ import json
 # sys.path.append('/home/jupyter/catch/') # setting sys path to include project-root-folder
 # from utils.get_moon_phase import *
 
+# approximate radius of earth in km, used for the distances between coordinates
+R_EARTH = 6373.0
+# category of land in the NASA seaice data
+NASA_LAND_CATEGORY = 25
+
 def matrix_mask_from_seaicedata(seaice_data, data_source='NASA'):
     """
     Make matrix mask based on seaice data (numpy 2D array), i.e. a mask matrix giving where
@@ -23,35 +29,20 @@ def matrix_mask_from_seaicedata(seaice_data, data_source='NASA'):
     This follows the convention of numpys mask module, see
         https://docs.scipy.org/doc/numpy/reference/maskedarray.generic.html
 
+    For point queries (is land / is ice at positions) use LandMask.
+
     Arguments:
     ----------
         seaice_data -- numpy npzfile object with fields ['seaice', 'latitude', 'longitude', 'date]
         data_source -- string, default 'NASA', should be in ['NASA', 'ESA'] (meereisportal uses ESA)
             NASA seaice data is categorical, where category 25 is land
             ESA seaice data is numeric (0 to 100), where nan is land
-    """
-    data_dim = len(seaice_data['seaice'].shape)
-    if data_dim == 2:
-        temp_data = seaice_data['seaice']
-        #matrix_mask = ( == land_category)
-    elif data_dim == 3:
-        temp_data = seaice_data['seaice'][:, :, 0]
-        #matrix_mask = ( == land_category)
-
-    # Make mask matrix
-    if data_source == 'NASA':
-        matrix_mask = (temp_data == 25)
-        #if data_dim == 2:
-        #    matrix_mask = (seaice_data['seaice'] == land_category)
-        #elif data_dim == 3:
-        #    matrix_mask = (seaice_data['seaice'][:, :, 0] == land_category)
-    elif data_source == 'ESA':
-        matrix_mask = np.isnan(temp_data)
-    matrix_mask = matrix_mask * 1
 
-    #print(matrix_mask.shape)
-    #print(np.sum(matrix_mask.ravel()))
-    #print(matrix_mask)
+    Returns:
+    --------
+        mask_npz -- numpy NpzFile with fields ['mask' (int array, 1 on land), 'latitude', 'longitude']
+    """
+    matrix_mask = land_mask_from_seaice(seaice_data['seaice'], data_source) * 1
 
     # Combine it with latitude and longitude in a numpy NpzFile
     outfile = TemporaryFile()
@@ -64,17 +55,181 @@ def matrix_mask_from_seaicedata(seaice_data, data_source='NASA'):
     return mask_npz
 
 
-def get_location_temperature(lat, lon, date, data=None, datapath='../data/satellite_data/temperature.npz'):
+def land_mask_from_seaice(seaice, data_source='NASA'):
+    """
+    Bool matrix, True where there is land, from seaice data (2D, or 3D with the dates on the
+    last axis, then the first date is used), see matrix_mask_from_seaicedata
+    """
+    seaice = np.asarray(seaice)
+    if seaice.ndim == 3:
+        seaice = seaice[:, :, 0]
+    if data_source == 'NASA':
+        return seaice == NASA_LAND_CATEGORY
+    elif data_source == 'ESA':
+        return np.isnan(seaice)
+    raise ValueError("data_source should be in ['NASA', 'ESA'], got '{}'".format(data_source))
+
+
+def _lookup_bits(bits, index):
+    """
+    Values (bool) at the flat indices of a matrix packed with np.packbits(matrix.ravel())
+    """
+    return ((bits[index >> 3] >> (7 - (index & 7))) & 1).astype(bool)
+
+
+class LandMask():
+    """
+    Land and sea ice masks of seaice data, kept bit-packed in memory, for fast queries of
+    many positions at once, e.g.
+
+        land_mask = LandMask.from_seaicedata(np.load('../data/satellite_data/seaice.npz'), data_source='ESA')
+        on_land = land_mask.is_land(df_catch['Latitude'], df_catch['Longitude'])
+        in_ice = land_mask.is_ice(df_catch['Latitude'], df_catch['Longitude'], df_catch['Date'])
+
+    A position is looked up in the nearest grid cell: on regular grids by searchsorted on the
+    latitude and longitude axes, on other grids (e.g. polar stereographic) with a k-d tree on
+    the unit vectors of the cells (see latlon_to_unit_vectors).
+
+    Parameters
+    ----------
+        seaice -- array (n_rows, n_columns) or (n_rows, n_columns, n_dates), seaice data
+            NASA seaice data is categorical, where category 25 is land (and 0 is open water)
+            ESA seaice data is numeric (0 to 100), where nan is land
+        latitude, longitude -- arrays, the grid, either axes (1D) or one value per cell (2D)
+        dates -- array (n_dates,) of datetime64, default None, dates of the seaice data
+        data_source -- string, default 'NASA', should be in ['NASA', 'ESA']
+        ice_threshold -- float, default None, a cell (not land) is ice where seaice >= ice_threshold,
+            None gives 15 (% concentration) for ESA and 1 (any category but open water) for NASA
+    """
+    def __init__(self, seaice, latitude, longitude, dates=None, data_source='NASA', ice_threshold=None):
+        if data_source not in ['NASA', 'ESA']:
+            raise ValueError("data_source should be in ['NASA', 'ESA'], got '{}'".format(data_source))
+        self.seaice = seaice
+        self.data_source = data_source
+        self.ice_threshold = ice_threshold if ice_threshold is not None else (1 if data_source == 'NASA' else 15)
+        self.dates = None if dates is None else np.asarray(dates, dtype='datetime64[ns]').ravel()
+        self.shape = seaice.shape[:2]
+
+        land = land_mask_from_seaice(seaice, data_source)
+        self._land_bits = np.packbits(land.ravel())
+        self._ice_bits = {}  # packed ice mask per date index
+
+        self._set_grid(np.asarray(latitude, dtype='float64'), np.asarray(longitude, dtype='float64'))
+
+    @classmethod
+    def from_seaicedata(cls, seaice_data, data_source='NASA', ice_threshold=None):
+        """
+        LandMask of a seaice npzfile object with fields ['seaice', 'latitude', 'longitude'] and optionally 'date'
+        """
+        seaice = np.asarray(seaice_data['seaice'])
+        dates = seaice_data['date'] if seaice.ndim == 3 and 'date' in seaice_data else None
+        return cls(seaice, seaice_data['latitude'], seaice_data['longitude'], dates, data_source, ice_threshold)
+
+    def _set_grid(self, latitude, longitude):
+        """
+        Index the grid, with axes if it is regular and else with a k-d tree
+        """
+        self.row_axis = self.column_axis = self.tree = None
+        if latitude.ndim == 1 and longitude.ndim == 1:
+            if (len(latitude), len(longitude)) == self.shape:
+                self.row_axis, self.column_axis = ('latitude', latitude), ('longitude', longitude)
+            elif (len(longitude), len(latitude)) == self.shape:
+                self.row_axis, self.column_axis = ('longitude', longitude), ('latitude', latitude)
+            else:
+                raise ValueError("Grid axes of length {} and {} do not match seaice of shape {}".format(
+                    len(latitude), len(longitude), self.shape))
+        elif np.all(latitude == latitude[:, :1]) and np.all(longitude == longitude[:1, :]):
+            self.row_axis, self.column_axis = ('latitude', latitude[:, 0]), ('longitude', longitude[0, :])
+        elif np.all(latitude == latitude[:1, :]) and np.all(longitude == longitude[:, :1]):
+            self.row_axis, self.column_axis = ('longitude', longitude[:, 0]), ('latitude', latitude[0, :])
+        else:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(latlon_to_unit_vectors(latitude.ravel(), longitude.ravel()))
+
+    def cell_index(self, lat, lon):
+        """
+        Flat index (into the seaice grid) of the nearest cell of each position
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        if self.tree is not None:
+            return self.tree.query(latlon_to_unit_vectors(lat, lon))[1]
+        position = {'latitude': lat, 'longitude': lon}
+        rows = _nearest_on_axis(self.row_axis[1], position[self.row_axis[0]])
+        columns = _nearest_on_axis(self.column_axis[1], position[self.column_axis[0]])
+        return rows * self.shape[1] + columns
+
+    def is_land(self, lat, lon):
+        """
+        Bool array, True for the positions (arrays lat, lon) on land (NaN positions are not)
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        missing = np.isnan(lat) | np.isnan(lon)
+        index = self.cell_index(np.where(missing, 0.0, lat), np.where(missing, 0.0, lon))
+        return _lookup_bits(self._land_bits, index) & ~missing
+
+    def is_ice(self, lat, lon, dates=None):
+        """
+        Bool array, True for the positions (arrays lat, lon) in sea ice on the dates (array of
+        datetime64, the nearest date of the seaice data is used; None for the first date)
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        missing = np.isnan(lat) | np.isnan(lon)
+        index = self.cell_index(np.where(missing, 0.0, lat), np.where(missing, 0.0, lon))
+
+        if dates is None or self.dates is None:
+            date_index = np.zeros(len(index), dtype=np.intp)
+        else:
+            dates = np.asarray(dates, dtype='datetime64[ns]').ravel()
+            missing |= np.isnat(dates)
+            dates = np.where(np.isnat(dates), self.dates[0], dates)
+            date_index = _nearest_on_axis(self.dates.astype('int64').astype('float64'),
+                                          dates.astype('int64').astype('float64'))
+
+        ice = np.zeros(len(index), dtype=bool)
+        for date in np.unique(date_index):
+            on_date = date_index == date
+            ice[on_date] = _lookup_bits(self.ice_bits(date), index[on_date])
+        return ice & ~missing
+
+    def ice_bits(self, date_index=0):
+        """
+        Packed ice mask of the seaice data on the date with index date_index, computed once per date
+        """
+        if date_index not in self._ice_bits:
+            seaice = self.seaice[:, :, date_index] if self.seaice.ndim == 3 else self.seaice
+            seaice = np.asarray(seaice, dtype='float64')
+            with np.errstate(invalid='ignore'):
+                ice = (seaice >= self.ice_threshold) & ~self.land
+            self._ice_bits[date_index] = np.packbits(ice.ravel())
+        return self._ice_bits[date_index]
+
+    @property
+    def land(self):
+        """
+        Bool matrix, True where there is land (as the mask of matrix_mask_from_seaicedata)
+        """
+        return np.unpackbits(self._land_bits, count=self.shape[0] * self.shape[1]).astype(bool).reshape(self.shape)
+
+
+def get_location_temperature(lat, lon, date=None, data=None, datapath='../data/satellite_data/temperature.npz'):
     """
     Function to extract temperature data for specific location (lat, lon)
     for a certain date (or time period).
 
+    The data file is only loaded the first time (see GriddedField), for many positions
+    at once use GriddedField.values_at directly.
+
     Parameters
     ----------
         lat, lon -- floats
             Position in (latitude, longitude) for which we want to extract temperature
-        date --
-        data -- numpy NpzFile (numpy.lib.npyio.NpzFile) object, default None
+        date -- datetime64 (or string 'YYYY-MM-DD'), default None
+            Date for which we want the temperature, if None the temperature on all dates is returned
+            (also when the data has no 'date' field, then date is ignored)
+        data -- numpy NpzFile (numpy.lib.npyio.NpzFile) object or GriddedField, default None
             Temperature data file with fields ['temperature', 'latitude',
             'longitude', 'date']
         datapath -- string, default '../data/satellite_data/temperature.npz'
@@ -82,7 +237,7 @@ def get_location_temperature(lat, lon, date, data=None, datapath='../data/satell
 
     Return
     ------
-        location_temp -- float
+        location_temp -- float (or float array with the temperature on each date, see date)
             Temperature at specified/wanted location
 
     Notes
@@ -93,20 +248,216 @@ def get_location_temperature(lat, lon, date, data=None, datapath='../data/satell
     """
     # Load data
     if data is None:
-        data = np.load(datapath)
-    temperature = data['temperature']   # Note - need to include filtering on date
-    latitude = data['latitude']
-    latitude_vector = latitude[0, :]
-    longitude = data['longitude']
-    longitude_vector = longitude[:, 0]
+        field = GriddedField.load_cached(datapath, 'temperature')
+    elif isinstance(data, GriddedField):
+        field = data
+    else:
+        field = GriddedField.from_npz(data, 'temperature')
 
     # Find data for specified position
-    index_row = np.argmin(np.abs(longitude_vector - lon))
-    index_col = np.argmin(np.abs(latitude_vector - lat))
+    dates = None if date is None or field.dates is None else [date]
+    return field.values_at([lat], [lon], dates)[0]
+
+
+def _nearest_on_axis(axis, values):
+    """
+    Index of the nearest element of axis (sorted, ascending or descending) for each of the values,
+    ties go to the first element as with np.argmin(np.abs(axis - value))
+    """
+    descending = len(axis) > 1 and axis[0] > axis[-1]
+    ascending_axis = axis[::-1] if descending else axis
+    upper = np.clip(np.searchsorted(ascending_axis, values), 1, max(len(axis) - 1, 1))
+    lower = upper - 1
+    if len(axis) == 1:
+        return np.zeros(len(values), dtype=np.intp)
+    distance_lower = np.abs(values - ascending_axis[lower])
+    distance_upper = np.abs(ascending_axis[upper] - values)
+    if descending:
+        index = np.where(distance_upper <= distance_lower, upper, lower)
+        return len(axis) - 1 - index
+    return np.where(distance_lower <= distance_upper, lower, upper)
+
+
+def _bracket_on_axis(axis, values):
+    """
+    Indices (i, i + 1) of the axis elements enclosing each of the values and the weight of i + 1,
+    for linear interpolation (clamped at the ends of the axis)
+    """
+    if len(axis) == 1:
+        zeros = np.zeros(len(values), dtype=np.intp)
+        return zeros, zeros, np.zeros(len(values))
+    descending = axis[0] > axis[-1]
+    ascending_axis = axis[::-1] if descending else axis
+    values = np.clip(values, ascending_axis[0], ascending_axis[-1])
+    upper = np.clip(np.searchsorted(ascending_axis, values), 1, len(axis) - 1)
+    lower = upper - 1
+    weight = (values - ascending_axis[lower]) / (ascending_axis[upper] - ascending_axis[lower])
+    if descending:
+        return len(axis) - 1 - lower, len(axis) - 1 - upper, weight
+    return lower, upper, weight
+
+
+class GriddedField():
+    """
+    Satellite raster (e.g. temperature) on a latitude/longitude grid with an optional date axis,
+    opened once and queried for whole arrays of positions (and dates), e.g.
+
+        GriddedField.from_npz('../data/satellite_data/temperature.npz', 'temperature').save('../data/temperature')
+        field = GriddedField.open('../data/temperature')   # memory-mapped
+        df_catch['Temperature'] = field.values_at(df_catch['Latitude'], df_catch['Longitude'], df_catch['Date'])
 
-    location_temp = temperature[index_row, index_col, :]
+    Parameters
+    ----------
+        values -- array (n_longitude, n_latitude) or (n_longitude, n_latitude, n_dates), the layout of
+            the satellite .npz files
+        latitude -- array (n_latitude,), sorted (ascending or descending) latitudes of the grid
+        longitude -- array (n_longitude,), sorted longitudes of the grid
+        dates -- array (n_dates,) of datetime64, default None, sorted dates of the grid (if None, a date
+            axis of the values is kept unlabelled: values on all dates can be read, but not looked up by date)
+    """
+    _loaded = {}
+
+    def __init__(self, values, latitude, longitude, dates=None):
+        self.values = values
+        self.latitude = np.asarray(latitude, dtype='float64')
+        self.longitude = np.asarray(longitude, dtype='float64')
+        self.dates = None if dates is None else np.asarray(dates, dtype='datetime64[ns]')
+        expected = (len(self.longitude), len(self.latitude))
+        if self.dates is not None:
+            expected += (len(self.dates),)
+        elif values.ndim == 3:
+            expected += values.shape[2:]
+        if values.shape != expected:
+            raise ValueError("values have shape {}, expected {} (longitude, latitude[, date])".format(
+                values.shape, expected))
+
+    @classmethod
+    def from_npz(cls, data, field='temperature'):
+        """
+        GriddedField of a field in a satellite .npz file (path or NpzFile) with fields [field,
+        'latitude', 'longitude'] and optionally 'date' (without it the date axis is unlabelled), loaded in memory
+        """
+        if isinstance(data, str):
+            data = np.load(data)
+        latitude, longitude = np.asarray(data['latitude']), np.asarray(data['longitude'])
+        if latitude.ndim == 2:
+            latitude = latitude[0, :]
+        if longitude.ndim == 2:
+            longitude = longitude[:, 0]
+        values = np.asarray(data[field])
+        dates = None
+        if values.ndim == 3 and 'date' in data:
+            dates = np.asarray(data['date']).ravel().astype('datetime64[ns]')
+        return cls(values, latitude, longitude, dates)
+
+    @classmethod
+    def load_cached(cls, path, field='temperature'):
+        """
+        GriddedField of a .npz file (see from_npz) or a directory (see open), loaded only the first time
+        """
+        key = (path, field)
+        if key not in cls._loaded:
+            cls._loaded[key] = cls.open(path) if not path.endswith('.npz') else cls.from_npz(path, field)
+        return cls._loaded[key]
+
+    def save(self, directory):
+        """
+        Save the field as uncompressed .npy files in directory, to be opened memory-mapped with open
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'values.npy'), np.ascontiguousarray(self.values))
+        np.save(os.path.join(directory, 'latitude.npy'), self.latitude)
+        np.save(os.path.join(directory, 'longitude.npy'), self.longitude)
+        if self.dates is not None:
+            np.save(os.path.join(directory, 'dates.npy'), self.dates)
+        return self
+
+    @classmethod
+    def open(cls, directory, mmap_mode='r'):
+        """
+        Open a field saved with save, the values are memory-mapped (only the cells queried are read)
+        """
+        dates_path = os.path.join(directory, 'dates.npy')
+        return cls(np.load(os.path.join(directory, 'values.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, 'latitude.npy')),
+                   np.load(os.path.join(directory, 'longitude.npy')),
+                   np.load(dates_path) if os.path.exists(dates_path) else None)
+
+    def select_dates(self, start=None, end=None):
+        """
+        GriddedField with the dates from start to end (both included), a view on the values
+        """
+        if self.dates is None:
+            raise ValueError("GriddedField has no dates to select from")
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'ns'), side='left')
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'ns'), side='right')
+        return GriddedField(self.values[:, :, first:last], self.latitude, self.longitude, self.dates[first:last])
+
+    def cell_index(self, lat, lon):
+        """
+        Indices (longitude index, latitude index) of the nearest grid cell of each position
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        return _nearest_on_axis(self.longitude, lon), _nearest_on_axis(self.latitude, lat)
+
+    def date_index(self, dates):
+        """
+        Index of the nearest date on the date axis of each date
+        """
+        if self.dates is None:
+            raise ValueError("GriddedField has no dates to look up dates on")
+        dates = np.asarray(dates, dtype='datetime64[ns]').ravel().astype('int64').astype('float64')
+        return _nearest_on_axis(self.dates.astype('int64').astype('float64'), dates)
+
+    def values_at(self, lat, lon, dates=None, method='nearest'):
+        """
+        Values of the field at the positions (and dates)
+
+        Parameters
+        ----------
+            lat, lon -- arrays (n,), positions in decimal degrees
+            dates -- array (n,) of datetime64, default None, the nearest date on the date axis is used
+                (if None and the field has a date axis, the values on all dates are returned; ignored
+                if the field has no date axis, a ValueError if the date axis has no dates)
+            method -- string, default 'nearest', value of the nearest grid cell or 'bilinear' interpolation
+                between the four enclosing cells (NaN cells, e.g. land, give NaN)
+
+        Returns
+        -------
+            values -- float array (n,), or (n, n_dates) if the field has a date axis and dates is None;
+                NaN for positions with NaN coordinates (or NaT dates)
+        """
+        lat = np.asarray(lat, dtype='float64').ravel()
+        lon = np.asarray(lon, dtype='float64').ravel()
+        missing = np.isnan(lat) | np.isnan(lon)
+        if dates is not None and self.values.ndim == 3:
+            if self.dates is None:
+                raise ValueError("GriddedField has no dates to look up dates on")
+            dates = np.asarray(dates, dtype='datetime64[ns]').ravel()
+            missing |= np.isnat(dates)
+            date_index = (self.date_index(np.where(np.isnat(dates), self.dates[0], dates)),)
+        else:
+            date_index = ()
+        lat, lon = np.where(missing, 0.0, lat), np.where(missing, 0.0, lon)
+
+        if method == 'nearest':
+            result = self.values[self.cell_index(lat, lon) + date_index].astype('float64')
+        elif method == 'bilinear':
+            lon0, lon1, lon_weight = _bracket_on_axis(self.longitude, lon)
+            lat0, lat1, lat_weight = _bracket_on_axis(self.latitude, lat)
+            if not date_index:
+                lon_weight, lat_weight = lon_weight.reshape((-1,) + (1,) * (self.values.ndim - 2)), \
+                                         lat_weight.reshape((-1,) + (1,) * (self.values.ndim - 2))
+            result = ((1 - lon_weight) * (1 - lat_weight) * self.values[(lon0, lat0) + date_index] +
+                      (1 - lon_weight) * lat_weight * self.values[(lon0, lat1) + date_index] +
+                      lon_weight * (1 - lat_weight) * self.values[(lon1, lat0) + date_index] +
+                      lon_weight * lat_weight * self.values[(lon1, lat1) + date_index])
+        else:
+            raise ValueError("method should be 'nearest' or 'bilinear', got '{}'".format(method))
 
-    return location_temp
+        result[missing] = np.nan
+        return result
 
 
 def get_latitude_longitude_as_dd(position):
@@ -219,7 +570,7 @@ def distance_between_latlon_coords(lat1, lon1, lat2, lon2):
         distance -- float, disctance between coordinates in (km)
     """
     # approximate radius of earth in km
-    R = 6373.0
+    R = R_EARTH
 
     lat1 = radians(lat1)
     lon1 = radians(lon1)
@@ -237,6 +588,199 @@ def distance_between_latlon_coords(lat1, lon1, lat2, lon2):
     return distance
 
 
+def _haversine_from_radians(lat1, lon1, cos_lat1, lat2, lon2, cos_lat2, R):
+    """
+    Haversine distance (same formula as distance_between_latlon_coords) from coordinates
+    in radians and the cosines of the latitudes, broadcasting over the arrays
+    """
+    a = np.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos_lat2 * np.sin((lon2 - lon1) / 2) ** 2
+    a = np.clip(a, 0, 1)
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def distance_between_latlon_arrays(lat1, lon1, lat2, lon2, dtype='float64'):
+    """
+    Compute distance in (km) between coordinates, element-wise over arrays (vectorized
+    distance_between_latlon_coords). The arrays are broadcast against each other, so
+    one of the positions can also be a single coordinate.
+
+    Parameters
+    ----------
+        lat1, lon1 -- floats or arrays, latitude and longitude for positions 1
+        lat2, lon2 -- floats or arrays, latitude and longitude for positions 2
+        dtype -- string, default 'float64', 'float32' halves the memory (relative accuracy ~1e-6)
+
+    Returns
+    -------
+        distance -- float array, distances between coordinates in (km)
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(value, dtype=dtype)) for value in (lat1, lon1, lat2, lon2)]
+    return _haversine_from_radians(lat1, lon1, np.cos(lat1), lat2, lon2, np.cos(lat2), np.asarray(R_EARTH, dtype))
+
+
+def distance_from_latlon_coord(lat, lon, latitudes, longitudes, dtype='float64'):
+    """
+    Compute distance in (km) from one coordinate to many coordinates.
+
+    Parameters
+    ----------
+        lat, lon -- floats, latitude and longitude for the position
+        latitudes, longitudes -- arrays, latitude and longitude for the other positions
+        dtype -- string, default 'float64', or 'float32'
+
+    Returns
+    -------
+        distance -- float array, distance from (lat, lon) to each of the positions in (km)
+    """
+    return distance_between_latlon_arrays(lat, lon, latitudes, longitudes, dtype=dtype)
+
+
+def latlon_to_unit_vectors(lat, lon, dtype='float64'):
+    """
+    Convert coordinates once to 3D unit vectors (earth centered, earth fixed, on the unit sphere).
+    The great circle distance between two positions is a monotonic function of the (Euclidean)
+    chord length between their vectors, so with chord_threshold a test "distance <= X km" needs
+    no trigonometry per pair, e.g. with a k-d tree over the vectors.
+
+    Parameters
+    ----------
+        lat, lon -- floats or arrays, latitude and longitude (decimal degrees)
+        dtype -- string, default 'float64', or 'float32' (chord accuracy ~1e-7, i.e. ~1 m)
+
+    Returns
+    -------
+        vectors -- C-contiguous float array (n, 3), the unit vectors (x, y, z)
+    """
+    lat = np.radians(np.asarray(lat, dtype='float64')).ravel()
+    lon = np.radians(np.asarray(lon, dtype='float64')).ravel()
+    cos_lat = np.cos(lat)
+    vectors = np.empty((len(lat), 3), dtype=dtype)
+    vectors[:, 0] = cos_lat * np.cos(lon)
+    vectors[:, 1] = cos_lat * np.sin(lon)
+    vectors[:, 2] = np.sin(lat)
+    return vectors
+
+
+def chord_threshold(distance, R=R_EARTH):
+    """
+    Chord length on the unit sphere of the great circle distance (km), i.e. the threshold on
+    the Euclidean distance between unit vectors (see latlon_to_unit_vectors)
+
+    Parameters
+    ----------
+        distance -- float or array, great circle distance in (km)
+        R -- float, default R_EARTH, earth radius in (km) of the distance
+
+    Returns
+    -------
+        chord -- float or array, in [0, 2]
+    """
+    return 2 * np.sin(np.clip(np.asarray(distance, dtype='float64') / (2 * R), 0, np.pi / 2))
+
+
+def distance_from_chord(chord, R=R_EARTH):
+    """
+    Great circle distance (km) of a chord length on the unit sphere, inverse of chord_threshold
+    """
+    return 2 * R * np.arcsin(np.clip(np.asarray(chord, dtype='float64') / 2, 0, 1))
+
+
+def within_distance_unit_vectors(vectors, vector, distance, R=R_EARTH):
+    """
+    Boolean mask of the positions (unit vectors) within distance (km) of the position vector,
+    tested on the squared chord length (no trigonometry)
+
+    Parameters
+    ----------
+        vectors -- float array (n, 3), unit vectors, see latlon_to_unit_vectors
+        vector -- float array (3,), unit vector of the position
+        distance -- float, great circle distance in (km)
+        R -- float, default R_EARTH, earth radius in (km)
+
+    Returns
+    -------
+        within -- bool array (n,)
+    """
+    difference = vectors - vector
+    return np.einsum('ij,ij->i', difference, difference) <= chord_threshold(distance, R) ** 2
+
+
+def bearing_between_latlon_arrays(lat1, lon1, lat2, lon2):
+    """
+    Compute the initial bearing (great circle course) from positions 1 to positions 2,
+    element-wise over arrays like distance_between_latlon_arrays.
+
+    Parameters
+    ----------
+        lat1, lon1 -- floats or arrays, latitude and longitude for positions 1
+        lat2, lon2 -- floats or arrays, latitude and longitude for positions 2
+
+    Returns
+    -------
+        bearing -- float array, bearing in degrees clockwise from north, in [0, 360)
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(value, dtype='float64')) for value in (lat1, lon1, lat2, lon2)]
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def pairwise_distance_latlon_blocks(lat1, lon1, lat2=None, lon2=None, block_size=1024, dtype='float64'):
+    """
+    Generator over blocks of the pairwise distance matrix in (km), so that the memory
+    used is bounded by block_size x block_size values. The coordinates are converted
+    to radians once, the cosines of the latitudes once per block.
+
+    Parameters
+    ----------
+        lat1, lon1 -- arrays, latitude and longitude for the rows
+        lat2, lon2 -- arrays, default None (same as lat1, lon1), latitude and longitude for the columns
+        block_size -- int, default 1024, number of rows and columns per block
+        dtype -- string, default 'float64', or 'float32'
+
+    Yields
+    ------
+        row_start, col_start, block -- ints and float array, block is the distance matrix of the
+            rows row_start:row_start + block.shape[0] and columns col_start:col_start + block.shape[1]
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=dtype))
+    lon1 = np.radians(np.asarray(lon1, dtype=dtype))
+    if lat2 is None:
+        lat2, lon2 = lat1, lon1
+    else:
+        lat2 = np.radians(np.asarray(lat2, dtype=dtype))
+        lon2 = np.radians(np.asarray(lon2, dtype=dtype))
+    R = np.asarray(R_EARTH, dtype)
+
+    for col_start in range(0, len(lat2), block_size):
+        cols = slice(col_start, col_start + block_size)
+        lat_cols, lon_cols = lat2[cols], lon2[cols]
+        cos_cols = np.cos(lat_cols)
+        for row_start in range(0, len(lat1), block_size):
+            rows = slice(row_start, row_start + block_size)
+            lat_rows = lat1[rows, np.newaxis]
+            block = _haversine_from_radians(lat_rows, lon1[rows, np.newaxis], np.cos(lat_rows),
+                                            lat_cols, lon_cols, cos_cols, R)
+            yield row_start, col_start, block
+
+
+def pairwise_distance_latlon(lat1, lon1, lat2=None, lon2=None, block_size=1024, dtype='float64'):
+    """
+    Compute the pairwise distance matrix in (km), filled block by block (see
+    pairwise_distance_latlon_blocks) so that no temporaries larger than a block are needed.
+
+    Returns
+    -------
+        distance -- float array (len(lat1), len(lat2)), distance[i, j] between position i of
+            (lat1, lon1) and position j of (lat2, lon2)
+    """
+    n_cols = len(lat1) if lat2 is None else len(lat2)
+    distance = np.empty((len(lat1), n_cols), dtype=dtype)
+    for row_start, col_start, block in pairwise_distance_latlon_blocks(lat1, lon1, lat2, lon2, block_size, dtype):
+        distance[row_start:row_start + block.shape[0], col_start:col_start + block.shape[1]] = block
+    return distance
+
+
 def get_phase_on_day(year, month, day):
     """
     Returns a floating-point number from 0-1. where 0=new, 0.5=full, 1=new
@@ -263,19 +807,121 @@ def get_moon_phase(date):
     """
     ephem.Moon().moon_phase command - returns the ratio of the moon which is illuminated.
     
-    date a string on the format 'mm/dd/YYYY'
+    date a string on the format 'mm/dd/YYYY' (or a datetime.date)
+
+    For many dates use LunationTable, which is much faster.
     """
-    
-    month = np.int(date[0:2])
-    day = np.int(date[3:5])
-    year = np.int(date[6:10])
-    
-    date = datetime.date(year, month, day)
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date.strip(), '%m/%d/%Y').date()
     moon = ephem.Moon(date)
 
     return moon.moon_phase
 
 
+# ephem dates are Dublin Julian Days, i.e. days since 1899-12-31 12:00 UT
+_EPHEM_EPOCH = np.datetime64('1899-12-31T12:00:00', 'us')
+
+
+def _to_ephem_days(dates):
+    """
+    Convert an array of datetime64 (or anything np.datetime64 accepts) to ephem dates (floats)
+    """
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    return (dates - _EPHEM_EPOCH) / np.timedelta64(1, 'D')
+
+
+class LunationTable():
+    """
+    Moon phases of many dates at once. The new moons and the illuminated fraction of the
+    Moon on a fine time grid are computed with ephem once for a date range, the phases of
+    the dates then follow with searchsorted and interpolation (within 1e-4 of ephem), e.g.
+
+        table = LunationTable.covering(df_catch['Date'].values)
+        df_catch['Moon phase'] = table.illuminated_fraction(df_catch['Date'].values)
+
+    Parameters
+    ----------
+        start, end -- datetime64 or datetime, first and last date of the range (UT)
+        step -- float, default 0.1, time step (days) of the illuminated fraction grid
+    """
+    _cached = None
+
+    def __init__(self, start, end, step=0.1):
+        self.start_date, self.end_date = np.asarray([start, end], dtype='datetime64[us]')
+        self.start, self.end = _to_ephem_days([self.start_date, self.end_date])
+        self.step = step
+
+        # new moons enclosing the range
+        new_moons = [float(ephem.previous_new_moon(self.start))]
+        while new_moons[-1] <= self.end:
+            new_moons.append(float(ephem.next_new_moon(new_moons[-1])))
+        self.new_moons = np.array(new_moons)
+
+        self.grid = self.start + step * np.arange(int(np.ceil((self.end - self.start) / step)) + 2)
+        self.fractions = np.array([ephem.Moon(ephem.Date(day)).moon_phase for day in self.grid])
+
+    @classmethod
+    def covering(cls, dates, step=0.1):
+        """
+        Table covering dates (array of datetime64), the last table is reused when it covers them
+        """
+        dates = np.asarray(dates, dtype='datetime64[us]')
+        dates = dates[~np.isnat(dates)]
+        if len(dates) == 0:
+            dates = np.asarray(['2000-01-01'], dtype='datetime64[us]')
+        start, end = dates.min(), dates.max()
+
+        table = cls._cached
+        if table is not None and table.step == step:
+            if table.start_date <= start and end <= table.end_date:
+                return table
+            start, end = min(start, table.start_date), max(end, table.end_date)
+        cls._cached = cls(start, end, step=step)
+        return cls._cached
+
+    def _days(self, dates):
+        days = _to_ephem_days(dates)
+        outside = (days < self.start) | (days > self.end)
+        if np.any(outside):
+            raise ValueError("Dates outside of the LunationTable range, use LunationTable.covering(dates)")
+        return days
+
+    def lunation(self, dates):
+        """
+        Fraction of the lunation (0 = new, 0.5 = full, 1 = new) of each date, as get_phase_on_day
+
+        Parameters
+        ----------
+            dates -- array of datetime64
+
+        Returns
+        -------
+            lunation -- float array, NaN for NaT
+        """
+        days = self._days(dates)
+        index = np.clip(np.searchsorted(self.new_moons, days, side='right'), 1, len(self.new_moons) - 1)
+        previous, following = self.new_moons[index - 1], self.new_moons[index]
+        return (days - previous) / (following - previous)
+
+    def illuminated_fraction(self, dates):
+        """
+        Illuminated fraction of the Moon (0-1) of each date, as get_moon_phase
+
+        Parameters
+        ----------
+            dates -- array of datetime64
+
+        Returns
+        -------
+            fraction -- float array, NaN for NaT
+        """
+        days = self._days(dates)
+        position = (days - self.start) / self.step
+        index = np.clip(np.floor(np.nan_to_num(position)).astype(np.intp), 0, len(self.grid) - 2)
+        weight = position - index
+        return (1 - weight) * self.fractions[index] + weight * self.fractions[index + 1]
+
+
 errMsg = ""
 
 def getUrl(date, coords):
@@ -366,6 +1012,15 @@ def getMoonPhase(date, coords, info):
     ApiUrl = getUrl(date, coords)
     dataString = getData(ApiUrl)
 
+    if dataString == "":
+        return errMsg
+    return moon_phase_info(dataString, info, date)
+
+
+def moon_phase_info(dataString, info, date=None):
+    """
+    Extract info ("moonphase" or "fracillum", see getMoonPhase) from the API response dataString (dict)
+    """
     if info=="moonphase":
         infoType = "curphase"
     elif info == "fracillum":
@@ -373,9 +1028,7 @@ def getMoonPhase(date, coords, info):
     else:
         infoType = "error"
 
-    if dataString == "":
-        return errMsg
-    elif infoType == "error":
+    if infoType == "error":
         return 'Desired datatype not specified. Choose "moonphase" or "fracillum" as the third argument.'
     else: # success!
         if dataString["curphase"]=="" and info == "moonphase": # (if "closestphase" occurs on date requested, "curphase" will not be in JSON)
@@ -0,0 +1,266 @@
+"""
+Batch client for the moon phase API used by getMoonPhase (see geofunctions_utils), e.g. to fill
+a fracillum column for all catch days:
+
+    client = MoonPhaseClient(cache_path='../data/moon_phase_cache.sqlite')
+    results = client.get_moon_phases(dates, coords, info='fracillum')
+
+The requests are made asynchronously, at most max_concurrency at a time over reused (keep-alive)
+connections, failed requests are retried with exponential backoff and every response is stored in
+an on-disk cache keyed by date and rounded coordinates, so that repeated feature builds make no
+network calls. Errors are returned per request (MoonPhaseResult.error) instead of in errMsg.
+
+Only the standard library is used (asyncio with http.client connections run in threads).
+"""
+import asyncio
+import datetime
+import http.client
+import json
+import re
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from utils.geofunctions_utils import moon_phase_info
+
+API_URL = 'https://api.usno.navy.mil/rstt/oneday'
+
+MoonPhaseResult = namedtuple('MoonPhaseResult', ['date', 'coords', 'value', 'error', 'from_cache'])
+MoonPhaseResult.__doc__ = """
+Result of one request: value (phase name or illuminated fraction) or error (message, value is None)
+"""
+
+_COORDS = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([NS])\s*,\s*(\d+(?:\.\d*)?)\s*([EW])\s*$', re.IGNORECASE)
+
+
+class MoonPhaseError(Exception):
+    """
+    Error response of the API, or a request that failed after all retries
+    """
+
+
+def format_date(date):
+    """
+    Date as the API expects it, 'm/d/YYYY' (date is a datetime.date/datetime, numpy datetime64 or such a string)
+    """
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date.strip(), '%m/%d/%Y')
+    elif not isinstance(date, datetime.date):
+        date = datetime.datetime.fromisoformat(str(date)[:10])
+    return '{}/{}/{}'.format(date.month, date.day, date.year)
+
+
+def format_coords(coords, decimals=2):
+    """
+    Coordinates as the API expects them, e.g. '59.54N,10.46E', rounded to decimals
+
+    Parameters
+    ----------
+        coords -- string on the format '59.54N,10.46E', or tuple (latitude, longitude) in decimal degrees
+        decimals -- int, default 2, number of decimals of the rounded coordinates
+
+    Returns
+    -------
+        coords -- string
+    """
+    if isinstance(coords, str):
+        match = _COORDS.match(coords)
+        if match is None:
+            raise ValueError("Coordinates '{}' not on the format '59.54N,10.46E'".format(coords))
+        lat = float(match.group(1)) * (-1 if match.group(2).upper() == 'S' else 1)
+        lon = float(match.group(3)) * (-1 if match.group(4).upper() == 'W' else 1)
+    else:
+        lat, lon = coords
+    lat, lon = round(float(lat), decimals), round(float(lon), decimals)
+    return '{:.{d}f}{},{:.{d}f}{}'.format(abs(lat), 'S' if lat < 0 else 'N', abs(lon), 'W' if lon < 0 else 'E',
+                                          d=decimals)
+
+
+def parse_response(body):
+    """
+    Parse the API response (bytes) to a dict, as getData, raise MoonPhaseError if the API reports an error
+    """
+    contents = json.loads(body.decode('utf-8').replace('\n', ''))
+    if contents.get('error', True) is not False:
+        raise MoonPhaseError(contents.get('type', 'An error happened while requesting data from the API. '
+                                                  'Check the format of the input variables.'))
+    # curphase is not given on the days of a closestphase, the same as in getData
+    contents.setdefault('curphase', '')
+    return contents
+
+
+class ResponseCache():
+    """
+    Persistent cache (sqlite) of the API responses, keyed by (date, coords)
+
+    Parameters
+    ----------
+        path -- string, sqlite file, default None keeps the cache in memory only
+    """
+    def __init__(self, path=None):
+        # the client uses the cache from one thread at a time, but not always the one that opened it
+        self.connection = sqlite3.connect(path if path is not None else ':memory:', check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(date TEXT, coords TEXT, response TEXT, PRIMARY KEY (date, coords))')
+
+    def get(self, date, coords):
+        row = self.connection.execute('SELECT response FROM responses WHERE date = ? AND coords = ?',
+                                      (date, coords)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, date, coords, response):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                                    (date, coords, json.dumps(response)))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class MoonPhaseClient():
+    """
+    Client for many moon phase requests at once (see the module docstring).
+
+    Parameters
+    ----------
+        url -- string, default API_URL, the API endpoint (e.g. a local stub server when testing)
+        cache_path -- string, default None, sqlite file of the response cache (None: in memory only)
+        max_concurrency -- int, default 8, maximum number of requests (and connections) at a time
+        retries -- int, default 3, number of retries of a failed request
+        backoff -- float, default 0.5, seconds before the first retry, doubled for each next retry
+        timeout -- float, default 10, seconds before a request times out
+        decimals -- int, default 2, decimals of the coordinates in the requests and the cache keys
+
+    Attributes
+    ----------
+        n_requests -- int, number of requests sent over the network (retries included)
+    """
+    def __init__(self, url=API_URL, cache_path=None, max_concurrency=8, retries=3, backoff=0.5, timeout=10,
+                 decimals=2):
+        parts = urlsplit(url)
+        self.scheme, self.host, self.port, self.path = parts.scheme, parts.hostname, parts.port, parts.path
+        self.cache = ResponseCache(cache_path)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.decimals = decimals
+        self.n_requests = 0
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, connection, date, coords):
+        """
+        Blocking GET on a (reused) connection, returns the status and the body
+        """
+        connection.request('GET', '{}?{}'.format(self.path, urlencode({'date': date, 'coords': coords, 'tz': 0})))
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    async def _fetch(self, date, coords, connections, executor):
+        """
+        Response (dict) for one (date, coords), from the cache or the API
+        """
+        response = self.cache.get(date, coords)
+        if response is not None:
+            return response, True
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            connection = await connections.get()
+            try:
+                self.n_requests += 1
+                status, body = await loop.run_in_executor(executor, self._request, connection, date, coords)
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()  # reconnects on the next request
+                message = 'Error while connecting to API: {}'.format(error)
+                continue
+            finally:
+                connections.put_nowait(connection)
+
+            if status == 429 or status >= 500:
+                message = 'API responded with status {}'.format(status)
+                continue
+            if status != 200:
+                raise MoonPhaseError('API responded with status {}'.format(status))
+            response = parse_response(body)
+            self.cache.set(date, coords, response)
+            return response, False
+        raise MoonPhaseError(message)
+
+    async def fetch_many(self, dates, coords, info='fracillum'):
+        """
+        Request info for all (date, coords) pairs, see get_moon_phases
+        """
+        if isinstance(coords, (str, tuple)):
+            coords = [coords] * len(dates)
+        keys = []
+        for date, coord in zip(dates, coords):
+            try:
+                keys.append((format_date(date), format_coords(coord, self.decimals)))
+            except (ValueError, TypeError) as error:
+                keys.append(error)
+
+        connections = asyncio.Queue()
+        for _ in range(self.max_concurrency):
+            connections.put_nowait(self._connect())
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            # one request per distinct key
+            unique_keys = list(dict.fromkeys(key for key in keys if isinstance(key, tuple)))
+            responses = await asyncio.gather(*[self._fetch(date, coord, connections, executor)
+                                               for date, coord in unique_keys], return_exceptions=True)
+        while not connections.empty():
+            connections.get_nowait().close()
+
+        responses = dict(zip(unique_keys, responses))
+        results = []
+        for key, date, coord in zip(keys, dates, coords):
+            if not isinstance(key, tuple):
+                results.append(MoonPhaseResult(date, coord, None, str(key), False))
+                continue
+            date, coord = key
+            response = responses[key]
+            if isinstance(response, Exception):
+                results.append(MoonPhaseResult(date, coord, None, str(response) or type(response).__name__, False))
+            else:
+                results.append(MoonPhaseResult(date, coord, moon_phase_info(response[0], info, date), None,
+                                               response[1]))
+        return results
+
+    def get_moon_phases(self, dates, coords, info='fracillum'):
+        """
+        Moon phase info for many dates (and coordinates), see getMoonPhase
+
+        Inside a running event loop (e.g. in Jupyter) the requests are made in a worker thread with
+        its own event loop; from async code use `await client.fetch_many(dates, coords, info)` instead.
+
+        Parameters
+        ----------
+            dates -- list of dates (datetime.date, datetime64 or string 'm/d/YYYY')
+            coords -- list of coordinates, one per date, or the same coordinates for all dates
+                (string '59.54N,10.46E' or tuple (latitude, longitude))
+            info -- string, "moonphase" (phase name) or "fracillum" (illuminated fraction), default "fracillum"
+
+        Returns
+        -------
+            results -- list of MoonPhaseResult, one per date
+        """
+        dates = list(dates)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.fetch_many(dates, coords, info))
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(lambda: asyncio.run(self.fetch_many(dates, coords, info))).result()
+
+    def close(self):
+        self.cache.close()
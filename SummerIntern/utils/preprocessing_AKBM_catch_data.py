@@ -1,29 +1,44 @@
 """
 Pre-processing and feature engineering of AKBM catch data, in particular on the aggregated dataset.
 """
+import re
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
-from utils.geofunctions_utils import get_latitude_longitude_as_dd, get_moon_phase, distance_between_latlon_coords
+from utils.geofunctions_utils import get_latitude_longitude_as_dd, distance_between_latlon_arrays, \
+    bearing_between_latlon_arrays, LunationTable
 
+KM_PER_NAUTICAL_MILE = 1.852
+# the vessels of the fleet, in the order feature_engineering_catch_data returns them
+AKBM_VESSELS = ('Antarctic Sea', 'Saga Sea', 'Antarctic Endurance')
 
-def clean_catch_data(df_catch):
+
+def clean_catch_data(df_catch, parse_caches=None, verbose=False):
     """
     Clean aggregated dataset.
     Note there are lots of hard-coded rules in this function, e.g. column names.
+
+    The free-text columns 'Position', 'Wind' and 'Krill Size (mm/ Gr)' are parsed through
+    ParseCaches, so each distinct string is parsed once (and not again in later calls).
     Parameters
     ----------
         df_catch -- pandas DataFrame, raw data
+        parse_caches -- dict, default None (PARSE_CACHES, shared between calls), ParseCache per free-text column
+        verbose -- bool, default False, print the hit rates of the parse caches
     Returns
     -------
         df_catch -- pandas DataFrame, cleaned data
     """
+    if parse_caches is None:
+        parse_caches = PARSE_CACHES
+
     # Make two new column; [latitude, longitude] which are taken from position column (in N W format)
-    df_catch['Position'] = df_catch['Position'].apply(lambda x: correct_position(x))
+    temp_df_position = parse_caches['Position'].parse(df_catch['Position'])
+    df_catch['Position'] = temp_df_position[0].values
+    df_catch['Latitude'] = temp_df_position[1].values.astype('float64')
+    df_catch['Longitude'] = temp_df_position[2].values.astype('float64')
     df_catch.dropna(subset=['Position'], inplace=True)   # Remove rows with missing position
     df_catch.reset_index(inplace=True, drop=True)
-    df_catch['latlon_tuple'] = df_catch['Position'].apply(lambda x: get_latitude_longitude_as_dd(x))
-    df_catch[['Latitude', 'Longitude']] = df_catch['latlon_tuple'].apply(pd.Series)
-    df_catch.drop(['latlon_tuple'], axis=1, inplace=True)
 
     # Change production day column to datetime
     for col in ['Date', 'Production day']:
@@ -31,92 +46,125 @@ def clean_catch_data(df_catch):
             df_catch[col] = pd.to_datetime(df_catch[col])
 
     # Change selected column types from object (strings) to numeric floats
-    dict_replace_chars = {'-': '', ' ': '', ',': '.', 'nan': '', '%': '', 'ND': ''}
-
     cols_to_float = ['Total catch Krill - Mt', 'Total Krill Meal Kg', 'Yield %',
                      'Krill Size (mm)', 'Krill weight (gram)']
+    cleaned_strings = {}  # shared between the columns
     for col in cols_to_float:
         if col in df_catch.columns:
-            for org, replacement in dict_replace_chars.items():
-                df_catch[col] = df_catch[col].apply(lambda x: str(x).replace(org, replacement))
-            df_catch[col] = pd.to_numeric(df_catch[col])
+            df_catch[col] = coerce_numeric(df_catch[col], cleaned_strings)
 
     # Extract krill weight and length from combined string column if it exists
     if 'Krill Size (mm/ Gr)' in df_catch.columns:
-        temp_df_size = df_catch['Krill Size (mm/ Gr)'].apply(lambda x: split_krill_size(x)).apply(pd.Series)
-        temp_df_size.rename(index=str, columns={0: "Krill Size (mm)", 1: "Krill weight (gram)"}, inplace=True)
+        temp_df_size = parse_caches['Krill Size (mm/ Gr)'].parse(df_catch['Krill Size (mm/ Gr)'])
+        temp_df_size.rename(columns={0: "Krill Size (mm)", 1: "Krill weight (gram)"}, inplace=True)
         for col in temp_df_size.columns:
             temp_df_size[col] = temp_df_size[col].astype('float64')
 
-        # Combine the two
-        array_length_1 = temp_df_size['Krill Size (mm)']
-        array_length_2 = df_catch['Krill Size (mm)']
-        array_weight_1 = temp_df_size['Krill weight (gram)']
-        array_weight_2 = df_catch['Krill weight (gram)']
-        array_combined = np.zeros([len(array_length_1), 2])
-
-        for i in range(len(array_length_1)):
-            # Set krill length to the one that is valid
-            if array_length_1[i] > 0:
-                array_combined[i, 0] = array_length_1[i]
-            elif array_length_2[i] > 0:
-                array_combined[i, 0] = array_length_2[i]
-            else:
-                array_combined[i, 0] = None
-
-            # Set krill weight to the one that is valid
-            if array_weight_1[i] > 0:
-                array_combined[i, 1] = array_weight_1[i]
-            elif array_weight_2[i] > 0:
-                array_combined[i, 1] = array_weight_2[i]
-            else:
-                array_combined[i, 1] = None
-        df_catch[['Krill Size (mm)', 'Krill weight (gram)']] = array_combined
+        # Combine the two, krill length and weight are set to the first one that is valid (positive)
+        for col in ['Krill Size (mm)', 'Krill weight (gram)']:
+            df_catch[col] = coalesce_first_valid([temp_df_size[col].values, df_catch[col].values.astype('float64')],
+                                                 is_valid=lambda values: values > 0).values
         df_catch.drop(['Krill Size (mm/ Gr)'], axis=1, inplace=True)
 
     # Extract wind direction and speed from combined column if it exists
     if 'Wind' in df_catch.columns:
-        temp_df_wind = df_catch['Wind'].apply(lambda x: split_wind_string(x)).apply(pd.Series)
-        temp_df_wind.rename(index=str, columns={0: "Wind direction", 1: "Wind speed (kn)"}, inplace=True)
-
-        # Combine the two
-        array_winddir_1 = temp_df_wind['Wind direction'].values
-        array_winddir_2 = df_catch['Wind direction'].values
-        winddirections = []
-        array_windspeed_1 = temp_df_wind['Wind speed (kn)'].values
-        array_windspeed_2 = df_catch['Wind speed (kn)'].values
-        windspeeds = [] #np.zeros([len(array_winddir_1), 2])
-
-        for i in range(len(array_winddir_1)):
-            # Set wind direction to the one that is valid
-            if pd.isnull(array_winddir_1[i]) is False:
-                winddir = array_winddir_1[i]
-            elif pd.isnull(array_winddir_2[i]) is False:
-                winddir = array_winddir_2[i]
-            else:
-                winddir = None
-            winddirections.append(winddir)
-
-            # Set krill weight to the one that is valid
-            if pd.isnull(array_windspeed_1[i]) is False:
-                windspeed = array_windspeed_1[i]
-            elif pd.isnull(array_windspeed_2[i]) is False:
-                windspeed = array_windspeed_2[i]
-            else:
-                windspeed = None
-            windspeeds.append(windspeed)
-        df_catch['Wind direction'] = winddirections
-        df_catch['Wind speed (kn)'] = windspeeds
+        temp_df_wind = parse_caches['Wind'].parse(df_catch['Wind'])
+        temp_df_wind.rename(columns={0: "Wind direction", 1: "Wind speed (kn)"}, inplace=True)
+
+        # Combine the two, wind direction and speed are set to the first one that is valid (not null)
+        for col in ['Wind direction', 'Wind speed (kn)']:
+            df_catch[col] = coalesce_first_valid([temp_df_wind[col].values, df_catch[col].values]).values
         df_catch.drop(['Wind'], axis=1, inplace=True)
 
     # Finally order by date
     df_catch.sort_values(by=["Date"], inplace=True)
     df_catch.reset_index(inplace=True, drop=True)
 
+    if verbose:
+        print(parse_cache_report(parse_caches))
+
     return df_catch
 
 
-def feature_engineering_catch_data(df_catch):
+def coalesce_first_valid(columns, is_valid=pd.notna):
+    """
+    Vectorized "first valid value" over columns, e.g. to merge a field that is given in
+    two columns: for each row the value of the first column that is valid in that row,
+    missing (NaN/None) if none of them is.
+
+    Parameters
+    ----------
+        columns -- list of arrays (or Series) of equal length, in order of priority
+        is_valid -- function, default pd.notna, vectorized predicate returning a boolean array
+            for the values of a column, e.g. lambda values: values > 0
+
+    Returns
+    -------
+        values -- pandas Series, with the dtype inferred from the values taken
+    """
+    columns = [np.asarray(column) for column in columns]
+    is_object = any(column.dtype == object for column in columns)
+    values = np.full(len(columns[0]), None if is_object else np.nan, dtype=object if is_object else 'float64')
+
+    missing = np.ones(len(values), dtype=bool)
+    for column in columns:
+        take = missing & np.asarray(is_valid(column), dtype=bool)
+        values[take] = column[take]
+        missing &= ~take
+
+    return pd.Series(values).infer_objects() if is_object else pd.Series(values)
+
+
+# Replacements of the number columns, {'-': '', ' ': '', ',': '.'} followed by 'nan', '%', 'ND' removed
+_NUMBER_TRANSLATION = str.maketrans({'-': None, ' ': None, ',': '.'})
+
+
+def coerce_numeric(values, cleaned_strings=None):
+    """
+    Convert a column of numbers typed as text to numbers in a single pass, giving the same
+    numbers as replacing {'-': '', ' ': '', ',': '.', 'nan': '', '%': '', 'ND': ''} in str(value)
+    one after the other and calling pd.to_numeric. Values which can not be parsed become NaN.
+
+    Each distinct string is cleaned once. Numbers are not converted to strings at all, as the
+    replacements only drop their sign (except for tiny numbers written with an exponent).
+
+    Parameters
+    ----------
+        values -- pandas Series
+        cleaned_strings -- dict, default None, cleaned string per raw string, shared between calls
+
+    Returns
+    -------
+        numbers -- pandas Series (float64)
+    """
+    if cleaned_strings is None:
+        cleaned_strings = {}
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numbers = values.abs().astype('float64')
+        if not ((numbers > 0) & (numbers < 1e-4)).any():
+            return numbers
+
+    # clean each distinct value once, missing values (code -1) become NaN as 'nan' does
+    codes, uniques = pd.factorize(values.to_numpy(dtype=object))
+    cleaned = np.empty(len(uniques), dtype=object)
+    for i, value in enumerate(uniques):
+        if type(value) is not str and isinstance(value, (int, float, np.number)) \
+                and not isinstance(value, (bool, np.bool_)) and not 0 < abs(value) < 1e-4:
+            cleaned[i] = abs(value)
+        elif value in cleaned_strings:
+            cleaned[i] = cleaned_strings[value]
+        else:
+            cleaned[i] = cleaned_strings[value] = str(value).translate(_NUMBER_TRANSLATION).replace('nan', '') \
+                .replace('%', '').replace('ND', '')
+
+    numbers = pd.to_numeric(cleaned, errors='coerce').astype('float64')
+    if (codes < 0).any():
+        numbers = np.append(numbers, np.nan)  # codes -1 take the last element
+    return pd.Series(numbers[codes], index=values.index)
+
+
+def feature_engineering_catch_data(df_catch, vessels=AKBM_VESSELS, per_vessel=True):
     """
     Feature engineering on cleaned AKBM catch dataset, in particular extract the following features:
         - moon phase
@@ -125,51 +173,131 @@ def feature_engineering_catch_data(df_catch):
 
     More features should be naturally be added, this will be the goal for Q2 2019.
 
+    The features are computed for all vessels in one pass over the catches sorted by vessel
+    and date, so new vessels in the fleet need no changes here (use vessels=None).
+
     Parameters
     ----------
         df_catch -- pandas DataFrame, cleaned data
+        vessels -- tuple of strings, default AKBM_VESSELS ('Antarctic Sea', 'Saga Sea', 'Antarctic Endurance'),
+            the vessels to return a DataFrame for; None returns a dict with a DataFrame per vessel in df_catch
+        per_vessel -- bool, default True, return one DataFrame per vessel instead of a single DataFrame
     Returns
     -------
         df_catch_Antarctic -- pandas DataFrame, data for Antarctic Sea
         df_catch_Saga -- pandas DataFrame, data for Saga Sea
+        df_catch_Endurance -- pandas DataFrame, data for Antarctic Endurance
+            (one DataFrame per vessel in vessels, sorted by date and empty for vessels without catches), or
+        df_catch -- dict with a DataFrame per vessel, e.g. df_catch['Antarctic Sea'], if vessels is None, or
+            a single pandas DataFrame sorted by vessel and date (catches without vessel are dropped)
+            if not per_vessel
     """
-    # Make individual datasets per vessel and sort by date
-    df_catch_Antarctic = df_catch[df_catch['Vessel'] == 'Antarctic Sea'].copy()
-    df_catch_Saga = df_catch[df_catch['Vessel'] == 'Saga Sea'].copy()
-    df_catch_Endurance = df_catch[df_catch['Vessel'] == 'Antarctic Endurance'].copy()
-
-    # Sort by date
-    df_catch_Antarctic.sort_values(by=['Date'], inplace=True)
-    df_catch_Saga.sort_values(by=['Date'], inplace=True)
-    if df_catch_Endurance.empty is False:
-        df_catch_Endurance.sort_values(by=['Date'], inplace=True)
+    df_catch = _sort_by_vessel_and_date(df_catch)
+    vessel_groups = df_catch.groupby('Vessel', sort=False)
 
-    # NOT USED currently - skipping - give date on dd/mm/yyyy to fix
-    # Compute moon phase for given day
-    # for temp_df in [df_catch_Antarctic, df_catch_Saga, df_catch_Endurance]:
-    #     if temp_df.empty is False:
-    #         temp_df['Moon phase'] = temp_df['Date'].apply(lambda x: get_moon_phase(x.year, x.month, x.day))
+    # Compute moon phase (illuminated fraction) for given day
+    dates = df_catch['Date'].values
+    df_catch['Moon phase'] = LunationTable.covering(dates).illuminated_fraction(dates)
 
     # Compute days since last catch/report day
-    for temp_df in [df_catch_Antarctic, df_catch_Saga, df_catch_Endurance]:
-        if temp_df.empty is False:
-            days_diff = temp_df['Date'] - temp_df['Date'].shift()
-            temp_df['Days since last report'] = days_diff.map(lambda x: x.days)
+    df_catch['Days since last report'] = vessel_groups['Date'].diff().dt.days.astype('float64')
 
     # Calculate distance travelled since yesterday
-    for temp_df in [df_catch_Antarctic, df_catch_Saga, df_catch_Endurance]:
-        if temp_df.empty is False:
-            n = temp_df.shape[0]
-            latlons = temp_df[['Latitude', 'Longitude']].values
-            distances = np.zeros([n, 1])
-            for i in np.arange(1, n):
-                if temp_df['Days since last report'].iloc[i] == 1:
-                    dist = distance_between_latlon_coords(latlons[i, 0], latlons[i, 1], latlons[i - 1, 0],
-                                                          latlons[i - 1, 1])
-                    distances[i] = dist
-            temp_df['Distance since yesterday'] = distances
+    previous = vessel_groups[['Latitude', 'Longitude']].shift()
+    distances = distance_between_latlon_arrays(df_catch['Latitude'].values, df_catch['Longitude'].values,
+                                               previous['Latitude'].values, previous['Longitude'].values)
+    df_catch['Distance since yesterday'] = np.where(df_catch['Days since last report'].values == 1, distances, 0.0)
+
+    if not per_vessel:
+        return df_catch
+    df_vessels = _split_by_vessel(df_catch)
+    if vessels is None:
+        return df_vessels
+    return tuple(df_vessels.get(vessel, df_catch.iloc[0:0]) for vessel in vessels)
+
+
+def trajectory_features(df_catch, stationary_distance=5.0, min_dwell_days=2, per_vessel=False):
+    """
+    Trajectory features per vessel from the daily reported positions:
+        - bearing and distance from the previous report
+        - implied speed, i.e. distance over the time since the previous report
+        - cumulative distance travelled
+        - dwell segments ("stationary fishing"), runs of reports on consecutive days each
+          within stationary_distance of the day before
+
+    Parameters
+    ----------
+        df_catch -- pandas DataFrame, cleaned data (columns 'Vessel', 'Date', 'Latitude', 'Longitude')
+        stationary_distance -- float, default 5.0, maximum distance (km) from yesterday within a dwell segment
+        min_dwell_days -- int, default 2, minimum number of days of a dwell segment to count as stationary fishing
+        per_vessel -- bool, default False, return a dict with a DataFrame per vessel
 
-    return df_catch_Antarctic, df_catch_Saga, df_catch_Endurance
+    Returns
+    -------
+        df_catch -- pandas DataFrame sorted by vessel and date, with the columns
+            'Bearing since last report' (degrees, NaN for the first report of a vessel),
+            'Distance since last report' (km), 'Speed (kn)', 'Cumulative distance' (km),
+            'Dwell segment' (int, numbers the segments), 'Dwell days' (int, days in the segment)
+            and 'Stationary fishing' (bool, the segment has at least min_dwell_days days)
+    """
+    df_catch = _sort_by_vessel_and_date(df_catch)
+    vessel = df_catch['Vessel'].values
+    latitude = df_catch['Latitude'].values.astype('float64')
+    longitude = df_catch['Longitude'].values.astype('float64')
+    dates = df_catch['Date'].values
+    n = len(vessel)
+
+    # consecutive reports of the same vessel, the first report of a vessel has no previous one
+    same_vessel = np.zeros(n, dtype=bool)
+    same_vessel[1:] = vessel[1:] == vessel[:-1]
+    previous = np.maximum(np.arange(n) - 1, 0)
+
+    distance = np.where(same_vessel, distance_between_latlon_arrays(latitude, longitude, latitude[previous],
+                                                                    longitude[previous]), 0.0)
+    bearing = np.where(same_vessel, bearing_between_latlon_arrays(latitude[previous], longitude[previous],
+                                                                  latitude, longitude), np.nan)
+    hours = (dates - dates[previous]) / np.timedelta64(1, 'h')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(same_vessel & (hours > 0), distance / KM_PER_NAUTICAL_MILE / hours, np.nan)
+
+    # cumulative distance restarts at the first report of each vessel
+    cumulative = np.cumsum(distance)
+    first = np.flatnonzero(~same_vessel)
+    cumulative -= np.repeat(cumulative[first], np.diff(np.append(first, n)))
+
+    # run-length segmentation, a report continues the segment of yesterday's report if it is close
+    days = (dates - dates[previous]) / np.timedelta64(1, 'D')
+    continues = same_vessel & (days == 1) & (distance <= stationary_distance)
+    segment = np.cumsum(~continues) - 1
+    dwell_days = np.bincount(segment)[segment] if n else np.zeros(0, dtype=np.int64)
+
+    df_catch['Bearing since last report'] = bearing
+    df_catch['Distance since last report'] = distance
+    df_catch['Speed (kn)'] = speed
+    df_catch['Cumulative distance'] = cumulative
+    df_catch['Dwell segment'] = segment
+    df_catch['Dwell days'] = dwell_days
+    df_catch['Stationary fishing'] = dwell_days >= min_dwell_days
+
+    return _split_by_vessel(df_catch) if per_vessel else df_catch
+
+
+def _sort_by_vessel_and_date(df_catch):
+    """
+    Catches with a vessel, sorted by vessel and date (stable, so catches on the same date keep their order)
+    """
+    return df_catch[df_catch['Vessel'].notna()].sort_values(by=['Vessel', 'Date'], kind='stable')
+
+
+def _split_by_vessel(df_catch):
+    """
+    Dict with the rows of each vessel, df_catch sorted by vessel
+    """
+    # the vessels are contiguous in the sorted DataFrame, slice them out
+    vessel = df_catch['Vessel'].values
+    starts = np.concatenate([[0], np.flatnonzero(vessel[1:] != vessel[:-1]) + 1]) if len(vessel) else []
+    stops = np.append(starts[1:], len(vessel))
+    return {vessel[start]: df_catch.iloc[start:stop] for start, stop in zip(starts, stops)}
 
 
 def clean_catch_data_williamdata(df_catch):
@@ -310,6 +438,74 @@ def correct_position(pos_string):
     return pos_string
 
 
+# Patterns of correct_position: the separators (the replaced characters and the whitespace of
+# str.split()), tokens of other lengths than 2 and 4 (dropped) and 'xx' as a unit. The remaining tokens
+# are read as units of two characters, a token of 4 characters giving two units.
+_POSITION_SEPARATORS = re.compile(r"[SWNE°º.,'\-\s]+")
+_POSITION_OTHER_TOKENS = re.compile(r'(?<!\S)(?:\S|\S{3}|\S{5,})(?!\S)')
+_POSITION_XX = re.compile(r'(?<!\S)(?:\S\S)?xx')
+# the first four units, the fifth and sixth (seconds given) and whether there are more than six
+_POSITION_UNITS = re.compile(r'^ *(?P<u0>\S\S) *(?P<u1>\S\S) *(?P<u2>\S\S) *(?P<u3>\S\S)'
+                             r'(?: *(?P<u4>\S\S))?(?: *(?P<u5>\S\S))?(?: *(?P<more>\S\S))?')
+_POSITION_DIGITS = re.compile(r'[0-9]{8}')
+
+
+def parse_positions(positions):
+    """
+    Vectorized correct_position followed by get_latitude_longitude_as_dd, for a whole
+    column of position strings. Handles the same format variants (XX°XXSXXXX°W, xx°xx,
+    degrees/minutes/seconds, minutes >= 60) and gives the same output.
+
+    The strings are tokenized with the pandas string methods and the patterns above; the rare
+    strings with units that are not two (ASCII) digits go through correct_position.
+
+    Parameters
+    ----------
+        positions -- pandas Series, raw position strings
+
+    Returns
+    -------
+        position -- pandas Series, corrected position strings (XX°XX S XX°XX W), None where invalid
+        latitude, longitude -- float64 arrays, position in decimal degrees, NaN where invalid
+    """
+    strings = pd.Series(pd.Series(positions, dtype=object).map(str).to_numpy(dtype=object), dtype=object)
+    units = strings.str.replace(_POSITION_SEPARATORS, ' ', regex=True)
+    units = units.str.replace(_POSITION_OTHER_TOKENS, '', regex=True)
+    valid = ~units.str.contains(_POSITION_XX, regex=True).to_numpy(dtype=bool)
+
+    extracted = units.str.extract(_POSITION_UNITS)
+    valid &= extracted['u3'].notna().to_numpy()
+    # with six units (seconds given), skip the seconds
+    six = (extracted['u5'].notna() & extracted['more'].isna()).to_numpy()
+    extracted.loc[six, ['u2', 'u3']] = extracted.loc[six, ['u3', 'u4']].to_numpy()
+    extracted = extracted[['u0', 'u1', 'u2', 'u3']]
+
+    # strings to parse one by one (units that are not two ASCII digits)
+    digits = extracted.fillna('').sum(axis=1).str.fullmatch(_POSITION_DIGITS).to_numpy(dtype=bool)
+    fallback = valid & ~digits
+    valid &= digits
+    values = extracted[valid].astype('int64').to_numpy(copy=True)
+
+    # minutes >= 60 are carried over to the degrees
+    overflow = values[:, [1, 3]] >= 60
+    values[:, [0, 2]] += overflow
+    values[:, [1, 3]] -= 60 * overflow
+
+    position = np.full(len(strings), None, dtype=object)
+    position[valid] = ['{:02d}°{:02d} S {:02d}°{:02d} W'.format(*row) for row in values.tolist()]
+    latitude = np.full(len(strings), np.nan)
+    longitude = np.full(len(strings), np.nan)
+    latitude[valid] = -(values[:, 0] + values[:, 1] / 60.0)
+    longitude[valid] = -(values[:, 2] + values[:, 3] / 60.0)
+
+    for i in np.flatnonzero(fallback):
+        position[i] = correct_position(strings.iloc[i])
+        if position[i] is not None:
+            latitude[i], longitude[i] = get_latitude_longitude_as_dd(position[i])
+
+    return pd.Series(position, index=positions.index, dtype=object), latitude, longitude
+
+
 def split_krill_size(size_string):
     """
     Correct krill size, i.e. split up string 'XX.Xmm/Y.YYg' into tuple with krill length and weight.
@@ -385,3 +581,180 @@ def split_wind_string(wind_string):
                 # If value can not be interpreted as number, we choose it to be the direction (a string)
                 direction = el_list[0]
                 return direction, None
+
+
+# Patterns for split_krill_sizes and split_wind_strings, with the same replacements
+# as split_krill_size and split_wind_string
+_KRILL_SIZE_NOISE = re.compile(r'[mgrkna/\-]')
+# the wind replacements are applied one after the other in this order (the output of one can
+# be matched by a later one, e.g. 'S-SSE' -> 'S-SE' -> 'SE')
+_WIND_REPLACEMENTS = (
+    ('ESE', 'SE'), ('WSE', 'SE'), ('WSW', 'SW'), ('ESW', 'SW'), ('SSE', 'SE'), ('SSW', 'SW'),
+    ('E-SE', 'SE'), ('W-SE', 'SE'), ('W-SW', 'SW'), ('E-SW', 'SW'), ('S-SE', 'SE'), ('S-SW', 'SW'),
+    ('ENE', 'NE'), ('WNE', 'NE'), ('WNW', 'NW'), ('ENW', 'NW'), ('NNE', 'NE'), ('NNW', 'NW'),
+    ('E-NE', 'NE'), ('W-NE', 'NE'), ('W-NW', 'NW'), ('E-NW', 'NW'), ('N-NE', 'NE'), ('N-NW', 'NW'),
+    ('East', ' E '), ('West', ' W '), ('North', ' N '), ('South', ' S '), ('Nice and calm', 'Calm'), ('calm', 'Calm'),
+    ('-', ' '), ('wind', ' '), ('kts', ' '), ('knots', ' '), ('Knots', ' '), ('kots', ' '), ('kn', ' '))
+_TOKENS = re.compile(r'^\s*(\S+)?(?:\s+(\S+))?(?:\s+(\S+))?')  # first two tokens, and a third if any
+
+
+def split_krill_sizes(size_strings):
+    """
+    Vectorized split_krill_size, i.e. split up strings 'XX.Xmm/Y.YYg' (and the same variants)
+    into krill length and weight. Unlike split_krill_size, parts that are not numbers give NaN.
+
+    Parameters
+    ----------
+        size_strings -- pandas Series, krill size strings
+
+    Returns
+    -------
+        df_size -- pandas DataFrame with float64 columns ['Krill Size (mm)', 'Krill weight (gram)']
+    """
+    strings = pd.Series(size_strings, dtype=object).map(str).str.lower()
+    strings = strings.str.replace(',', '.', regex=False).str.replace('..', '.', regex=False)
+    strings = strings.str.replace(' ', '', regex=False).str.replace(_KRILL_SIZE_NOISE, ' ', regex=True)
+    tokens = strings.str.extract(_TOKENS)
+
+    two_tokens = tokens[1].notna() & tokens[2].isna()
+    return pd.DataFrame({'Krill Size (mm)': pd.to_numeric(tokens[0].where(two_tokens), errors='coerce'),
+                         'Krill weight (gram)': pd.to_numeric(tokens[1].where(two_tokens), errors='coerce')},
+                        index=strings.index).astype('float64')
+
+
+def split_wind_strings(wind_strings):
+    """
+    Vectorized split_wind_string, i.e. correct and split manually entered wind specifications
+    (e.g. 'WSW 15 kts', 'East-20knots', 'Nice and calm') into wind direction and speed.
+    Unlike split_wind_string, a speed that is not a number gives NaN.
+
+    Parameters
+    ----------
+        wind_strings -- pandas Series, wind strings
+
+    Returns
+    -------
+        df_wind -- pandas DataFrame with columns ['Wind direction'] (categorical) and ['Wind speed (kn)'] (float64)
+    """
+    wind_strings = pd.Series(wind_strings, dtype=object)
+    direction = pd.Series(None, index=wind_strings.index, dtype=object)
+    speed = pd.Series(np.nan, index=wind_strings.index)
+
+    given = wind_strings.notna() & (wind_strings != '')
+    strings = wind_strings[given].map(str).str.replace(',', '.', regex=False)
+    for old, new in _WIND_REPLACEMENTS:
+        strings = strings.str.replace(old, new, regex=False)
+    tokens = strings.str.extract(_TOKENS)
+
+    # two tokens are direction and speed, a single token is the speed if it is a number
+    two_tokens = tokens[1].notna() & tokens[2].isna()
+    one_token = tokens[0].notna() & tokens[1].isna()
+    number = pd.to_numeric(tokens[0].where(one_token), errors='coerce')
+    is_number = one_token & (number.notna() | tokens[0].str.lower().isin(['nan', '+nan', '-nan']))
+
+    direction[tokens.index[two_tokens | (one_token & ~is_number)]] = tokens[0][two_tokens | (one_token & ~is_number)]
+    speed[tokens.index[two_tokens]] = pd.to_numeric(tokens[1][two_tokens], errors='coerce').astype('float64')
+    speed[tokens.index[is_number]] = number[is_number].astype('float64')
+
+    return pd.DataFrame({'Wind direction': pd.Categorical(direction),
+                         'Wind speed (kn)': speed})
+
+
+class ParseCache():
+    """
+    Bounded LRU memo for parsing free-text values, which repeat a lot as they are typed by hand on board.
+    Each distinct raw value is parsed once per call (values are factorized first) and the results are
+    kept between calls, so repeated cleaning runs and daily increments only parse values not seen before.
+
+    Parameters
+    ----------
+        parser -- function, takes a list of distinct raw values and returns a list with one result
+            (tuple) per value
+        n_columns -- int, number of elements of the results (columns of the returned DataFrame)
+        max_size -- int, default 100000, number of distinct values kept, least recently used are dropped
+
+    Attributes
+    ----------
+        hits, misses -- ints, number of values (rows) served from the memo and number of values parsed
+    """
+    def __init__(self, parser, n_columns, max_size=100000):
+        self.parser = parser
+        self.n_columns = n_columns
+        self.max_size = max_size
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else np.nan
+
+    def parse(self, values):
+        """
+        Parse the values (pandas Series or list), returning a DataFrame with one row per value
+        (RangeIndex) and one column per element of the results
+        """
+        values = list(values)
+        # non-string values (e.g. nan) are told apart by type, as the parsers are
+        keys = pd.Series([value if type(value) is str else (type(value).__name__, str(value)) for value in values],
+                         dtype=object)
+        codes, unique_keys = pd.factorize(keys)
+        _, first = np.unique(codes, return_index=True)
+
+        results = [None] * len(unique_keys)
+        missing = []
+        for code, key in enumerate(unique_keys):
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                results[code] = self.memo[key]
+            else:
+                missing.append(code)
+        if missing:
+            for code, result in zip(missing, self.parser([values[first[code]] for code in missing])):
+                results[code] = result
+                self.memo[unique_keys[code]] = result
+            while len(self.memo) > self.max_size:
+                self.memo.popitem(last=False)
+
+        self.misses += len(missing)
+        self.hits += len(values) - len(missing)
+        return pd.DataFrame(results, columns=range(self.n_columns)).take(codes).reset_index(drop=True)
+
+    def clear(self):
+        self.memo.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _parse_position_values(values):
+    position, latitude, longitude = parse_positions(pd.Series(values, dtype=object))
+    return list(zip(position.where(position.notna(), None), latitude, longitude))
+
+
+def _parse_wind_values(values):
+    df_wind = split_wind_strings(pd.Series(values, dtype=object))
+    direction = df_wind['Wind direction'].astype(object)
+    return list(zip(direction.where(direction.notna(), None), df_wind['Wind speed (kn)']))
+
+
+def _parse_krill_size_values(values):
+    df_size = split_krill_sizes(pd.Series(values, dtype=object))
+    return list(zip(df_size['Krill Size (mm)'], df_size['Krill weight (gram)']))
+
+
+# parse caches of clean_catch_data, shared between calls
+PARSE_CACHES = {'Position': ParseCache(_parse_position_values, 3),
+                'Wind': ParseCache(_parse_wind_values, 2),
+                'Krill Size (mm/ Gr)': ParseCache(_parse_krill_size_values, 2)}
+
+
+def parse_cache_report(parse_caches=None):
+    """
+    Hit rates of the parse caches (default PARSE_CACHES), as a DataFrame with one row per column
+    """
+    if parse_caches is None:
+        parse_caches = PARSE_CACHES
+    return pd.DataFrame([{'column': column, 'hits': cache.hits, 'misses': cache.misses,
+                          'hit_rate': cache.hit_rate, 'size': len(cache.memo)}
+                         for column, cache in parse_caches.items()]).set_index('column')